@@ -0,0 +1,318 @@
+# bench/fakes.py - ネットワークにも Discord にも接続せずに bot.py を動かすための偽物
+# run_benchmarks.py から使う。環境変数を設定してから bot を import するので、bot より先に import すること。
+#   FakeExtractor     yt_dlp.YoutubeDL の代わりに決まった形の情報を返す (プレイリスト/単一動画)
+#   FakeAudioSource   FFmpegPCMAudio / FFmpegOpusAudio の代わりに決まった数のフレームを返す
+#   FakeVoiceClient   音声ソースのフレームを別スレッドで読み切って after を呼ぶ (実時間は待たない)
+#   VoicePump         複数の FakeVoiceClient のフレームを1本のスレッドで実時間どおり (20ms ごと) に読む (負荷試験用)
+#   FakeContext       スラッシュコマンドの ctx の代わり (送信したメッセージは記録するだけ)
+
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# .env の設定に左右されないよう、結果に影響するものはここで固定する
+os.environ.setdefault("DISCORD_BOT_TOKEN", "bench") # bot.py は起動時に値があるかを確認するだけ
+os.environ["CACHE_DIR"] = tempfile.mkdtemp(prefix="musicbot-bench-") # 毎回空のキャッシュから始める
+os.environ["META_CACHE_PLAYLIST_MAX"] = "1000000" # 大きなプレイリストもキャッシュからの取り込みを計測する
+os.environ["AUDIO_CACHE_MAX_MB"] = "0"
+os.environ["METRICS_PORT"] = "0"
+os.environ["TRACE_LOG_PATH"] = ""
+os.environ["EXTRACT_BACKEND"] = "thread"
+os.environ["LOG_LEVEL"] = "ERROR" # ログの出力は計測しない
+os.environ["LOG_LEVELS"] = ""
+
+import discord
+import bot
+import extraction
+
+
+_YOUTUBE_WATCH_PREFIX = "https://www.youtube.com/watch?v="
+_PLAYLIST_PREFIX = "https://www.youtube.com/playlist?list="
+FAR_EXPIRY = 4102444800 # ストリームURLの expire (2100年。期限切れで再取得されないように)
+
+
+def fake_video_id(n: int) -> str:
+    """n 番目の偽の動画ID (YouTube と同じ 11 文字)"""
+    return f"bench{n:06d}"
+
+
+def playlist_url(size: int, tag: str = "") -> str:
+    """size 曲の偽プレイリストのURL (tag を変えるとメタデータキャッシュに当たらない別のプレイリストになる)"""
+    return f"{_PLAYLIST_PREFIX}PLbench{tag}x{size}"
+
+
+def flat_entry(n: int) -> dict:
+    """プレイリストの n 番目のエントリ (yt-dlp の extract_flat と同じ形)"""
+    video_id = fake_video_id(n)
+    return {'id': video_id, 'title': f"Benchmark Track {n} - Some Artist (Official Audio)", 'duration': 180 + n % 120,
+            'ie_key': 'Youtube', 'url': _YOUTUBE_WATCH_PREFIX + video_id, '_type': 'url'}
+
+
+class FakeExtractor:
+    """yt-dlp の代わりに決まった形の情報を返す。latency 秒だけ待ってから返す (ワーカーを占有する時間の模擬)"""
+
+    def __init__(self):
+        self.latency = 0.0
+        self.calls: Counter = Counter()
+
+    def extract_info(self, url: str, flat: bool) -> dict | None:
+        self.calls['flat' if flat else 'full'] += 1
+        if self.latency: time.sleep(self.latency)
+        if url.startswith(_PLAYLIST_PREFIX):
+            size = int(url.rsplit('x', 1)[1])
+            playlist_id = url[len(_PLAYLIST_PREFIX):]
+            if not flat: # 詳細取得ではプレイリストの最初の曲
+                return self.video_info(fake_video_id(0))
+            # 本物と同じく entries はジェネレータ (ページングしながら届く)
+            return {'_type': 'playlist', 'id': playlist_id, 'title': f"Benchmark Playlist {playlist_id}",
+                    'extractor_key': 'YoutubeTab', 'entries': (flat_entry(n) for n in range(size))}
+        video_id = url[len(_YOUTUBE_WATCH_PREFIX):] if url.startswith(_YOUTUBE_WATCH_PREFIX) else fake_video_id(abs(hash(url)) % 1000000)
+        if flat:
+            return {'_type': 'url', 'id': video_id, 'url': _YOUTUBE_WATCH_PREFIX + video_id, 'ie_key': 'Youtube'}
+        return self.video_info(video_id)
+
+    @staticmethod
+    def video_info(video_id: str) -> dict:
+        return {
+            'id': video_id, 'title': f"Benchmark Track {video_id}", 'duration': 200, 'extractor_key': 'Youtube',
+            'webpage_url': _YOUTUBE_WATCH_PREFIX + video_id,
+            'formats': [{'url': f"https://bench.invalid/{video_id}?expire={FAR_EXPIRY}", 'acodec': 'opus', 'vcodec': 'none', 'abr': 160}],
+        }
+
+
+fake_extractor = FakeExtractor()
+
+
+class FakeYoutubeDL:
+    """extraction.py の YoutubeDLPool が作るインスタンスの代わり"""
+
+    def __init__(self, opts: dict):
+        self.flat = bool(opts.get('extract_flat'))
+
+    def extract_info(self, url: str, download: bool = False, process: bool = True) -> dict | None:
+        return fake_extractor.extract_info(url, self.flat)
+
+
+class FakeAudioSource(discord.AudioSource):
+    """frames 個のフレームを返したら終わる音声ソース (FFmpeg の音声ソースと同じ引数で作れる)"""
+    frames = 50 # 1曲あたりのフレーム数 (本物なら 20ms/フレーム)
+    opus = False
+
+    def __init__(self, source: str, **kwargs):
+        self.source = source
+        self._remaining = self.frames
+        self._frame = b'\x00' * (160 if self.opus else discord.opus.Encoder.FRAME_SIZE)
+
+    def read(self) -> bytes:
+        if self._remaining <= 0:
+            return b''
+        self._remaining -= 1
+        return self._frame
+
+    def is_opus(self) -> bool:
+        return self.opus
+
+    def cleanup(self):
+        self._remaining = 0
+
+
+class FakeOpusSource(FakeAudioSource):
+    opus = True
+
+    def __init__(self, source: str, codec: str | None = None, **kwargs):
+        super().__init__(source, **kwargs)
+
+
+class FakeMember:
+    def __init__(self, member_id: int = 4242, is_bot: bool = False):
+        self.id = member_id
+        self.name = self.display_name = f"bench-{member_id}"
+        self.mention = f"<@{member_id}>"
+        self.display_avatar = None
+        self.bot = is_bot
+        self.voice = None
+
+
+class FakeVoiceChannel:
+    """VoiceChannel の代わり。connect() すると FakeVoiceClient を返す (pump があれば実時間で再生する)"""
+
+    def __init__(self, channel_id: int = 1000, pump: 'VoicePump | None' = None):
+        self.id = channel_id
+        self.name = "bench-vc"
+        self.members = [FakeMember(1), FakeMember(2, is_bot=True)]
+        self.pump = pump
+
+    async def connect(self, timeout: float = 60.0, **kwargs) -> 'FakeVoiceClient':
+        return FakeVoiceClient(self, pump=self.pump)
+
+
+class FakeVoiceClient:
+    """VoiceClient の代わり。play された音声ソースをフレームがなくなるまで読み、after を呼ぶ
+    pump がなければ曲ごとに別スレッドで一気に読み、あれば VoicePump が実時間どおりに読む
+    各曲の play 呼び出し・最初のフレーム・終了の時刻 (time.perf_counter()) を記録する"""
+
+    def __init__(self, channel: FakeVoiceChannel | None = None, pump: 'VoicePump | None' = None):
+        self.channel = channel or FakeVoiceChannel()
+        self.pump = pump
+        self.connected = True
+        self.play_times: list[float] = []
+        self.first_frame_times: list[float] = []
+        self.end_times: list[float] = []
+        self.frames_read = 0
+        self._playing = False
+        self._first_pending = False
+        self._stop = threading.Event()
+        self.finished = threading.Event() # expect_tracks 曲を再生し終えたらセット
+        self.expect_tracks = 0
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def is_playing(self) -> bool:
+        return self._playing
+
+    def is_paused(self) -> bool:
+        return False
+
+    def play(self, source: discord.AudioSource, after=None):
+        self.play_times.append(time.perf_counter())
+        self._playing = True
+        self._first_pending = True
+        self._stop.clear()
+        if self.pump:
+            self.pump.add(self, source, after)
+        else:
+            threading.Thread(target=self._consume, args=(source, after), daemon=True, name='bench-voice').start()
+
+    def _consume(self, source: discord.AudioSource, after):
+        while self.read_frame(source):
+            pass
+        self.finish(source, after)
+
+    def read_frame(self, source: discord.AudioSource) -> bool:
+        """1フレーム読む (止められたか、読み終わったら False)"""
+        if self._stop.is_set() or not source.read():
+            return False
+        if self._first_pending:
+            self._first_pending = False
+            self.first_frame_times.append(time.perf_counter())
+        self.frames_read += 1
+        return True
+
+    def finish(self, source: discord.AudioSource, after):
+        source.cleanup()
+        self.end_times.append(time.perf_counter())
+        self._playing = False
+        if self.expect_tracks and len(self.end_times) >= self.expect_tracks:
+            self.finished.set()
+        if after: after(None)
+
+    def stop(self):
+        self._stop.set()
+
+    async def disconnect(self, force: bool = False):
+        self.connected = False
+        self.stop()
+
+    async def move_to(self, channel: FakeVoiceChannel):
+        self.channel = channel
+
+
+class VoicePump:
+    """再生中の FakeVoiceClient から interval 秒ごとに1フレームずつ読むスレッド
+    (本物の py-cord は VC ごとに再生スレッドを立てるが、負荷試験ではボット側の負荷を見たいので1本にまとめる)"""
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self._active: dict[FakeVoiceClient, tuple] = {} # VC -> (音声ソース, after)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self.late_ticks = 0 # 間に合わなかった (interval 以上かかった) 回数
+        threading.Thread(target=self._run, daemon=True, name='bench-voice-pump').start()
+
+    def add(self, voice_client: FakeVoiceClient, source: discord.AudioSource, after):
+        with self._lock:
+            self._active[voice_client] = (source, after)
+
+    @property
+    def playing(self) -> int:
+        return len(self._active)
+
+    def close(self):
+        self._closed.set()
+
+    def _run(self):
+        next_tick = time.perf_counter()
+        while not self._closed.is_set():
+            with self._lock:
+                active = list(self._active.items())
+            for voice_client, (source, after) in active:
+                if not voice_client.read_frame(source):
+                    with self._lock:
+                        self._active.pop(voice_client, None)
+                    voice_client.finish(source, after)
+            next_tick += self.interval
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.late_ticks += 1
+                next_tick = time.perf_counter()
+
+
+class FakeMessage:
+    def __init__(self, content: str | None = None):
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content: str | None = None, **kwargs):
+        self.content = content
+        self.edits += 1
+
+
+class _FakeFollowup:
+    async def send(self, content: str | None = None, **kwargs) -> FakeMessage:
+        return FakeMessage(content)
+
+
+class FakeContext:
+    """スラッシュコマンドの ctx の代わり (respond/followup の内容は捨てる)"""
+    _ids = itertools.count(1)
+
+    def __init__(self, guild_id: int, author: FakeMember | None = None):
+        self.guild_id = guild_id
+        self.guild = True # コマンド側は「サーバー内か」の判定にしか使わない
+        self.channel_id = 2000
+        self.author = author or FakeMember()
+        self.followup = _FakeFollowup()
+        self.responses = 0
+
+    async def respond(self, content: str | None = None, **kwargs):
+        self.responses += 1
+
+    async def defer(self, **kwargs):
+        pass
+
+
+def install():
+    """yt-dlp と FFmpeg を偽物に差し替える"""
+    extraction.load_yt_dlp().YoutubeDL = FakeYoutubeDL
+    discord.FFmpegPCMAudio = FakeAudioSource
+    discord.FFmpegOpusAudio = FakeOpusSource
+
+
+async def wait_until(predicate, timeout: float = 30.0, interval: float = 0.005):
+    """predicate() が真になるまで待つ (タイムアウトしたら TimeoutError)"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Benchmark condition was not reached in time.")
+        await asyncio.sleep(interval)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# bench/loadtest.py - 大量のサーバーから同時にコマンドが来たときの負荷試験
+#
+# 使い方: python bench/loadtest.py [--guilds 50,200,1000] [--duration 30] [--rate 6] [--fixtures 記録フォルダ] [--output 結果.json]
+# サーバー数を段階的に増やしながら、各サーバーの利用者が /play /queue /skip /remove /stop を
+# 1分あたり --rate 回のペース (間隔はランダム) で実行し、次のものを計測する。
+#   コマンドごとの応答時間 (p50/p90/p99/max)、イベントループの遅れ、CPU使用率、メモリ (RSS)、再生した曲数
+# CPU使用率とコマンド数/秒は --duration の区間で計算する。区間の終わりに実行中だったコマンドを待った時間は drain_s に出す。
+# Discord (Gateway/VC) と FFmpeg は fakes.py の偽物、曲情報の取得は extraction.ReplayResolver の記録の再生で行う。
+# --fixtures を指定しなければ、偽の曲情報を記録したフォルダをその場で作る (--extract-latency 秒ずつかかる扱い)。
+# 本番で EXTRACT_RESOLVER=record:<フォルダ> で記録したものを --fixtures に渡せば、実際の /play の入力で試験できる。
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+from fakes import bot, extraction, FakeContext, FakeMember, FakeVoiceChannel, VoicePump
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+COMMANDS = ('play', 'queue', 'skip', 'remove', 'stop')
+
+
+# --- 曲情報の記録 ---
+def build_fixtures(directory: str, videos: int, playlists: int, playlist_size: int) -> list[str]:
+    """偽の曲情報を RecordingResolver で記録し、/play に渡す入力 (URL と検索ワード) の一覧を返す"""
+    fakes.install()
+    recorder = extraction.RecordingResolver(extraction.YtDlpResolver(), directory)
+    queries = []
+    for n in range(videos):
+        url = f"https://www.youtube.com/watch?v={fakes.fake_video_id(n)}"
+        recorder.extract_flat(url)
+        recorder.extract_full(url)
+        queries.append(url)
+    for n in range(videos // 4): # 検索ワード (フラット取得では情報が足りず、詳細取得し直す)
+        query = f"benchmark search {n}"
+        recorder.extract_flat(query)
+        recorder.extract_full(query)
+        recorder.extract_full(f"https://www.youtube.com/watch?v={fakes.fake_video_id(abs(hash(query)) % 1000000)}")
+        queries.append(query)
+    for n in range(playlists):
+        url = fakes.playlist_url(playlist_size, tag=f"load{n}")
+        recorder.stream_flat(url, lambda event, payload: True)
+        queries.append(url)
+    return queries
+
+
+def load_queries(directory: str) -> list[str]:
+    """記録フォルダにある /play の入力 (フラット取得の記録) の一覧"""
+    queries = []
+    for path in glob.glob(os.path.join(directory, 'flat-*.json')):
+        with open(path, encoding='utf-8') as f:
+            queries.append(json.load(f)['input'])
+    return queries
+
+
+# --- 計測 ---
+def current_rss() -> int | None:
+    """このプロセスの RSS (バイト)。取れない環境では None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None: # /proc がない場合はピーク値で代用 (macOS はバイト、それ以外は KB)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return None
+
+
+def percentiles(samples: list[float], scale: float = 1000.0) -> dict:
+    """サンプル (秒) の代表値をミリ秒で返す"""
+    if not samples:
+        return {'n': 0}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * scale, 3)
+    return {'n': len(ordered), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': round(ordered[-1] * scale, 3),
+            'mean': round(statistics.fmean(ordered) * scale, 3)}
+
+
+class LoopMonitor:
+    """イベントループの遅れ (sleep(interval) が何秒遅れて戻ったか) と RSS のピークを記録する"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lag: list[float] = []
+        self.peak_rss = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task: self._task.cancel()
+
+    async def _run(self):
+        last_rss_check = 0.0
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self.lag.append(max(0.0, now - started - self.interval))
+            if now - last_rss_check >= 1.0:
+                last_rss_check = now
+                self.peak_rss = max(self.peak_rss, current_rss() or 0)
+
+
+# --- 利用者の模擬 ---
+class SimulatedGuild:
+    """1つのサーバーと、そこでコマンドを打つ利用者"""
+
+    def __init__(self, guild_id: int, pump: VoicePump, queries: list[str], rng: random.Random):
+        self.guild_id = guild_id
+        self.channel = FakeVoiceChannel(guild_id, pump=pump)
+        self.member = FakeMember(guild_id % 100000 + 1)
+        self.member.voice = types.SimpleNamespace(channel=self.channel)
+        self.queries = queries
+        self.rng = rng
+
+    def connected(self) -> bool:
+        state = bot.guild_states.get(self.guild_id)
+        return bool(state and state.voice_client and state.voice_client.is_connected())
+
+    def choose(self, weights: dict[str, float]) -> str:
+        if not self.connected(): # 接続していなければ、まず /play
+            return 'play'
+        names = list(weights)
+        return self.rng.choices(names, weights=[weights[name] for name in names])[0]
+
+    async def run_command(self, name: str):
+        ctx = FakeContext(self.guild_id, self.member)
+        if name == 'play':
+            await bot.play.callback(ctx, self.rng.choice(self.queries))
+        elif name == 'queue':
+            await bot.queue_cmd.callback(ctx)
+        elif name == 'skip':
+            await bot.skip.callback(ctx)
+        elif name == 'remove':
+            state = bot.guild_states.get(self.guild_id)
+            length = len(state.queue) if state else 0
+            await bot.remove.callback(ctx, self.rng.randint(1, length) if length else 1)
+        elif name == 'stop':
+            await bot.stop.callback(ctx)
+
+
+async def run_step(guild_count: int, args, queries: list[str], weights: dict[str, float]) -> dict:
+    """guild_count サーバーで args.duration 秒間コマンドを打ち続け、結果をまとめる"""
+    rng = random.Random(args.seed + guild_count)
+    pump = VoicePump()
+    guilds = [SimulatedGuild(1_000_000 + guild_count * 10_000 + i, pump, queries, random.Random(rng.random())) for i in range(guild_count)]
+    latencies: dict[str, list[float]] = {name: [] for name in COMMANDS}
+    errors: dict[str, int] = {name: 0 for name in COMMANDS}
+    inflight: set[asyncio.Task] = set()
+    issued = 0
+    monitor = LoopMonitor()
+    mean_interval = 60.0 / args.rate
+    deadline = time.perf_counter() + args.duration
+
+    async def timed(guild: SimulatedGuild, name: str):
+        started = time.perf_counter()
+        try:
+            await guild.run_command(name)
+            latencies[name].append(time.perf_counter() - started)
+        except Exception as e:
+            errors[name] += 1
+            if errors[name] <= 3: print(f"  {name} failed in guild {guild.guild_id}: {type(e).__name__}: {e}", file=sys.stderr)
+
+    async def pause(seconds: float):
+        # 終了時刻を過ぎて待たない (計測の区間が --duration より延びないように)
+        await asyncio.sleep(max(0.0, min(seconds, deadline - time.perf_counter())))
+
+    async def user(guild: SimulatedGuild):
+        nonlocal issued
+        await pause(guild.rng.uniform(0, mean_interval)) # 開始をばらけさせる
+        while time.perf_counter() < deadline:
+            # 前のコマンドの完了は待たない (Discord の利用者も待たずに次を打てる)
+            task = asyncio.ensure_future(timed(guild, guild.choose(weights)))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+            issued += 1
+            await pause(guild.rng.expovariate(1.0 / mean_interval))
+
+    gc_threads_before = threading.active_count()
+    monitor.start()
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(user(guild) for guild in guilds))
+    # 割合は --duration の区間で計算する。実行中のコマンドの完了を待つ時間 (drain) は別に出す
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+    drain_started = time.perf_counter()
+    if inflight:
+        await asyncio.wait(inflight, timeout=30)
+    drain = time.perf_counter() - drain_started
+    monitor.stop()
+
+    result = {
+        'guilds': guild_count,
+        'duration_s': round(wall, 2),
+        'drain_s': round(drain, 2),
+        'unfinished_commands': len(inflight),
+        'commands': {name: dict(percentiles(samples), errors=errors[name]) for name, samples in latencies.items()},
+        'commands_per_second': round(issued / wall, 1),
+        'loop_lag_ms': percentiles(monitor.lag),
+        'cpu_percent': round(cpu / wall * 100, 1),
+        'rss_mb': round((current_rss() or 0) / 2**20, 1),
+        'peak_rss_mb': round(max(monitor.peak_rss, current_rss() or 0) / 2**20, 1),
+        'threads': threading.active_count(),
+        'threads_before': gc_threads_before,
+        'guild_states': len(bot.guild_states),
+        'queued_tracks': sum(len(state.queue) for state in bot.guild_states.values()),
+        'playing': pump.playing,
+        'voice_pump_late_ticks': pump.late_ticks,
+        'extraction': bot.extraction_scheduler.stats(),
+        'replay_misses': getattr(extraction.resolver, 'misses', None),
+    }
+
+    # 次の段階に持ち越さないよう、全サーバーを /stop する
+    for guild in guilds:
+        if guild.connected():
+            await bot.stop.callback(FakeContext(guild.guild_id, guild.member))
+    for guild_id in [guild.guild_id for guild in guilds if guild.guild_id in bot.guild_states]:
+        bot.remove_guild_state(guild_id)
+    pump.close()
+    await asyncio.sleep(0.5) # キャンセルしたプレーヤーのタスクを片付ける
+    return result
+
+
+def parse_mix(spec: str) -> dict[str, float]:
+    weights = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in COMMANDS:
+            raise SystemExit(f"Unknown command in --mix: {name}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+async def run(args) -> dict:
+    if args.fixtures:
+        fixture_dir = args.fixtures
+    else:
+        fixture_dir = tempfile.mkdtemp(prefix="musicbot-fixtures-")
+        print(f"Recording synthetic fixtures into {fixture_dir}...", file=sys.stderr)
+        build_fixtures(fixture_dir, args.videos, args.playlists, args.playlist_size)
+    queries = load_queries(fixture_dir)
+    if not queries:
+        raise SystemExit(f"No flat-*.json fixtures found in {fixture_dir}.")
+    latency = args.extract_latency if args.extract_latency is not None else (None if args.fixtures else 0.5)
+    extraction.resolver = extraction.ReplayResolver(fixture_dir, latency=latency, jitter=args.jitter)
+    # yt-dlp は一切呼ばれないはず (記録にない入力は ReplayResolver が失敗にする)
+    extraction.load_yt_dlp().YoutubeDL = None
+    weights = parse_mix(args.mix)
+    fakes.FakeAudioSource.frames = int(args.track_seconds / 0.02)
+
+    steps = []
+    for guild_count in args.guilds:
+        print(f"Running {guild_count} guilds for {args.duration}s...", file=sys.stderr)
+        result = await run_step(guild_count, args, queries, weights)
+        steps.append(result)
+        play = result['commands']['play']
+        print(f"  play p99 {play.get('p99')}ms, loop lag p99 {result['loop_lag_ms'].get('p99')}ms, "
+              f"cpu {result['cpu_percent']}%, rss {result['rss_mb']}MB", file=sys.stderr)
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rate_per_guild_per_min': args.rate,
+            'mix': weights,
+            'track_seconds': args.track_seconds,
+            'extract_latency': latency if latency is not None else 'recorded',
+            'extract_workers': bot.EXTRACT_WORKERS,
+            'queries': len(queries),
+            'fixtures': fixture_dir,
+        },
+        'steps': steps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test: drive slash commands across many simulated guilds against fakes and replayed extraction.")
+    parser.add_argument('--guilds', type=lambda s: [int(x) for x in s.split(',')], default=[50, 200, 500], help="comma-separated guild counts to step through")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds per step")
+    parser.add_argument('--rate', type=float, default=6.0, help="commands per guild per minute")
+    parser.add_argument('--mix', default="play=4,queue=3,skip=2,remove=2,stop=1", help="command weights")
+    parser.add_argument('--track-seconds', type=float, default=30.0, help="length of each fake track")
+    parser.add_argument('--fixtures', help="directory recorded with EXTRACT_RESOLVER=record:<dir> (default: synthetic)")
+    parser.add_argument('--extract-latency', type=float, help="fixed replay latency in seconds (default: recorded time, or 0.5 for synthetic fixtures)")
+    parser.add_argument('--jitter', type=float, default=0.3, help="replay latency jitter ratio")
+    parser.add_argument('--videos', type=int, default=400, help="synthetic fixtures: number of single videos")
+    parser.add_argument('--playlists', type=int, default=20, help="synthetic fixtures: number of playlists")
+    parser.add_argument('--playlist-size', type=int, default=200, help="synthetic fixtures: entries per playlist")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# bench/run_benchmarks.py - キュー周りの処理速度をオフラインで計測する
+#
+# 使い方: python bench/run_benchmarks.py [--quick] [--only 名前 ...] [--output 結果.json] [--compare 前回.json]
+# yt-dlp・FFmpeg・Discord はすべて fakes.py の偽物に差し替えるので、ネットワークもトークンも不要。
+# 結果は JSON で出力する (--output がなければ標準出力)。--compare で前回の結果との差を標準エラーに表示する。
+#   enqueue_playlist  1万曲のプレイリストを /play してキューに入れ終わるまで (初回/メタデータキャッシュあり)
+#   player_cycle      曲の終わりから次の曲の最初のフレームまで (抽出の待ち時間あり/なし)
+#   queue_render      /queue の Embed 作成 (キャッシュなし/あり、先頭/中央/末尾のページ)
+#   entry_memory      キューの1曲あたりのメモリ (タイトル文字列を含む)
+#   remove            /remove の1回あたりの時間 (先頭/中央/末尾)
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+from fakes import bot, fake_extractor, FakeContext, FakeMember, FakeVoiceClient
+
+_guild_ids = iter(range(10_000, 1_000_000))
+
+
+def new_guild_state() -> bot.GuildMusicState:
+    """ベンチマークごとに別のサーバーとして状態を作る (前のベンチマークのキャッシュを持ち越さない)"""
+    return bot.get_guild_state(next(_guild_ids))
+
+
+def release_guild_state(state: bot.GuildMusicState):
+    if state.voice_client: state.voice_client.connected = False # 切断処理 (bot.loop 上のタスク) を走らせない
+    bot.remove_guild_state(state.guild_id)
+
+
+def fill_queue(state: bot.GuildMusicState, size: int, start: int = 0):
+    """start 番目からの偽の曲を size 曲キューに入れる (start を変えるとストリームキャッシュに当たらない別の曲になる)"""
+    state.queue.extend(state._playlist_entry_to_song(fakes.flat_entry(n), 4242 + n % 7) for n in range(start, start + size))
+
+
+def percentiles(samples: list[float], scale: float = 1000.0) -> dict:
+    """サンプル (秒) の代表値をミリ秒で返す"""
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * scale, 4)
+    return {'n': len(ordered), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': round(ordered[-1] * scale, 4),
+            'mean': round(statistics.fmean(ordered) * scale, 4)}
+
+
+def time_calls(func, repeat: int) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+# --- ベンチマーク本体 ---
+async def bench_enqueue_playlist(sizes: list[int], repeat: int) -> dict:
+    """/play でプレイリストをキューに入れ終わるまでの時間
+    cold は毎回別のプレイリスト (yt-dlp を呼ぶ)、cached はメタデータキャッシュに保存された後の2回目"""
+    results = {}
+    for size in sizes:
+        cold, cached = [], []
+        for i in range(repeat):
+            url = fakes.playlist_url(size, tag=f"r{i}t{time.time_ns()}")
+            for samples in (cold, cached):
+                state = new_guild_state()
+                started = time.perf_counter()
+                added = await state.add_to_queue(url, FakeMember(), FakeContext(state.guild_id))
+                samples.append(time.perf_counter() - started)
+                assert added == size, f"expected {size} songs, got {added}"
+                release_guild_state(state)
+                if samples is cold: # 保存はバックグラウンドで行われるので、キャッシュに入るまで待つ
+                    key = bot.metadata_cache_key(url)
+                    await fakes.wait_until(lambda: bot.metadata_cache.get(key) is not None)
+        results[str(size)] = {
+            'cold': dict(percentiles(cold), entries_per_second=round(size / statistics.median(cold))),
+            'cached': dict(percentiles(cached), entries_per_second=round(size / statistics.median(cached))),
+        }
+    return results
+
+
+async def bench_player_cycle(tracks: int, latencies: list[float]) -> dict:
+    """曲が終わってから次の曲の最初のフレームが出るまでの時間 (曲間の無音)
+    extract_latency は yt-dlp の詳細取得にかかる時間の模擬 (先読みが効いていれば曲間には出てこない)"""
+    results = {}
+    for i, latency in enumerate(latencies):
+        fake_extractor.latency = latency
+        state = new_guild_state()
+        voice_client = FakeVoiceClient()
+        voice_client.expect_tracks = tracks
+        state.voice_client = voice_client
+        fill_queue(state, tracks, start=100000 * (i + 1))
+        started = time.perf_counter()
+        state.start_player_task()
+        await fakes.wait_until(voice_client.finished.is_set, timeout=60 + tracks * latency * 2)
+        elapsed = time.perf_counter() - started
+        gaps = [voice_client.first_frame_times[n + 1] - voice_client.end_times[n] for n in range(tracks - 1)]
+        results[f"extract_latency_{int(latency * 1000)}ms"] = {
+            'gap_ms': percentiles(gaps),
+            'first_track_ms': round((voice_client.first_frame_times[0] - started) * 1000, 3),
+            'tracks_per_second': round(tracks / elapsed, 1),
+        }
+        release_guild_state(state)
+    fake_extractor.latency = 0.0
+    return results
+
+
+async def bench_queue_render(sizes: list[int], repeat: int) -> dict:
+    """/queue の Embed 作成 (送信用の dict への変換まで)。cold はキュー変更直後、warm は同じページの2回目"""
+    results = {}
+    viewer = FakeMember()
+    for size in sizes:
+        state = new_guild_state()
+        fill_queue(state, size)
+        pages = {'first': 0, 'middle': state.queue_page_count() // 2, 'last': state.queue_page_count() - 1}
+        size_results = {}
+        for label, page in pages.items():
+            def cold():
+                state.queue.append(state.queue.pop()) # キューを変更してページのキャッシュを無効にする
+                bot.build_queue_embed(state, page, viewer).to_dict()
+            cold_samples = time_calls(cold, repeat)
+            warm_samples = time_calls(lambda: bot.build_queue_embed(state, page, viewer).to_dict(), repeat)
+            size_results[label] = {'cold': percentiles(cold_samples), 'warm': percentiles(warm_samples)}
+        results[str(size)] = size_results
+        release_guild_state(state)
+    return results
+
+
+async def bench_entry_memory(sizes: list[int]) -> dict:
+    """キューに入った曲1件あたりのメモリ (yt-dlp から届いたエントリの辞書は捨てた後に残る分)"""
+    results = {}
+    for size in sizes:
+        state = new_guild_state()
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        fill_queue(state, size)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results[str(size)] = {'bytes_per_entry': round((after - before) / size, 1), 'total_bytes': after - before}
+        release_guild_state(state)
+    return results
+
+
+async def bench_remove(sizes: list[int], repeat: int) -> dict:
+    """/remove コマンド1回あたりの時間 (応答の送信を除く)。消した曲は同じ位置に戻して、キューの長さを保つ"""
+    results = {}
+    for size in sizes:
+        state = new_guild_state()
+        fill_queue(state, size)
+        ctx = FakeContext(state.guild_id)
+        size_results = {}
+        for label, number in (('first', 1), ('middle', size // 2), ('last', size)):
+            samples = []
+            for _ in range(repeat):
+                entry = state.queue[number - 1]
+                started = time.perf_counter()
+                await bot.remove.callback(ctx, number)
+                samples.append(time.perf_counter() - started)
+                state.queue.insert(number - 1, entry)
+            size_results[label] = percentiles(samples)
+        results[str(size)] = size_results
+        state.clear_prefetch()
+        release_guild_state(state)
+    return results
+
+
+# --- 実行と出力 ---
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=fakes.ROOT, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def flatten(results: dict, prefix: str = '') -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict): flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)): flat[prefix + key] = value
+    return flat
+
+
+def print_comparison(baseline: dict, current: dict):
+    """前回の結果との差を標準エラーに表示する (値が大きいほど悪いとは限らないので、変化率だけを出す)"""
+    old, new = flatten(baseline.get('results', {})), flatten(current['results'])
+    print(f"Comparing with {baseline.get('meta', {}).get('git_commit')} ({baseline.get('meta', {}).get('timestamp')})", file=sys.stderr)
+    for key in sorted(old.keys() & new.keys()):
+        if key.endswith('.n'): continue
+        change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+        print(f"  {key:<70} {old[key]:>12} -> {new[key]:>12}  ({change:+.1f}%)", file=sys.stderr)
+
+
+async def run(args) -> dict:
+    quick = args.quick
+    benchmarks = {
+        'enqueue_playlist': lambda: bench_enqueue_playlist([1000] if quick else [1000, 10000], 2 if quick else 5),
+        'player_cycle': lambda: bench_player_cycle(50 if quick else 200, [0.0, 0.05]),
+        'queue_render': lambda: bench_queue_render([1000, 10000] if quick else [1000, 10000, 100000], 20 if quick else 100),
+        'entry_memory': lambda: bench_entry_memory([10000] if quick else [10000, 100000]),
+        'remove': lambda: bench_remove([1000, 10000] if quick else [1000, 10000, 100000], 50 if quick else 200),
+    }
+    selected = args.only or list(benchmarks)
+    results = {}
+    for name in selected:
+        print(f"Running {name}...", file=sys.stderr)
+        started = time.perf_counter()
+        results[name] = await benchmarks[name]()
+        print(f"  done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick,
+            'prefetch_count': bot.PREFETCH_COUNT,
+            'extract_workers': bot.EXTRACT_WORKERS,
+            'frames_per_track': fakes.FakeAudioSource.frames,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for queue ingestion, player transitions, /queue and /remove.")
+    parser.add_argument('--quick', action='store_true', help="smaller sizes and fewer repeats")
+    parser.add_argument('--only', nargs='+', choices=['enqueue_playlist', 'player_cycle', 'queue_render', 'entry_memory', 'remove'])
+    parser.add_argument('--output', help="write JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help="previous JSON results to compare against")
+    args = parser.parse_args()
+
+    fakes.install()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# bench/startup.py - 起動 (import) にかかる時間を計測する
+#
+# 使い方: python bench/startup.py [--repeat 15] [--top 15] [--output 結果.json] [--compare 前回.json]
+# 計測はすべて別プロセスで行う (このプロセスで import 済みのモジュールに影響されないように)。
+#   import_time   python -c "import bot" などの実行時間 (子プロセスの中で計った値の中央値と最小値。Python 自体の起動と終了処理は含まない)
+#                 ばらつきが大きい環境では --repeat を増やすこと
+#   importtime    python -X importtime -c "import bot" の結果をパッケージごとに集計したもの (ミリ秒)
+#   warm_up       yt-dlp の下準備 (extraction.warm_up) の内訳。lazy extractors あり/なし
+# 結果は JSON で出力する (--output がなければ標準出力)。パッケージごとの内訳は標準エラーにも表示する。
+# bench/baselines/startup.json は yt-dlp を起動時に読み込まなくする前の計測結果 (--compare に渡すと差を表示する)。
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 起動のたびに読む設定。.env の内容に左右されないよう固定する
+ENV = dict(os.environ, DISCORD_BOT_TOKEN="bench", LOG_LEVEL="ERROR", METRICS_PORT="0", TRACE_LOG_PATH="", EXTRACT_BACKEND="thread")
+
+# 実行時間を計測するコード
+SCENARIOS = {
+    'bot': "import bot",
+    'bot_eager': "import bot, extraction; extraction.warm_up()", # EXTRACT_WARMUP=eager でログイン前にかかる時間
+    'extraction': "import extraction",
+    'diagnosis': "import diagnosis",
+}
+
+WARM_UP_CODE = "import json, extraction; print(json.dumps(extraction.warm_up()))"
+# code の実行時間を子プロセスの中で計って最後の行に出力する
+TIMED_CODE = "import time as _time; _started = _time.perf_counter()\n{code}\nprint(_time.perf_counter() - _started)"
+
+
+def run_python(args: list[str], env: dict | None = None) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=ROOT, env=env or ENV, capture_output=True, text=True, timeout=120)
+
+
+def timed_run(code: str, repeat: int) -> list[float]:
+    """code の実行時間 (秒) を repeat 回分返す。毎回新しいプロセスで実行する
+    (終了時の後片付けは起動の速さと関係ないので、プロセス全体の時間ではなく子プロセスの中で計る)"""
+    samples = []
+    for _ in range(repeat):
+        result = run_python(['-c', TIMED_CODE.format(code=code)])
+        if result.returncode != 0:
+            raise RuntimeError(f"'{code}' failed: {result.stderr.strip()[-500:]}")
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+def bench_import_time(repeat: int) -> dict:
+    """各シナリオの実行時間 (ミリ秒)。実行できないシナリオ (古いコミットで計測する場合など) は None"""
+    results = {}
+    for name, code in SCENARIOS.items():
+        try:
+            samples = timed_run(code, repeat)
+        except RuntimeError as e:
+            print(f"  skipped {name}: {e}", file=sys.stderr)
+            results[name] = None
+            continue
+        results[name] = {'median_ms': round(statistics.median(samples) * 1000, 1), 'min_ms': round(min(samples) * 1000, 1)}
+    return results
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int, int]]:
+    """-X importtime の出力を (モジュール名, 深さ, 自身の時間 us, 累積時間 us) の一覧にする"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split('|', 2)
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def bench_importtime(module: str, top: int) -> dict:
+    """import module の時間を、トップレベルのパッケージごとの自身の時間の合計に分ける
+    (累積時間で分けると、他のパッケージから import されたものが重複して数えられるため)"""
+    result = run_python(['-X', 'importtime', '-c', f"import {module}"])
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed: {result.stderr.strip()[-500:]}")
+    rows = parse_importtime(result.stderr)
+    total = sum(self_us for _, _, self_us, _ in rows)
+    packages: dict[str, int] = {}
+    for name, _, self_us, _ in rows:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    ordered = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return {
+        'total_ms': round(total / 1000, 1),
+        'modules': len(rows),
+        'packages': {name: round(us / 1000, 1) for name, us in ordered[:top]},
+        'other_ms': round(sum(us for _, us in ordered[top:]) / 1000, 1),
+        'yt_dlp_imported': 'yt_dlp' in packages,
+    }
+
+
+def bench_warm_up(repeat: int) -> dict:
+    """extraction.warm_up (yt_dlp の import + YoutubeDL の作成) の内訳 (ミリ秒)。lazy extractors あり/なし"""
+    results = {}
+    for label, extra_env in (('lazy_extractors', {}), ('no_lazy_extractors', {'YTDLP_NO_LAZY_EXTRACTORS': '1'})):
+        imports, instances = [], []
+        for _ in range(repeat):
+            result = run_python(['-c', WARM_UP_CODE], env=dict(ENV, **extra_env))
+            if result.returncode != 0:
+                print(f"  skipped warm_up: {result.stderr.strip().splitlines()[-1:]}", file=sys.stderr)
+                return {}
+            timings = json.loads(result.stdout.strip().splitlines()[-1])
+            imports.append(timings['import'])
+            instances.append(timings['instances'])
+        results[label] = {'import_ms': round(statistics.median(imports) * 1000, 1), 'instances_ms': round(statistics.median(instances) * 1000, 1)}
+    return results
+
+
+# --- 実行と出力 ---
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def package_version(name: str) -> str | None:
+    from importlib import metadata
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def flatten(results: dict, prefix: str = '') -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict): flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool): flat[prefix + key] = value
+    return flat
+
+
+def print_comparison(baseline: dict, current: dict):
+    old, new = flatten(baseline.get('results', {})), flatten(current['results'])
+    print(f"Comparing with {baseline.get('meta', {}).get('git_commit')} ({baseline.get('meta', {}).get('timestamp')})", file=sys.stderr)
+    for key in sorted(old.keys() & new.keys()):
+        change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+        print(f"  {key:<50} {old[key]:>10} -> {new[key]:>10}  ({change:+.1f}%)", file=sys.stderr)
+
+
+def print_breakdown(name: str, breakdown: dict):
+    print(f"import {name}: {breakdown['total_ms']} ms in {breakdown['modules']} modules", file=sys.stderr)
+    for package, ms in breakdown['packages'].items():
+        print(f"  {package:<30} {ms:>8.1f} ms  ({ms / breakdown['total_ms'] * 100:4.1f}%)", file=sys.stderr)
+    print(f"  {'(other)':<30} {breakdown['other_ms']:>8.1f} ms", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark: import time breakdown (-X importtime) and yt-dlp warm-up cost.")
+    parser.add_argument('--repeat', type=int, default=15, help="runs per measurement (median is reported)")
+    parser.add_argument('--top', type=int, default=15, help="packages to list in the importtime breakdown")
+    parser.add_argument('--output', help="write JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help="previous JSON results to compare against")
+    args = parser.parse_args()
+
+    ENV["CACHE_DIR"] = tempfile.mkdtemp(prefix="musicbot-startup-")
+    results = {}
+    print("Measuring import time...", file=sys.stderr)
+    results['import_time'] = bench_import_time(args.repeat)
+    print("Collecting -X importtime breakdown...", file=sys.stderr)
+    results['importtime'] = {name: bench_importtime(name, args.top) for name in ('bot', 'extraction')}
+    print("Measuring yt-dlp warm-up...", file=sys.stderr)
+    results['warm_up'] = bench_warm_up(args.repeat)
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'py_cord': package_version('py-cord'),
+            'yt_dlp': package_version('yt-dlp'),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    print_breakdown('bot', results['importtime']['bot'])
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,26 +2,185 @@
 
 import discord
 import asyncio
-import yt_dlp
+import atexit
+import bisect
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import heapq
+import importlib.machinery
 import os
-from collections import deque
+import itertools
+import json
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import urllib.parse
+import weakref
+from aiohttp import web
+from collections import OrderedDict, Counter, deque
 from dotenv import load_dotenv
 import logging
+import logging.handlers
 import time # 再生時間計算用
+import extraction # yt-dlp による曲情報の取得 (ワーカープロセスでも動く部分)
+from extraction import ExtractionError
+
+# .envファイルから環境変数を読み込む（任意）
+load_dotenv()
 
 # --- ロギング設定 ---
-log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+# ログの書式化と書き込みは専用のスレッド (QueueListener) で行い、イベントループや音声スレッドは記録をキューに入れるだけにする
+# メッセージは "%s" 形式の引数で渡すこと (出力されないレベルのログでは文字列を組み立てずに済む)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO") # ルートロガーのレベル
+# ロガーごとのレベル (例: "GuildMusicState=DEBUG,ExtractionScheduler=DEBUG,discord=INFO")
+# 主なロガー: __main__ (コマンド), GuildMusicState, ExtractionScheduler, MetadataCache, AudioFileCache, QueueStore, IdleScheduler, Tracer, extraction, discord, yt_dlp
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower() # "text" または "json" (1行1つの JSON)
+# 同じサーバーの同じメッセージを何件/何秒まで出すか (例: "20/60"。"0" で制限しない)。ERROR 以上は制限しない
+LOG_RATE_LIMIT = os.getenv("LOG_RATE_LIMIT", "20/60")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000")) # 書き込み待ちの上限 (超えた分は捨てて数える)
+GUILD_LOG_PREFIX = "Guild %s:" # サーバーごとのメッセージの書き出し (最初の引数がサーバーID)
+
+
+def parse_log_level(value: str) -> int:
+    """"DEBUG" などのレベル名 (または数値) をレベルに変換する"""
+    value = value.strip().upper()
+    if value.isdigit(): return int(value)
+    level = logging.getLevelName(value)
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level: '{value}'")
+    return level
+
+
+def parse_log_levels(spec: str) -> dict[str, int]:
+    """LOG_LEVELS ("ロガー名=レベル,...") を {ロガー名: レベル} に変換する"""
+    levels = {}
+    for part in spec.split(','):
+        if not part.strip(): continue
+        name, sep, level = part.partition('=')
+        if not sep or not name.strip():
+            raise ValueError(f"Invalid LOG_LEVELS entry: '{part.strip()}' (expected name=LEVEL)")
+        levels[name.strip()] = parse_log_level(level)
+    return levels
+
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """ログの記録をキューに入れるだけのハンドラ (書き込みは QueueListener のスレッドで行う)
+    キューが一杯なら記録を捨てて数える (ログのためにイベントループを待たせない)"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 引数の埋め込みだけはここで行う (引数のオブジェクトが後で変わっても、ログを出した時点の値が残るように)
+        # 時刻の書式化・例外のトレースバック・JSON 化は書き込みスレッドで行う
+        record = copy.copy(record)
+        if record.args and isinstance(record.args, tuple) and isinstance(record.msg, str) and record.msg.startswith(GUILD_LOG_PREFIX):
+            record.guild_id = record.args[0]
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class GuildRateLimitFilter(logging.Filter):
+    """同じサーバーの同じメッセージ ("Guild %s: ..." の書式が同じもの) を window 秒間に burst 件までに抑える
+    抑えた件数は、次の期間に最初に通したメッセージの末尾に付ける。ERROR 以上は抑えない
+    イベントループ・音声スレッド・ワーカースレッドから呼ばれるのでロックを持つ"""
+
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.suppressed = 0 # これまでに抑えた件数 (メトリクス用)
+        self._counters: dict[tuple, list] = {} # (ロガー名, 書式, サーバーID) -> [期間の開始時刻, 通した件数, 抑えた件数]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if (record.levelno >= logging.ERROR or not record.args or not isinstance(record.args, tuple)
+                or not isinstance(record.msg, str) or not record.msg.startswith(GUILD_LOG_PREFIX)):
+            return True
+        key = (record.name, record.msg, record.args[0])
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None or record.created - counter[0] >= self.window:
+                suppressed = counter[2] if counter else 0
+                if counter is None and len(self._counters) >= 10000: self._prune(record.created)
+                self._counters[key] = [record.created, 1, 0]
+            elif counter[1] < self.burst:
+                counter[1] += 1
+                suppressed = 0
+            else:
+                counter[2] += 1
+                self.suppressed += 1
+                return False
+        if suppressed:
+            record.msg += " (%d similar messages suppressed)"
+            record.args += (suppressed,)
+        return True
+
+    def _prune(self, now: float):
+        """期間の終わったカウンタを捨てる (サーバー数が多くても辞書が際限なく増えないように)"""
+        for key in [key for key, counter in self._counters.items() if now - counter[0] >= self.window]:
+            del self._counters[key]
+
+
+class JsonLogFormatter(logging.Formatter):
+    """1行1つの JSON でログを出すフォーマッタ (LOG_FORMAT=json)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        guild_id = getattr(record, 'guild_id', None)
+        if guild_id is not None: entry['guild_id'] = guild_id
+        if record.exc_info: entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info: entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
 console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_formatter)
-# ルートロガーのレベルを DEBUG に設定して詳細なログを見る
-logging.basicConfig(level=logging.DEBUG, handlers=[console_handler])
+if LOG_FORMAT == 'json':
+    console_handler.setFormatter(JsonLogFormatter())
+else:
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+log_handler = BackgroundLogHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_listener = logging.handlers.QueueListener(log_handler.queue, console_handler)
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
+log_listener.start()
+atexit.register(log_listener.stop) # 終了時にキューに残ったログを書き出す
 logger = logging.getLogger(__name__)
-# ライブラリのログレベルは WARNING のまま（必要なら INFO に変更）
+# ライブラリのログレベルは WARNING のまま（必要なら LOG_LEVELS で変更）
 logging.getLogger('discord').setLevel(logging.WARNING)
 logging.getLogger('yt_dlp').setLevel(logging.WARNING)
-
-# .envファイルから環境変数を読み込む（任意）
-load_dotenv()
+log_rate_limit: GuildRateLimitFilter | None = None
+try:
+    logging.getLogger().setLevel(parse_log_level(LOG_LEVEL))
+    for name, level in parse_log_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+    if LOG_RATE_LIMIT.strip() not in ('', '0'):
+        burst, _, window = LOG_RATE_LIMIT.partition('/')
+        log_rate_limit = GuildRateLimitFilter(int(burst), float(window or 60))
+        log_handler.addFilter(log_rate_limit)
+except ValueError as e:
+    logger.critical("エラー: ログの設定が正しくありません: %s", e)
+    exit()
+if LOG_FORMAT not in ('text', 'json'):
+    logger.warning("Unknown LOG_FORMAT '%s'. Using text.", LOG_FORMAT)
 
 # Discord Bot Tokenを環境変数から取得
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
@@ -29,21 +188,21 @@ if not DISCORD_BOT_TOKEN:
     logger.critical("エラー: 環境変数 'DISCORD_BOT_TOKEN' が設定されていません。")
     exit()
 
-# yt-dlp の設定 (メタデータ取得用)
-ydl_opts_meta = {
-    'format': 'bestaudio/best',
-    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': False,
-    'nocheckcertificate': True,
-    'ignoreerrors': True, # プレイリスト内のエラーエントリをスキップ
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'auto',
-    'source_address': '0.0.0.0',
-    'extract_flat': 'in_playlist', # プレイリスト取得を高速化
-}
+# シャーディングの設定 (launcher.py で複数プロセスに分けて起動する場合など)
+# SHARD_COUNT: 全体のシャード数 ("auto" で Discord の推奨値。未設定ならシャーディングしない)
+# SHARD_IDS: このプロセスが担当するシャードID (例: "0,1,2" / "0-3")。未設定なら全シャード
+SHARD_COUNT = os.getenv("SHARD_COUNT", "").strip().lower()
+SHARD_IDS = os.getenv("SHARD_IDS", "").strip()
+
+
+def parse_shard_ids(spec: str) -> list[int] | None:
+    """"0,2,4" や "0-3" 形式のシャードID指定をリストにする (空なら None)"""
+    if not spec: return None
+    ids = []
+    for part in spec.split(','):
+        start, _, end = part.strip().partition('-')
+        ids.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(ids))
 
 # 再生時に使うffmpegオプション (安定性向上)
 ffmpeg_options = {
@@ -51,26 +210,1239 @@ ffmpeg_options = {
     'options': '-vn' # 音声のみを抽出
 }
 
-# yt-dlp インスタンス (メタデータ取得用)
-ytdl_meta = yt_dlp.YoutubeDL(ydl_opts_meta)
+# 再生方式
+# auto: 元の音声が Opus ならデコードせずにそのまま送る (ffmpeg は -c:a copy で詰め替えるだけ) / pcm: 常にPCMにデコードして再エンコード
+PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "auto").lower()
+
+# 先読みする曲数 (再生中に次の曲のストリームURL取得とffmpeg起動を済ませておく)
+# 1曲につきffmpegプロセスを1つ保持するので、増やしすぎに注意。0 で無効
+PREFETCH_COUNT = max(0, int(os.getenv("PREFETCH_COUNT", "1")))
+
+# yt-dlp 処理専用スケジューラの設定
+EXTRACT_WORKERS = max(1, int(os.getenv("EXTRACT_WORKERS", "4"))) # yt-dlp を同時に動かすワーカー数
+# thread: スレッドで実行 / process: ワーカープロセスで実行 (GILの影響を受けず、抽出中もイベントループが詰まらない)
+EXTRACT_BACKEND = os.getenv("EXTRACT_BACKEND", "thread").lower()
+EXTRACT_GUILD_CONCURRENCY = max(1, int(os.getenv("EXTRACT_GUILD_CONCURRENCY", "2"))) # 1サーバーあたりの同時実行数
+# 曲情報の取得方法 ytdlp: yt-dlp (通常) / record:<フォルダ>: yt-dlp の結果を記録 / replay:<フォルダ>: 記録した結果を返す (オフラインでの負荷試験用)
+EXTRACT_RESOLVER = os.getenv("EXTRACT_RESOLVER", "ytdlp")
+# yt-dlp の読み込み (import と YoutubeDL の作成) をいつ行うか
+# background: ログイン後にワーカーで (既定) / lazy: 最初に使う時 / eager: ログイン前 (起動は遅くなるが、最初の /play から速い)
+EXTRACT_WARMUP = os.getenv("EXTRACT_WARMUP", "background").strip().lower()
+
+# ジョブの優先度 (小さいほど優先)
+PRIORITY_PLAYER = 0 # 次に再生する曲の解決
+PRIORITY_INTERACTIVE = 1 # /play への応答に必要な取得
+PRIORITY_PREFETCH = 2 # 先読み
+PRIORITY_BULK = 3 # プレイリストの展開などの大量処理
+
+
+# ストリームURLキャッシュの設定
+# (有効期限の見積もりは extraction.STREAM_CACHE_MARGIN / STREAM_CACHE_DEFAULT_TTL)
+STREAM_CACHE_SIZE = int(os.getenv("STREAM_CACHE_SIZE", "512")) # 最大件数 (超えたら最も古く使われたものから破棄)
+
+class StreamCache:
+    """解決済みストリーム情報のプロセス共通キャッシュ (webpage_url -> extraction.select_stream_info の結果)
+    イベントループ上からのみ使う前提なのでロックは持たない"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url: str) -> dict | None:
+        info = self._entries.get(url)
+        if info is not None and info['expires_at'] <= time.time():
+            # 期限切れ
+            del self._entries[url]
+            info = None
+        if info is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(url)
+        self.hits += 1
+        return info
+
+    def put(self, info: dict, *urls: str):
+        """情報を info['webpage_url'] と追加のURL (リクエスト時のURLなど) の両方で登録する"""
+        if self.max_size <= 0 or info['expires_at'] <= time.time():
+            return
+        for key in {info['webpage_url'], *urls}:
+            if not key: continue
+            self._entries[key] = info
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+
+stream_cache = StreamCache(STREAM_CACHE_SIZE)
+
+
+# --- yt-dlp 処理のスケジューラ ---
+class ExtractionScheduler:
+    """yt-dlp の処理を専用のワーカー (スレッド or プロセス) で実行するスケジューラ
+    優先度の高いジョブから、サーバーごとの同時実行数の上限を守りつつワーカーに割り当てる
+    (先読み/大量処理はワーカーを1つ残して使うので、再生に必要な処理が待たされ続けることはない)
+    イベントループ上からのみ使う前提なのでロックは持たない"""
+    _logger = logging.getLogger(__qualname__)
+
+    def __init__(self, workers: int, per_guild: int, backend: str = 'thread'):
+        self.workers = workers
+        self.per_guild = per_guild
+        self.backend = backend
+        self._executor: concurrent.futures.Executor | None = None
+        self._pending: list[list] = [] # [priority, seq, guild_id, func, args, future, enqueued_at, key] のヒープ
+        self._seq = itertools.count()
+        self._running = 0
+        self._running_background = 0 # 実行中の先読み/大量処理の数
+        self._running_per_guild: dict[int, int] = {}
+        # 統計
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, func, *args, guild_id: int | None = None, priority: int = PRIORITY_INTERACTIVE, key: str | None = None):
+        """func(*args) をワーカーで実行し、結果を返す
+        (process バックエンドでは func と args を pickle するので、func はモジュールレベルの関数にすること)
+        key は promote_key で優先度を引き上げるときの識別子"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._pending, [priority, next(self._seq), guild_id, func, args, future, time.monotonic(), key])
+        self._dispatch()
+        return await future # 呼び出し元がキャンセルされると future もキャンセルされ、未実行なら破棄される
+
+    def promote(self, guild_id: int, from_priority: int, to_priority: int):
+        """待機中のジョブの優先度を引き上げる (先読み中の曲が再生の番になった場合など)"""
+        changed = False
+        for job in self._pending:
+            if job[2] == guild_id and job[0] == from_priority:
+                job[0] = to_priority
+                changed = True
+        if changed:
+            heapq.heapify(self._pending)
+            self._dispatch()
+
+    def promote_key(self, key: str, to_priority: int):
+        """待機中の key のジョブの優先度を to_priority まで引き上げる (より急ぎの呼び出し元が合流した場合)"""
+        changed = False
+        for job in self._pending:
+            if job[7] == key and job[0] > to_priority:
+                job[0] = to_priority
+                changed = True
+        if changed:
+            heapq.heapify(self._pending)
+            self._dispatch()
+
+    def _dispatch(self):
+        skipped = []
+        try:
+            self._dispatch_jobs(skipped)
+        finally:
+            for job in skipped:
+                heapq.heappush(self._pending, job)
+
+    def _dispatch_jobs(self, skipped: list):
+        while self._pending and self._running < self.workers:
+            job = heapq.heappop(self._pending)
+            priority, _, guild_id, func, args, future, enqueued_at, _ = job
+            if future.done(): # 待機中にキャンセルされた
+                continue
+            background = priority >= PRIORITY_PREFETCH
+            if (background and self.workers > 1 and self._running_background >= self.workers - 1) or \
+               (guild_id is not None and priority != PRIORITY_PLAYER and self._running_per_guild.get(guild_id, 0) >= self.per_guild):
+                skipped.append(job)
+                continue
+            wait = time.monotonic() - enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._running += 1
+            if background: self._running_background += 1
+            if guild_id is not None: self._running_per_guild[guild_id] = self._running_per_guild.get(guild_id, 0) + 1
+            loop = asyncio.get_running_loop()
+            try:
+                try:
+                    cf = self._get_executor().submit(func, *args)
+                except concurrent.futures.BrokenExecutor: # ワーカープロセスが異常終了していた場合は作り直す
+                    self._logger.warning("Extraction executor is broken. Recreating.")
+                    self._executor = None
+                    cf = self._get_executor().submit(func, *args)
+            except BaseException as e:
+                # 投入できなかったジョブの分を戻す (戻さないとワーカーの枠が永久に1つ減る)
+                self._release(priority, guild_id)
+                if not future.done(): future.set_exception(e)
+                raise
+            cf.add_done_callback(lambda f, job=job, loop=loop: self._notify_done(loop, job, f))
+
+    def _notify_done(self, loop: asyncio.AbstractEventLoop, job: list, cf: concurrent.futures.Future):
+        """ワーカー側から呼ばれる完了コールバック (処理はイベントループに戻して行う)"""
+        try:
+            loop.call_soon_threadsafe(self._on_done, job, cf)
+        except RuntimeError: # シャットダウン中でループが既に閉じている
+            pass
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self.backend == 'process':
+                self._executor = extraction.create_process_pool(self.workers, EXTRACT_RESOLVER)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='extract')
+            self._logger.info("Started %s extraction executor with %s workers.", self.backend, self.workers)
+        return self._executor
+
+    def _release(self, priority: int, guild_id: int | None):
+        """_dispatch で数えた実行中のジョブを1つ減らす"""
+        self._running -= 1
+        if priority >= PRIORITY_PREFETCH: self._running_background -= 1
+        if guild_id is not None:
+            remaining = self._running_per_guild.get(guild_id, 1) - 1
+            if remaining: self._running_per_guild[guild_id] = remaining
+            else: self._running_per_guild.pop(guild_id, None)
+
+    def _on_done(self, job: list, cf: concurrent.futures.Future):
+        priority, _, guild_id, _, _, future, _, _ = job
+        self._release(priority, guild_id)
+        self.completed += 1
+        exc = cf.exception()
+        if isinstance(exc, concurrent.futures.BrokenExecutor) and self._executor is not None:
+            self._logger.error("Extraction worker died: %s. Executor will be recreated.", exc)
+            self._executor = None
+        if not future.done():
+            if exc is not None: future.set_exception(exc)
+            else: future.set_result(cf.result())
+        self._dispatch()
+
+    def stats(self) -> dict:
+        """キューの深さと待ち時間 (ワーカー数の調整用)"""
+        return {
+            'workers': self.workers,
+            'running': self._running,
+            'pending': sum(1 for job in self._pending if not job[5].done()),
+            'completed': self.completed,
+            'avg_wait': self.total_wait / self.completed if self.completed else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+extraction_scheduler = ExtractionScheduler(EXTRACT_WORKERS, EXTRACT_GUILD_CONCURRENCY, EXTRACT_BACKEND)
+# スレッド実行なら同時に動くスレッド数だけ YoutubeDL インスタンスを用意する (プロセス実行ではワーカー側で用意)
+extraction.configure_pools(EXTRACT_WORKERS)
+# 曲情報の取得方法 (プロセス実行ではワーカー側でも init_worker で同じものを設定する)
+try:
+    extraction.configure_resolver(EXTRACT_RESOLVER)
+except ValueError as e:
+    logger.critical("エラー: %s", e)
+    exit()
+if EXTRACT_WARMUP not in ('background', 'lazy', 'eager'):
+    logger.warning("Unknown EXTRACT_WARMUP '%s'. Using background.", EXTRACT_WARMUP)
+    EXTRACT_WARMUP = 'background'
+extraction_warm_up_task: asyncio.Task | None = None
+
+
+def log_warm_up_result(result: dict, elapsed: float):
+    if not result: return # replay など、下準備のいらない取得方法
+    logger.info("yt-dlp warmed up in %.2fs (import %.2fs, instances %.2fs, lazy extractors: %s).",
+                elapsed, result['import'], result['instances'], result['lazy_extractors'])
+    if result['lazy_extractors'] is False:
+        logger.warning("yt-dlp lazy extractors are disabled (YTDLP_NO_LAZY_EXTRACTORS is set). Creating YoutubeDL instances is much slower.")
+
+
+async def warm_up_extraction():
+    """yt-dlp の import と YoutubeDL の作成をワーカーで済ませておく (ログイン後に一度だけ)
+    プロセス実行では下準備がワーカーごとに必要なので、ワーカー数だけ投げる (どのワーカーに割り当たるかは保証されない)"""
+    started = time.monotonic()
+    jobs = EXTRACT_WORKERS if EXTRACT_BACKEND == 'process' else 1
+    try:
+        results = await asyncio.gather(*(extraction_scheduler.run(extraction.warm_up, priority=PRIORITY_BULK) for _ in range(jobs)))
+    except Exception as e:
+        logger.warning("yt-dlp warm-up failed: %s", e)
+        return
+    log_warm_up_result(results[0], time.monotonic() - started)
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら、新しく始めずにその結果を待つ (同時リクエストの合流)
+    待っている呼び出し元がすべてキャンセルされたら、処理自体もキャンセルする"""
+
+    def __init__(self):
+        self._inflight: dict[str, list] = {} # key -> [共有タスク, 待機中の呼び出し元の数]
+        self.started = 0
+        self.coalesced = 0
+
+    def is_inflight(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def run(self, key: str, coro_factory):
+        """key の処理が実行中ならその結果を、なければ coro_factory() を実行してその結果を返す"""
+        flight = self._inflight.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(coro_factory())
+            flight = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda t, key=key: self._forget(key, t))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                task.cancel()
+
+    def _forget(self, key: str, task: asyncio.Task):
+        flight = self._inflight.get(key)
+        if flight is not None and flight[0] is task:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {'inflight': len(self._inflight), 'started': self.started, 'coalesced': self.coalesced}
+
+
+extraction_flights = SingleFlight()
+
+
+async def run_extraction(mode: str, url_or_search: str, *, guild_id: int | None, priority: int) -> dict | None:
+    """extraction.extract_flat (mode='flat') / extract_full (mode='full') をスケジューラ経由で実行する
+    同じ入力・同じモードの取得が実行中なら合流し、yt-dlp を二重に動かさない"""
+    func = extraction.extract_flat if mode == 'flat' else extraction.extract_full
+    key = f"{mode}|{metadata_cache_key(url_or_search)}"
+    if extraction_flights.is_inflight(key):
+        # 後から来た呼び出し元の方が急ぎなら、待機中のジョブの優先度を上げる
+        extraction_scheduler.promote_key(key, priority)
+    return await extraction_flights.run(key, lambda: extraction_scheduler.run(func, url_or_search, guild_id=guild_id, priority=priority, key=key))
+
+
+# プレイリスト取り込み中の進捗メッセージを更新する間隔 (秒)
+PLAYLIST_PROGRESS_INTERVAL = 3.0
+# /queue の1ページの曲数と、ページ送りボタンが有効な時間 (秒)
+QUEUE_PAGE_SIZE = 10
+QUEUE_VIEW_TIMEOUT = 180
+# PlaylistStream が溜めておくイベントの数。いっぱいになるとワーカーは取り込みが追いつくまで待つ
+PLAYLIST_STREAM_BUFFER = 4
+# これより曲数の多いプレイリストはメタデータキャッシュに保存しない (保存用の一覧を取り込み中に持ち続けないように)
+META_CACHE_PLAYLIST_MAX = int(os.getenv("META_CACHE_PLAYLIST_MAX", "5000"))
+
+
+class PlaylistStream:
+    """extraction.stream_flat をスケジューラで実行し、ワーカーから届くプレイリストのエントリを順に受け取る
+    emit を関数として渡すので、スレッドのバックエンド専用。使い終わったら (途中でも) close() を呼ぶこと"""
+
+    def __init__(self, url_or_search: str, *, guild_id: int | None, priority: int):
+        self._loop = asyncio.get_running_loop()
+        self._events: asyncio.Queue = asyncio.Queue(maxsize=PLAYLIST_STREAM_BUFFER)
+        self._stop = threading.Event()
+        self._final_put: asyncio.Task | None = None
+        job = asyncio.ensure_future(extraction_scheduler.run(extraction.stream_flat, url_or_search, self._emit, guild_id=guild_id, priority=priority))
+        job.add_done_callback(self._on_done)
+
+    def _emit(self, event: str, payload) -> bool:
+        """ワーカースレッドから呼ばれる。キューに空きができるまで待つ。False を返すと取得が打ち切られる"""
+        if self._stop.is_set():
+            return False
+        put = asyncio.run_coroutine_threadsafe(self._events.put((event, payload)), self._loop)
+        while True:
+            try:
+                put.result(timeout=0.5)
+                return True
+            except concurrent.futures.TimeoutError:
+                if self._stop.is_set(): # close() された (もう誰も受け取らない)
+                    put.cancel()
+                    return False
+
+    def _on_done(self, job: asyncio.Future):
+        # ワーカーの emit はすべてキューに入ってから戻るので、'done' は必ず最後に届く
+        if job.cancelled(): event = ('error', asyncio.CancelledError())
+        elif job.exception() is not None: event = ('error', job.exception())
+        else: event = ('done', job.result())
+        if self._stop.is_set(): return
+        try:
+            self._events.put_nowait(event)
+        except asyncio.QueueFull: # 受け取る側が取り出したら入れる
+            self._final_put = asyncio.ensure_future(self._events.put(event))
+
+    async def next_event(self) -> tuple[str, object]:
+        """('playlist', ヘッダー) / ('entries', [...]) / ('done', stream_flat の戻り値) のどれかを返す"""
+        event, payload = await self._events.get()
+        if event == 'error':
+            raise payload
+        return event, payload
+
+    async def batches(self):
+        """エントリのリストを届いた順に返す (取得が終わるまで)"""
+        while True:
+            event, payload = await self.next_event()
+            if event == 'done': return
+            if event == 'entries': yield payload
+
+    def close(self):
+        self._stop.set()
+        if self._final_put is not None: self._final_put.cancel()
+
+
+async def iter_batches(entries: list, size: int = extraction.PLAYLIST_BATCH_SIZE):
+    """取得済みのエントリ一覧を PlaylistStream.batches と同じ形で返す (キャッシュ/プロセスのバックエンド用)"""
+    for i in range(0, len(entries), size):
+        yield entries[i:i + size]
+
+
+# メタデータキャッシュ (SQLite) の設定
+CACHE_DIR = os.getenv("CACHE_DIR", "cache") # キャッシュファイルの保存先
+META_CACHE_MAX_ROWS = int(os.getenv("META_CACHE_MAX_ROWS", "20000")) # 最大件数 (0 で無効)
+META_CACHE_TTL_SEARCH = int(os.getenv("META_CACHE_TTL_SEARCH", str(24 * 3600))) # 検索ワードの保持秒数
+META_CACHE_TTL_VIDEO = int(os.getenv("META_CACHE_TTL_VIDEO", str(7 * 24 * 3600))) # 単一動画の保持秒数
+META_CACHE_TTL_PLAYLIST = int(os.getenv("META_CACHE_TTL_PLAYLIST", str(6 * 3600))) # プレイリストの保持秒数
+
+_YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtu.be')
+
+
+def metadata_cache_key(url_or_search: str) -> str:
+    """/play の入力をキャッシュキーに正規化する
+    YouTube の URL は動画ID (v:) / プレイリストID (pl:)、それ以外のURLは url:、検索ワードは q: になる"""
+    query = url_or_search.strip()
+    if '://' not in query:
+        return 'q:' + ' '.join(query.lower().split())
+    parsed = urllib.parse.urlsplit(query)
+    if (parsed.hostname or '').lower() in _YOUTUBE_HOSTS:
+        params = urllib.parse.parse_qs(parsed.query)
+        if params.get('list'): return 'pl:' + params['list'][0]
+        if params.get('v'): return 'v:' + params['v'][0]
+        path = parsed.path.strip('/')
+        if parsed.hostname.lower() == 'youtu.be' and path: return 'v:' + path
+        if path.startswith('shorts/'): return 'v:' + path.split('/', 1)[1]
+    return 'url:' + query
+
+
+def trim_video_info(data: dict) -> dict:
+    """単一動画の情報からキャッシュに保存する項目だけを取り出す (有効期限のあるストリーム情報は含めない)"""
+    return {
+        '_type': 'video',
+        'id': data.get('id'),
+        'title': data.get('title'),
+        'duration': data.get('duration'),
+        'extractor_key': data.get('extractor_key') or data.get('ie_key'),
+        'webpage_url': data.get('webpage_url') or data.get('original_url') or data.get('url'),
+    }
+
+
+class MetadataCache:
+    """/play の検索ワード・動画ID・プレイリストID -> フラットな曲情報 の永続キャッシュ (SQLite)
+    メソッドはすべてブロッキングなので executor から呼ぶこと"""
+    _logger = logging.getLogger(__qualname__)
+
+    def __init__(self, path: str, max_rows: int):
+        self.path = path
+        self.max_rows = max_rows
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock() # 接続は executor の複数スレッドから共有する
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> dict | None:
+        if self.max_rows <= 0: return None
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute('SELECT data, expires_at FROM metadata WHERE key = ?', (key,)).fetchone()
+                if row is not None and row[1] <= now:
+                    conn.execute('DELETE FROM metadata WHERE key = ?', (key,))
+                    row = None
+                elif row is not None:
+                    conn.execute('UPDATE metadata SET last_used = ? WHERE key = ?', (now, key))
+                conn.commit()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            self._logger.warning("Metadata cache read failed for '%s': %s", key, e)
+            return None
+
+    def put(self, keys: list[str], data: dict):
+        """data を複数のキーで登録する。件数上限を超えたら最も古く使われたものから削除"""
+        if self.max_rows <= 0: return
+        now = time.time()
+        payload = json.dumps(data, ensure_ascii=False)
+        try:
+            with self._lock:
+                conn = self._connect()
+                for key in dict.fromkeys(keys):
+                    if key.startswith('q:'): ttl = META_CACHE_TTL_SEARCH
+                    elif data.get('_type') == 'playlist': ttl = META_CACHE_TTL_PLAYLIST
+                    else: ttl = META_CACHE_TTL_VIDEO
+                    conn.execute('INSERT OR REPLACE INTO metadata (key, data, expires_at, last_used) VALUES (?, ?, ?, ?)', (key, payload, now + ttl, now))
+                overflow = conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] - self.max_rows
+                if overflow > 0:
+                    conn.execute('DELETE FROM metadata WHERE key IN (SELECT key FROM metadata ORDER BY last_used LIMIT ?)', (overflow,))
+                conn.commit()
+        except sqlite3.Error as e:
+            self._logger.warning("Metadata cache write failed for %s: %s", keys, e)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+
+metadata_cache = MetadataCache(os.path.join(CACHE_DIR, 'metadata.sqlite3'), META_CACHE_MAX_ROWS)
+
+
+# ローカル音声キャッシュの設定 (よく再生される曲をダウンロードしておき、ファイルから再生する)
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join(CACHE_DIR, 'audio'))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_MB", "0")) * 1024 * 1024 # 容量の上限 (0 で無効)
+AUDIO_CACHE_MIN_PLAYS = max(1, int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))) # 何回再生されたらダウンロードするか
+
+
+def audio_cache_key(webpage_url: str) -> str:
+    """曲のURLからキャッシュファイル名 (拡張子なし) を作る。YouTube は動画ID、それ以外はURLのハッシュ"""
+    key = metadata_cache_key(webpage_url)
+    if key.startswith('v:'):
+        return 'yt-' + re.sub(r'[^A-Za-z0-9_-]', '_', key[2:])
+    return 'url-' + hashlib.sha1(webpage_url.encode('utf-8')).hexdigest()
+
+
+class AudioFileCache:
+    """よく再生される曲の音声ファイルを保存しておくキャッシュ
+    AUDIO_CACHE_MIN_PLAYS 回以上再生された曲をバックグラウンドでダウンロードし、容量を超えたら最も長く使われていないものから削除する (LRU)
+    再生回数はプロセス内でだけ数える。イベントループ上からのみ使う前提 (ファイル操作は executor で行う)"""
+    _logger = logging.getLogger(__qualname__)
+
+    def __init__(self, directory: str, max_bytes: int, min_plays: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self._files: OrderedDict[str, dict] = OrderedDict() # key -> download_audio の結果 (古く使われた順)
+        self._play_counts: Counter = Counter()
+        self._downloading: set[str] = set()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        # 記録の再生 (EXTRACT_RESOLVER=replay:) などダウンロードできない取得方法では使わない
+        return self.max_bytes > 0 and extraction.resolver.downloads_audio
+
+    async def load(self):
+        """保存済みのファイルを読み込む (起動時に一度だけ呼ぶ)"""
+        if not self.enabled: return
+        found = await asyncio.get_running_loop().run_in_executor(None, self._scan)
+        self._files = OrderedDict((key, info) for _, key, info in found)
+        self.total_bytes = sum(info['size'] for info in self._files.values())
+        self._logger.info("Loaded %s cached audio files (%.1f MB).", len(self._files), self.total_bytes / 1024 / 1024)
+
+    def _scan(self) -> list:
+        """情報ファイルを走査して (更新日時, key, 情報) を古い順に返す (ブロッキング)"""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'): continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    info = json.load(f)
+                path = os.path.join(self.directory, info['file'])
+                found.append((os.path.getmtime(path), name[:-len('.json')], info))
+            except (OSError, ValueError, KeyError) as e:
+                self._logger.warning("Skipping broken audio cache entry %s: %s", name, e)
+        found.sort(key=lambda x: x[0])
+        return found
+
+    async def lookup(self, webpage_url: str) -> dict | None:
+        """キャッシュ済みなら、ファイル再生用のストリーム情報 (select_stream_info と同じ形) を返す"""
+        if not self.enabled: return None
+        key = audio_cache_key(webpage_url)
+        info = self._files.get(key)
+        if info is not None:
+            path = os.path.join(self.directory, info['file'])
+            # ファイルが残っているかの確認は、使われた日時の更新と一緒に executor で行う (イベントループで stat しない)
+            if not await asyncio.get_running_loop().run_in_executor(None, self._touch, path):
+                if self._files.get(key) is info: self._forget(key)
+                info = None
+        if info is None:
+            self.misses += 1
+            return None
+        if key in self._files: self._files.move_to_end(key)
+        self.hits += 1
+        return {
+            'stream_url': path,
+            'title': info['title'],
+            'webpage_url': info.get('webpage_url') or webpage_url,
+            'duration': info['duration'],
+            'acodec': info['acodec'],
+            'expires_at': float('inf'),
+            'local': True, # ローカルファイル (ffmpeg の再接続オプションは使わない)
+        }
+
+    def record_play(self, webpage_url: str):
+        """再生回数を数え、AUDIO_CACHE_MIN_PLAYS 回に達したらダウンロードを始める"""
+        if not self.enabled: return
+        key = audio_cache_key(webpage_url)
+        self._play_counts[key] += 1
+        if self._play_counts[key] >= self.min_plays and key not in self._files and key not in self._downloading:
+            self._downloading.add(key)
+            asyncio.get_running_loop().create_task(self._download(key, webpage_url))
+
+    async def _download(self, key: str, webpage_url: str):
+        try:
+            self._logger.info("Downloading '%s' into audio cache as %s.", webpage_url, key)
+            os.makedirs(self.directory, exist_ok=True)
+            info = await extraction_scheduler.run(extraction.download_audio, webpage_url, self.directory, key, priority=PRIORITY_BULK)
+            if not info:
+                self._logger.warning("Audio cache download for '%s' produced no file.", webpage_url)
+                return
+            if key in self._files: self._forget(key)
+            self._files[key] = info
+            self.total_bytes += info['size']
+            self._logger.info("Cached '%s' (%.1f MB). Cache: %.1f MB / %s files.", info['title'], info['size'] / 1024 / 1024, self.total_bytes / 1024 / 1024, len(self._files))
+            while self.total_bytes > self.max_bytes and len(self._files) > 1:
+                old_key = next(iter(self._files))
+                self._logger.info("Evicting %s from audio cache.", old_key)
+                self._forget(old_key, delete=True)
+        except ExtractionError as e:
+            self._logger.warning("Audio cache download failed for '%s': %s", webpage_url, e)
+        except Exception as e:
+            self._logger.exception("Unexpected error during audio cache download for '%s': %s", webpage_url, e)
+        finally:
+            self._downloading.discard(key)
+
+    def _forget(self, key: str, delete: bool = False):
+        info = self._files.pop(key)
+        self.total_bytes -= info['size']
+        if delete:
+            paths = [os.path.join(self.directory, info['file']), os.path.join(self.directory, f'{key}.json')]
+            asyncio.get_running_loop().run_in_executor(None, self._remove_files, paths)
+
+    @staticmethod
+    def _touch(path: str) -> bool:
+        """使われた日時を更新する (再起動後も使われた順を保つ)。ファイルがなければ False"""
+        try: os.utime(path)
+        except FileNotFoundError: return False
+        except OSError: pass
+        return True
+
+    def _remove_files(self, paths: list[str]):
+        for path in paths:
+            try: os.remove(path)
+            except FileNotFoundError: pass
+            except OSError as e: self._logger.warning("Failed to remove cached file %s: %s", path, e) # 再生中 (Windows) など
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'files': len(self._files), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes, 'downloading': len(self._downloading),
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+
+audio_cache = AudioFileCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_MIN_PLAYS)
+
+
+# --- メトリクス ---
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # Prometheus 形式のメトリクスを公開するポート (0 で無効)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1") # 公開するアドレス (外部から見せる場合は 0.0.0.0)
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+GAP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra: pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """ラベルの値の組ごとにバケットの件数と合計を持つヒストグラム
+    無効時 (enabled=False) は observe が何もしない"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, labelnames: tuple = (), enabled: bool = True):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self.enabled = enabled
+        self._series: dict[tuple, list] = {} # ラベルの値 -> [バケットごとの件数 (最後は +Inf), 合計]
+
+    def observe(self, value: float, *labels: str):
+        if not self.enabled: return
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = []
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CounterMetric:
+    """ラベルの値の組ごとの累積カウンタ"""
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), enabled: bool = True):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.enabled = enabled
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        if not self.enabled: return
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in self._values.items()]
+
+
+class GaugeCallback:
+    """スクレイプ時に callback() を呼んで値を得るゲージ (普段の処理には一切コストがかからない)
+    callback は数値、または {ラベルの値の組: 数値} を返す"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, callback, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.labelnames = labelnames
+
+    def render(self) -> list[str]:
+        value = self.callback()
+        if not isinstance(value, dict): value = {(): value}
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {v}" for labels, v in value.items()]
+
+
+class MetricsRegistry:
+    """メトリクスをまとめて Prometheus のテキスト形式 (/metrics) に書き出す"""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._metrics: list = []
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS, labelnames: tuple = ()) -> Histogram:
+        metric = Histogram(name, help_text, buckets, labelnames, self.enabled)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> CounterMetric:
+        metric = CounterMetric(name, help_text, labelnames, self.enabled)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, callback, labelnames: tuple = ()):
+        self._metrics.append(GaugeCallback(name, help_text, callback, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                body = metric.render()
+            except Exception as e: # 1つの値の取得に失敗しても他は出す
+                logger.warning("Failed to collect metric %s: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(body)
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(METRICS_PORT > 0)
+extraction_seconds = metrics.histogram('musicbot_extraction_seconds', 'yt-dlp extraction latency (path=metadata: /play lookup, path=stream: stream URL resolve)', labelnames=('path',))
+first_audio_seconds = metrics.histogram('musicbot_time_to_first_audio_seconds', 'Time from /play on an idle player to the first audio frame')
+inter_track_gap_seconds = metrics.histogram('musicbot_inter_track_gap_seconds', 'Silence between the end of a track and the first audio frame of the next', GAP_BUCKETS)
+notify_failures = metrics.counter('musicbot_notify_failures_total', 'notify_channel failures by reason', ('reason',))
+_ffmpeg_sources: weakref.WeakSet = weakref.WeakSet() # メトリクス有効時に作成した FFmpeg の音声ソース (プロセス数の集計用)
+
+
+# --- トレース (/play から最初の音声まで) ---
+TRACE_HISTORY = int(os.getenv("TRACE_HISTORY", "100")) # /traces 用にメモリに残すトレースの件数 (0 で記録しない)
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "") # 終わったトレースを JSON Lines で追記するファイル (空なら書き出さない)
+
+
+class Trace:
+    """1回の /play の処理を区間 (span) ごとに計測した記録
+    時刻は time.monotonic() で持ち、書き出す時にトレース開始からのミリ秒にする"""
+    __slots__ = ('trace_id', 'guild_id', 'query', 'started_at', 'started', 'spans', 'status', 'duration')
+
+    def __init__(self, guild_id: int | None, query: str):
+        self.trace_id = os.urandom(4).hex()
+        self.guild_id = guild_id
+        self.query = query
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.spans: list[tuple[str, float, float, dict]] = [] # (名前, 開始, 終了, 属性)
+        self.status: str | None = None # 終わったら結果 ('playing', 'queued', 'failed' など)
+        self.duration = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self.status is None
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        """with ブロックの処理時間を name の区間として記録する (as で受け取った dict に属性を追加できる)"""
+        start = time.monotonic()
+        try:
+            yield attrs
+        finally:
+            self.spans.append((name, start, time.monotonic(), attrs))
+
+    def add_span(self, name: str, start: float, end: float, **attrs):
+        self.spans.append((name, start, end, attrs))
+
+    def span_totals(self) -> dict[str, float]:
+        """区間名ごとの合計秒数 (記録された順)"""
+        totals: dict[str, float] = {}
+        for name, start, end, _ in self.spans:
+            totals[name] = totals.get(name, 0.0) + (end - start)
+        return totals
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id, 'guild_id': self.guild_id, 'query': self.query,
+            'started_at': self.started_at, 'status': self.status, 'total_ms': round(self.duration * 1000, 1),
+            'spans': [{'name': name, 'start_ms': round((start - self.started) * 1000, 1), 'duration_ms': round((end - start) * 1000, 1), **attrs}
+                      for name, start, end, attrs in self.spans],
+        }
+
+
+class _NullTrace(Trace):
+    """トレースを記録しない場合に渡すダミー (呼び出し側で None チェックをしなくて済むように)"""
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(None, '')
+        self.status = 'disabled'
+
+    def span(self, name: str, **attrs):
+        return contextlib.nullcontext(attrs)
+
+    def add_span(self, name: str, start: float, end: float, **attrs):
+        pass
+
+
+NO_TRACE = _NullTrace()
+
+
+class Tracer:
+    """トレースの開始と終了を管理し、最近の TRACE_HISTORY 件を残す (TRACE_LOG_PATH があれば JSON Lines でも書き出す)
+    イベントループ上からのみ使う"""
+    _logger = logging.getLogger(__qualname__)
+
+    def __init__(self, history: int, log_path: str):
+        self.enabled = history > 0
+        self.log_path = log_path
+        self._recent: deque[Trace] = deque(maxlen=max(1, history))
+
+    def start(self, guild_id: int, query: str) -> Trace:
+        return Trace(guild_id, query) if self.enabled else NO_TRACE
+
+    def finish(self, trace: Trace, status: str):
+        """trace を status で終える (終わっているトレースやダミーなら何もしない)"""
+        if not trace.active: return
+        trace.status = status
+        trace.duration = time.monotonic() - trace.started
+        self._recent.append(trace)
+        if self._logger.isEnabledFor(logging.DEBUG): # 区間の集計は DEBUG の時だけ
+            self._logger.debug("Trace %s finished (%s, %.2fs): %s", trace.trace_id, status, trace.duration,
+                               ", ".join(f"{name} {seconds:.2f}s" for name, seconds in trace.span_totals().items()))
+        if self.log_path:
+            line = json.dumps(trace.to_dict(), ensure_ascii=False)
+            asyncio.get_running_loop().run_in_executor(None, self._append, line)
+
+    def _append(self, line: str):
+        try:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            self._logger.warning("Failed to write trace to %s: %s", self.log_path, e)
+
+    def recent(self, guild_id: int, count: int) -> list[Trace]:
+        """guild_id のトレースを新しい順に最大 count 件"""
+        return list(itertools.islice((t for t in reversed(self._recent) if t.guild_id == guild_id), count))
+
+
+tracer = Tracer(TRACE_HISTORY, TRACE_LOG_PATH)
 
-# yt-dlp インスタンス (個別のストリームURL取得用)
-ydl_opts_stream = ydl_opts_meta.copy()
-ydl_opts_stream['ignoreerrors'] = False # 個別の曲のエラーは検知する
-ydl_opts_stream['extract_flat'] = False # 個別取得時はFalseに
-# ydl_opts_stream['format'] = 'bestaudio[abr<=128]/bestaudio/best' # 必要なら調整
-ytdl_stream = yt_dlp.YoutubeDL(ydl_opts_stream)
+
+# --- 音声ソース ---
+PLAYBACK_PATH_OPUS_COPY = 'opus-copy' # Opus パケットをそのまま送る
+PLAYBACK_PATH_PCM = 'pcm-encode' # PCM にデコードして libopus で再エンコード
+
+playback_path_counts: Counter = Counter() # 再生方式ごとの曲数
+
+
+def create_audio_source(stream_info: dict, start_at: float = 0) -> tuple[discord.AudioSource, str]:
+    """ストリーム情報から音声ソースを作成し、(ソース, 再生方式) を返す
+    Opus の音声はそのまま送り (デコード/再エンコードのCPUコストがかからない)、それ以外や失敗時は PCM 経由にする
+    start_at (秒) を指定すると、その位置から再生する (再起動後の再開用)"""
+    stream_url = stream_info['stream_url']
+    # ローカルファイルには HTTP 用の再接続オプションを付けない
+    options = {'options': ffmpeg_options['options']} if stream_info.get('local') else dict(ffmpeg_options)
+    if start_at > 0:
+        options['before_options'] = f"{options.get('before_options', '')} -ss {start_at:.1f}".strip()
+    if PLAYBACK_MODE == 'auto' and stream_info.get('acodec') == 'opus':
+        try:
+            source = discord.FFmpegOpusAudio(stream_url, codec='copy', **options)
+            playback_path_counts[PLAYBACK_PATH_OPUS_COPY] += 1
+            if metrics.enabled: _ffmpeg_sources.add(source)
+            return source, PLAYBACK_PATH_OPUS_COPY
+        except discord.errors.ClientException as e:
+            logger.warning("Failed to create Opus passthrough source, falling back to PCM: %s", e)
+    source = discord.FFmpegPCMAudio(stream_url, **options)
+    playback_path_counts[PLAYBACK_PATH_PCM] += 1
+    if metrics.enabled: _ffmpeg_sources.add(source)
+    return source, PLAYBACK_PATH_PCM
+
+
+class FirstReadProbe(discord.AudioSource):
+    """最初に音声データを返した時刻を on_first_read(time.monotonic()) で知らせるラッパー
+    (再生スレッドから呼ばれる。メトリクス有効時だけ使う)"""
+
+    def __init__(self, source: discord.AudioSource, on_first_read):
+        self.source = source
+        self._on_first_read = on_first_read
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if data and self._on_first_read is not None:
+            callback, self._on_first_read = self._on_first_read, None
+            callback(time.monotonic())
+        return data
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
 
 
 # --- データ構造 ---
 class Song:
     """再生する曲の情報を保持するクラス"""
-    def __init__(self, source: discord.FFmpegPCMAudio, title: str, url: str, requester: discord.Member | None, duration: float | None = None):
+    def __init__(self, source: discord.AudioSource, title: str, url: str, requester: discord.Member | None, duration: float | None = None, playback_path: str = PLAYBACK_PATH_PCM, start_offset: float = 0):
         self.source = source
         self.title = title
         self.url = url
         self.requester = requester
         self.duration = duration # 秒単位 or None
+        self.playback_path = playback_path # 再生方式 (PLAYBACK_PATH_*)
+        self.start_offset = start_offset # 途中から再生する場合の開始位置 (秒)
+
+_YOUTUBE_WATCH_PREFIX = "https://www.youtube.com/watch?v="
+_YOUTUBE_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+_YOUTUBE_ID_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+_YOUTUBE_ID_INDEX = {c: i for i, c in enumerate(_YOUTUBE_ID_ALPHABET)}
+
+
+def encode_youtube_id(video_id: str) -> int:
+    """11文字の YouTube 動画ID を整数にする (1文字6ビット)"""
+    n = 0
+    for c in video_id:
+        n = (n << 6) | _YOUTUBE_ID_INDEX[c]
+    return n
+
+
+def decode_youtube_id(n: int) -> str:
+    """encode_youtube_id の逆変換"""
+    chars = []
+    for _ in range(11):
+        chars.append(_YOUTUBE_ID_ALPHABET[n & 0x3F])
+        n >>= 6
+    return ''.join(reversed(chars))
+
+
+class QueueEntry:
+    """キューに入っている曲 (再生前なので音声ソースは持たない)
+    大きなプレイリストを何千曲もキューに入れるので、辞書ではなく __slots__ で省メモリにしている
+    YouTube の URL は動画IDの整数だけを持ち、タイトルは intern して同じ曲を複数サーバーで共有する"""
+    __slots__ = ('_video', 'title', 'requester', 'duration', 'stream_info')
+    start_at = 0 # 再生開始位置 (秒)。途中から再生するのは ResumeEntry だけ
+
+    def __init__(self, webpage_url: str, title: str, requester: int | None, duration: float | None = None, stream_info: dict | None = None):
+        video_id = webpage_url[len(_YOUTUBE_WATCH_PREFIX):] if webpage_url.startswith(_YOUTUBE_WATCH_PREFIX) else None
+        # 整数 = YouTube 動画ID、文字列 = それ以外のURL
+        self._video: int | str = encode_youtube_id(video_id) if video_id and _YOUTUBE_ID_RE.fullmatch(video_id) else webpage_url
+        self.title = sys.intern(title)
+        self.requester = requester # Member ではなくユーザーID (再接続時の fetch 用)
+        self.duration = duration # 秒単位 or None
+        self.stream_info = stream_info # キュー追加時に取得済みのストリーム情報 (単一曲のみ)
+
+    @property
+    def webpage_url(self) -> str:
+        if isinstance(self._video, int):
+            return _YOUTUBE_WATCH_PREFIX + decode_youtube_id(self._video)
+        return self._video
+
+    def to_row(self) -> list:
+        """キューの保存用 (JSON にできる形。ストリーム情報は有効期限があるので保存しない)"""
+        return [self._video, self.title, self.requester, self.duration]
+
+    @classmethod
+    def from_row(cls, row: list) -> 'QueueEntry':
+        entry = cls.__new__(cls)
+        entry._video, title, entry.requester, entry.duration = row
+        entry.title = sys.intern(title)
+        entry.stream_info = None
+        return entry
+
+    def to_flat_entry(self) -> dict:
+        """extract_flat のプレイリストのエントリと同じ形の辞書にする (メタデータキャッシュ保存用)"""
+        if isinstance(self._video, int):
+            return {'id': decode_youtube_id(self._video), 'title': self.title, 'duration': self.duration, 'ie_key': 'Youtube', 'url': self.webpage_url}
+        return {'id': None, 'title': self.title, 'duration': self.duration, 'ie_key': None, 'url': self._video}
+
+    def __repr__(self) -> str:
+        return f"QueueEntry({self.webpage_url!r}, {self.title!r})"
+
+
+class ResumeEntry(QueueEntry):
+    """再起動前に再生中だった曲 (start_at 秒の位置から再生を再開する)"""
+    __slots__ = ('start_at',)
+
+    def __init__(self, webpage_url: str, title: str, requester: int | None, duration: float | None, start_at: float):
+        super().__init__(webpage_url, title, requester, duration)
+        self.start_at = start_at
+
+
+class TrackQueue:
+    """位置指定の削除/移動/挿入が速い再生キュー (ブロック分割リスト)
+    曲を最大 BLOCK_SIZE*2 件のブロックに分けて持ち、ブロックの長さの累積和を Fenwick 木で管理する
+    位置の検索は O(log ブロック数)、1曲の挿入/削除/移動は O(log ブロック数 + BLOCK_SIZE)、範囲の削除は O(削除数 + log ブロック数)
+    大きくなりすぎたブロックは分割し、隣と合わせて BLOCK_SIZE 件以下になったブロックは結合する (ブロック数は 2*曲数/BLOCK_SIZE+1 以下)
+    木を作り直す (O(ブロック数)) のは分割/結合の時だけなので、均すと BLOCK_SIZE 回程度の変更に1回になる
+    中身が変わるたびに version、clear() のたびに generation が増える (表示のキャッシュ/取り込み中断の判定用)
+    /queue の表示用に、合計時間・時間不明の曲数・リクエストした人ごとの曲数を変更のたびに更新しておく"""
+    BLOCK_SIZE = 256
+
+    def __init__(self, items=()):
+        self._blocks: list[list[QueueEntry]] = []
+        self._tree: list[int] = [0] # Fenwick 木 (1-indexed)
+        self._len = 0
+        self.version = 0
+        self.generation = 0
+        self.total_duration = 0 # 時間が分かっている曲の合計 (秒)
+        self.unknown_duration_count = 0 # 時間が分からない曲の数
+        self.requester_counts: Counter = Counter() # リクエストしたユーザーID -> 曲数
+        self.extend(items)
+
+    # --- 内部処理 ---
+    def _rebuild(self):
+        """空のブロックを取り除き、Fenwick 木を作り直す O(ブロック数)"""
+        self._blocks = [b for b in self._blocks if b]
+        tree = [0] + [len(b) for b in self._blocks]
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree): tree[j] += tree[i]
+        self._tree = tree
+
+    def _add(self, block_index: int, delta: int):
+        i = block_index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, count: int) -> int:
+        """先頭から count 個のブロックの曲数の合計"""
+        total = 0
+        while count > 0:
+            total += self._tree[count]
+            count -= count & -count
+        return total
+
+    def _append_block(self, block: list):
+        """末尾にブロックを足す (木は作り直さず、要素を1つ足すだけ O(log ブロック数))"""
+        self._blocks.append(block)
+        i = len(self._tree)
+        self._tree.append(len(block) + self._prefix(i - 1) - self._prefix(i - (i & -i)))
+
+    def _needs_merge(self, b: int) -> bool:
+        """ブロック b が空か、隣のブロックと合わせても BLOCK_SIZE 件以下か"""
+        size = len(self._blocks[b])
+        return size == 0 or (b > 0 and size + len(self._blocks[b - 1]) <= self.BLOCK_SIZE) or \
+            (b + 1 < len(self._blocks) and size + len(self._blocks[b + 1]) <= self.BLOCK_SIZE)
+
+    def _merge(self, start: int, stop: int):
+        """ブロック [start, stop) とその両隣のうち、隣と合わせて BLOCK_SIZE 件以下になるものを結合して木を作り直す"""
+        start, stop = max(start - 1, 0), min(stop + 1, len(self._blocks))
+        merged: list[list[QueueEntry]] = []
+        for block in self._blocks[start:stop]:
+            if merged and len(merged[-1]) + len(block) <= self.BLOCK_SIZE: merged[-1].extend(block)
+            elif block: merged.append(block)
+        self._blocks[start:stop] = merged
+        self._rebuild()
+
+    def _locate(self, index: int) -> tuple[int, int]:
+        """全体での位置 -> (ブロック番号, ブロック内の位置)"""
+        pos = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= index:
+                pos = nxt
+                index -= self._tree[nxt]
+            step >>= 1
+        return pos, index
+
+    def _normalize(self, index: int) -> int:
+        if index < 0: index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("queue index out of range")
+        return index
+
+    def _changed(self, delta: int):
+        self._len += delta
+        self.version += 1
+        if not self._len: self.total_duration = 0 # 小数の時間の足し引きで誤差が残らないように
+
+    def _account(self, entries, sign: int):
+        """集計値に entries を加える (sign=1) / 取り除く (sign=-1)"""
+        for entry in entries:
+            if isinstance(entry.duration, (int, float)): self.total_duration += sign * entry.duration
+            else: self.unknown_duration_count += sign
+            if entry.requester is not None:
+                count = self.requester_counts[entry.requester] + sign
+                if count: self.requester_counts[entry.requester] = count
+                else: del self.requester_counts[entry.requester]
+
+    # --- 読み取り ---
+    def __len__(self) -> int:
+        return self._len
+
+    def __bool__(self) -> bool:
+        return self._len > 0
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __getitem__(self, index: int) -> QueueEntry:
+        b, o = self._locate(self._normalize(index))
+        return self._blocks[b][o]
+
+    def slice(self, start: int, stop: int) -> list[QueueEntry]:
+        """[start, stop) の曲をリストで返す (全体をコピーしない)"""
+        start, stop = max(0, start), min(stop, self._len)
+        if start >= stop: return []
+        b, o = self._locate(start)
+        return list(itertools.islice(itertools.chain(self._blocks[b][o:], *self._blocks[b + 1:]), stop - start))
+
+    # --- 変更 ---
+    def append(self, entry: QueueEntry):
+        if self._blocks and len(self._blocks[-1]) < self.BLOCK_SIZE:
+            self._blocks[-1].append(entry)
+            self._add(len(self._blocks) - 1, 1)
+        else:
+            self._append_block([entry])
+        self._account((entry,), 1)
+        self._changed(1)
+
+    def extend(self, entries):
+        entries = list(entries)
+        if not entries: return
+        rest = entries
+        if self._blocks: # 最後のブロックの空きを先に埋める
+            room = max(self.BLOCK_SIZE - len(self._blocks[-1]), 0)
+            if room:
+                self._blocks[-1].extend(entries[:room])
+                self._add(len(self._blocks) - 1, min(room, len(entries)))
+                rest = entries[room:]
+        for i in range(0, len(rest), self.BLOCK_SIZE):
+            self._append_block(rest[i:i + self.BLOCK_SIZE])
+        self._account(entries, 1)
+        self._changed(len(entries))
+
+    def insert(self, index: int, entry: QueueEntry):
+        """index の位置に挿入する (範囲外なら末尾/先頭に寄せる)"""
+        index = min(max(index + self._len if index < 0 else index, 0), self._len)
+        if index == self._len:
+            self.append(entry)
+            return
+        b, o = self._locate(index)
+        block = self._blocks[b]
+        block.insert(o, entry)
+        if len(block) > self.BLOCK_SIZE * 2: # 大きくなりすぎたブロックは分割
+            self._blocks[b:b + 1] = [block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:]]
+            self._rebuild()
+        else:
+            self._add(b, 1)
+        self._account((entry,), 1)
+        self._changed(1)
+
+    def pop(self, index: int = -1) -> QueueEntry:
+        b, o = self._locate(self._normalize(index))
+        entry = self._blocks[b].pop(o)
+        if self._needs_merge(b):
+            self._merge(b, b + 1)
+        else:
+            self._add(b, -1)
+        self._account((entry,), -1)
+        self._changed(-1)
+        return entry
+
+    def popleft(self) -> QueueEntry:
+        return self.pop(0)
+
+    def move(self, src: int, dst: int) -> QueueEntry:
+        """src の曲を取り出して dst の位置に入れ直す"""
+        entry = self.pop(src)
+        self.insert(dst, entry)
+        return entry
+
+    def remove_range(self, start: int, stop: int) -> list[QueueEntry]:
+        """[start, stop) の曲を削除して返す O(削除数 + log ブロック数)。ブロックを結合した時は木の作り直しの O(ブロック数) が加わる"""
+        start, stop = max(0, start), min(stop, self._len)
+        if start >= stop: return []
+        removed = []
+        first, o = self._locate(start)
+        b, remaining = first, stop - start
+        while remaining:
+            block = self._blocks[b]
+            chunk = block[o:o + remaining]
+            del block[o:o + remaining]
+            removed.extend(chunk)
+            remaining -= len(chunk)
+            self._add(b, -len(chunk))
+            b, o = b + 1, 0
+        # 途中のブロックは空になっている。端のブロックが小さくなっていれば隣と結合する
+        if b - first > 2 or any(self._needs_merge(i) for i in (first, b - 1)):
+            self._merge(first, b)
+        self._account(removed, -1)
+        self._changed(-len(removed))
+        return removed
+
+    def clear(self):
+        self._blocks = []
+        self._tree = [0]
+        self.generation += 1
+        self.total_duration = 0
+        self.unknown_duration_count = 0
+        self.requester_counts.clear()
+        self._changed(-self._len)
+
 
 class GuildMusicState:
     """サーバーごとの音楽再生状態を管理するクラス"""
@@ -78,7 +1450,7 @@ class GuildMusicState:
 
     def __init__(self, loop: asyncio.AbstractEventLoop, guild_id: int):
         self.guild_id = guild_id
-        self.queue = deque() # 曲情報辞書のキュー {'webpage_url': ..., 'title': ..., 'requester': ..., 'duration': ...}
+        self.queue = TrackQueue() # 再生待ちの曲
         self.voice_client: discord.VoiceClient | None = None
         self.current_song: Song | None = None
         self.loop = loop
@@ -87,12 +1459,19 @@ class GuildMusicState:
         self.last_text_channel_id: int | None = None # 最後にコマンドが使われたチャンネルID
         self.playback_start_time: float | None = None # 現在の曲の再生開始時刻 (time.time())
         self._playback_was_successful: bool = False # 再生成功フラグ (キュー処理用だったが残す)
-        self._logger.info(f"Guild {self.guild_id}: Music state initialized.")
+        self._prefetched: dict[int, tuple[QueueEntry, asyncio.Task]] = {} # id(キューの曲) -> (キューの曲, Song作成タスク)
+        self._queue_pages: dict[int, str] = {} # /queue のページ番号 -> 曲一覧テキスト (queue.version が変わったら破棄)
+        self._queue_pages_version = -1
+        self._first_audio_requested_at: float | None = None # メトリクス: 停止中に /play された時刻 (time.monotonic())
+        self._track_ended_at: float | None = None # メトリクス: 前の曲が終わった時刻 (time.monotonic())
+        self.first_audio_trace: Trace = NO_TRACE # 停止中に来た /play のトレース (最初の音声が出たら終える)
+        self._play_called_at = 0.0 # voice_client.play() を呼んだ時刻 (トレース用)
+        self._logger.info("Guild %s: Music state initialized.", self.guild_id)
 
     async def notify_channel(self, message: str, embed: discord.Embed | None = None, delete_after: float | None = None):
         """最後にコマンドが使われたチャンネルにメッセージを送信する"""
         if not self.last_text_channel_id:
-            self._logger.debug(f"Guild {self.guild_id}: No last text channel ID, cannot send notification.")
+            self._logger.debug("Guild %s: No last text channel ID, cannot send notification.", self.guild_id)
             return
 
         try:
@@ -102,11 +1481,14 @@ class GuildMusicState:
             if isinstance(channel, discord.TextChannel):
                 await channel.send(content=message if not embed else None, embed=embed, delete_after=delete_after)
             else:
-                 self._logger.warning(f"Guild {self.guild_id}: Channel {self.last_text_channel_id} not found/not text.")
+                 self._logger.warning("Guild %s: Channel %s not found/not text.", self.guild_id, self.last_text_channel_id)
+                 notify_failures.inc('channel_missing')
         except discord.errors.Forbidden:
-            self._logger.error(f"Guild {self.guild_id}: Missing permissions in channel {self.last_text_channel_id}.")
+            self._logger.error("Guild %s: Missing permissions in channel %s.", self.guild_id, self.last_text_channel_id)
+            notify_failures.inc('forbidden')
         except Exception as e:
-            self._logger.exception(f"Guild {self.guild_id}: Failed to send notification: {e}")
+            self._logger.exception("Guild %s: Failed to send notification: %s", self.guild_id, e)
+            notify_failures.inc('error')
 
     def update_last_channel(self, channel_id: int):
         """最後に使用されたテキストチャンネルIDを更新する"""
@@ -116,68 +1498,176 @@ class GuildMusicState:
         """オーディオプレーヤータスクを開始または再開する"""
         if self.audio_player_task is None or self.audio_player_task.done():
            if self.audio_player_task and self.audio_player_task.cancelled():
-               self._logger.info(f"Guild {self.guild_id}: Previous audio player task cancelled. Creating new.")
+               self._logger.info("Guild %s: Previous audio player task cancelled. Creating new.", self.guild_id)
            elif self.audio_player_task and self.audio_player_task.done() and self.audio_player_task.exception():
                 exc = self.audio_player_task.exception()
-                self._logger.error(f"Guild {self.guild_id}: Previous audio player task finished with error: {exc}")
-           self._logger.info(f"Guild {self.guild_id}: Starting audio player task.")
+                self._logger.error("Guild %s: Previous audio player task finished with error: %s", self.guild_id, exc)
+           self._logger.info("Guild %s: Starting audio player task.", self.guild_id)
            self.audio_player_task = self.loop.create_task(self.audio_player())
         else:
-           self._logger.debug(f"Guild {self.guild_id}: Audio player task already running.")
+           self._logger.debug("Guild %s: Audio player task already running.", self.guild_id)
+
+    def snapshot(self) -> tuple:
+        """保存用に (VCのID, テキストチャンネルID, 再生中の曲, 再生位置, キューの曲リスト) を返す
+        曲リストは参照のコピーだけ (JSON 化は書き込みスレッドで行う)"""
+        current = None
+        if self.current_song:
+            requester_id = self.current_song.requester.id if self.current_song.requester else None
+            current = [self.current_song.url, self.current_song.title, requester_id, self.current_song.duration]
+        voice_channel_id, text_channel_id, position = self.playback_position()
+        return voice_channel_id, text_channel_id, current, position, list(self.queue)
+
+    def playback_position(self) -> tuple:
+        """保存用に (VCのID, テキストチャンネルID, 再生位置) を返す (キューをコピーしないので、再生位置だけの更新に使う)"""
+        position = time.time() - self.playback_start_time if self.current_song and self.playback_start_time else 0.0
+        voice_channel_id = self.voice_client.channel.id if self.voice_client and self.voice_client.channel else None
+        return voice_channel_id, self.last_text_channel_id, position
+
+    def restore_snapshot(self, saved: dict):
+        """QueueStore.load で読んだ保存内容をキューに戻す。再生中だった曲は少し前の位置から再開するよう先頭に入れる"""
+        entries = [QueueEntry.from_row(row) for row in json.loads(saved['entries'])]
+        current = json.loads(saved['current']) if saved['current'] else None
+        if current:
+            url, title, requester_id, duration = current
+            entries.insert(0, ResumeEntry(url, title, requester_id, duration, max(0.0, saved['position'] - RESUME_REWIND_SECONDS)))
+        self.queue.extend(entries)
+        if saved['text_channel_id']: self.last_text_channel_id = saved['text_channel_id']
+        self._logger.info("Guild %s: Restored %s songs from saved queue (position %.0fs).", self.guild_id, len(entries), saved['position'])
+
+    def queue_page_count(self) -> int:
+        return max(1, -(-len(self.queue) // QUEUE_PAGE_SIZE))
+
+    def queue_page_text(self, page: int) -> str:
+        """/queue の page ページ目 (0始まり) の曲一覧。キューが変更されるまではキャッシュを返す"""
+        if self._queue_pages_version != self.queue.version:
+            self._queue_pages.clear()
+            self._queue_pages_version = self.queue.version
+        text = self._queue_pages.get(page)
+        if text is None:
+            start = page * QUEUE_PAGE_SIZE
+            lines = []
+            for i, song_info in enumerate(self.queue.slice(start, start + QUEUE_PAGE_SIZE), start=start + 1):
+                duration_str = self.format_duration(song_info.duration)
+                # キュー内のリクエスタIDからメンションを作成 (fetchはしない)
+                req_mention = f"<@{song_info.requester}>" if song_info.requester else '不明'
+                title = song_info.title if len(song_info.title) <= 80 else song_info.title[:79] + "…"
+                lines.append(f"{i}. [{title}]({song_info.webpage_url}) ({duration_str}) Req: {req_mention}\n")
+            text = self._queue_pages[page] = "".join(lines)
+        return text
+
+    def schedule_prefetch(self):
+        """キュー先頭 PREFETCH_COUNT 曲の Song オブジェクトをバックグラウンドで準備する
+        (キュー変更後に呼ぶ。先頭から外れた準備済みの曲は破棄する)"""
+        wanted = {id(info): info for info in itertools.islice(self.queue, PREFETCH_COUNT)}
+        for key, (info, _) in list(self._prefetched.items()):
+            if wanted.get(key) is not info:
+                self._discard_prefetched(key)
+        for i, (key, info) in enumerate(wanted.items()):
+            if key in self._prefetched:
+                continue
+            self._logger.debug("Guild %s: Prefetching '%s'.", self.guild_id, info.title)
+            # 停止中からの /play なら、先頭の曲の準備はその /play のトレースに記録する
+            trace = self.first_audio_trace if i == 0 and self.current_song is None else NO_TRACE
+            task = self.loop.create_task(self.create_song_object(info.webpage_url, info.requester, notify_errors=False, stream_info=info.stream_info, priority=PRIORITY_PREFETCH, start_at=info.start_at, trace=trace))
+            self._prefetched[key] = (info, task)
+
+    def take_prefetched(self, info: QueueEntry) -> asyncio.Task | None:
+        """キューから取り出した曲の準備済みタスクを引き取る (無ければ None)"""
+        entry = self._prefetched.get(id(info))
+        if entry is None or entry[0] is not info:
+            return None
+        del self._prefetched[id(info)]
+        return entry[1]
+
+    def _discard_prefetched(self, key: int):
+        """準備済みの曲を破棄する (作成途中ならキャンセル、作成済みならffmpegを終了)"""
+        info, task = self._prefetched.pop(key)
+        self._logger.debug("Guild %s: Discarding prefetched '%s'.", self.guild_id, info.title)
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None and task.result() is not None:
+            task.result().source.cleanup()
+
+    def clear_prefetch(self):
+        """準備済みの曲をすべて破棄する (キュークリア/停止時)"""
+        for key in list(self._prefetched):
+            self._discard_prefetched(key)
 
     async def audio_player(self):
         """キューを監視し、曲を再生するメインループ (ループ機能削除版)"""
-        self._logger.info(f"Guild {self.guild_id}: === Audio player task started ===")
+        self._logger.info("Guild %s: === Audio player task started ===", self.guild_id)
 
         while True: # メイン再生ループ
             self.play_next_song.clear()
             self._playback_was_successful = False # 各サイクルの開始時にリセット
 
-            self._logger.debug(f"Guild {self.guild_id}: --- Player loop cycle start --- Queue size: {len(self.queue)}")
+            self._logger.debug("Guild %s: --- Player loop cycle start --- Queue size: %s", self.guild_id, len(self.queue))
 
             # --- 次の曲の準備 ---
-            next_song_info: dict | None = None
+            next_song_info: QueueEntry | None = None
+            prefetched_task: asyncio.Task | None = None
             if self.queue:
                 # キューから取得
                 next_song_info = self.queue.popleft()
-                self._logger.debug(f"Guild {self.guild_id}: Popped from queue: {next_song_info.get('title')}")
+                self._logger.debug("Guild %s: Popped from queue: %s", self.guild_id, next_song_info.title)
+                prefetched_task = self.take_prefetched(next_song_info)
+                # 次の曲の先読みを開始
+                self.schedule_prefetch()
             else: # キューが空
-                self._logger.debug(f"Guild {self.guild_id}: Queue empty. Entering wait state.")
+                self._logger.debug("Guild %s: Queue empty. Entering wait state.", self.guild_id)
                 self.current_song = None # 再生対象がないのでクリア
                 self.playback_start_time = None
+                self._track_ended_at = None # 次の曲までの無音は曲間ではない
+                update_idle_timer(self.guild_id) # しばらく何も再生しなければ切断
                 # イベントがセットされるまで待機
                 await self.play_next_song.wait()
-                self._logger.debug(f"Guild {self.guild_id}: Player task woken up after wait.")
+                self._logger.debug("Guild %s: Player task woken up after wait.", self.guild_id)
                 # ループの先頭に戻る
                 continue # 次のサイクルへ
 
             # --- 曲オブジェクト作成と再生 ---
             try:
                 if not next_song_info:
-                    self._logger.warning(f"Guild {self.guild_id}: next_song_info is None unexpectedly. Skipping cycle.")
+                    self._logger.warning("Guild %s: next_song_info is None unexpectedly. Skipping cycle.", self.guild_id)
                     # ループの先頭に戻る
                     continue # 次のサイクルへ
 
-                original_url = next_song_info.get('webpage_url', 'N/A')
-                requester = next_song_info.get('requester') # ここではまだ Member or ID or None
-                title_hint = next_song_info.get('title', 'N/A')
-
-                self._logger.info(f"Guild {self.guild_id}: Preparing song object for: '{title_hint}' (URL: {original_url})")
-                # create_song_object 呼び出し (requesterを渡す)
-                self.current_song = await self.create_song_object(original_url, requester)
+                original_url = next_song_info.webpage_url
+                requester = next_song_info.requester # ここではまだ ID or None
+                title_hint = next_song_info.title
+
+                self.current_song = None
+                trace = self.first_audio_trace
+                if prefetched_task is not None:
+                    self._logger.info("Guild %s: Using prefetched song object for: '%s'", self.guild_id, title_hint)
+                    with trace.span('prefetch_wait', ready=prefetched_task.done()):
+                        if not prefetched_task.done(): # まだ解決待ちなら最優先に
+                            extraction_scheduler.promote(self.guild_id, PRIORITY_PREFETCH, PRIORITY_PLAYER)
+                        self.current_song = await prefetched_task
+                if self.current_song is None:
+                    self._logger.info("Guild %s: Preparing song object for: '%s' (URL: %s)", self.guild_id, title_hint, original_url)
+                    # create_song_object 呼び出し (requesterを渡す)
+                    self.current_song = await self.create_song_object(original_url, requester, stream_info=next_song_info.stream_info, start_at=next_song_info.start_at, trace=trace)
 
                 if self.current_song is None:
-                    self._logger.warning(f"Guild {self.guild_id}: Failed to create song object for '{title_hint}'. Skipping.")
+                    self._logger.warning("Guild %s: Failed to create song object for '%s'. Skipping.", self.guild_id, title_hint)
+                    tracer.finish(trace, 'failed')
                     await self.notify_channel(f"❌ 曲「{title_hint}」読込失敗、スキップ。", delete_after=15)
                     # ループの先頭に戻る
                     continue # 次のサイクルへ
 
                 # --- VC接続確認と再生開始 ---
                 if self.voice_client and self.voice_client.is_connected():
-                    self._logger.info(f"Guild {self.guild_id}: Playing '{self.current_song.title}' (Dur: {self.format_duration(self.current_song.duration)}) Req by {self.current_song.requester.name if self.current_song.requester else 'Unknown'}")
-                    self.playback_start_time = time.time()
+                    self._logger.info("Guild %s: Playing '%s' (Dur: %s, Path: %s) Req by %s", self.guild_id, self.current_song.title, self.format_duration(self.current_song.duration), self.current_song.playback_path, self.current_song.requester.name if self.current_song.requester else 'Unknown')
+                    self.playback_start_time = time.time() - self.current_song.start_offset # 途中から再生する場合はその分さかのぼる
+                    source = self.current_song.source
+                    if metrics.enabled or trace.active: # 最初の音声が出た時刻を計測する
+                        source = FirstReadProbe(source, lambda at: self.loop.call_soon_threadsafe(self._on_first_audio, at))
+                    self._play_called_at = time.monotonic()
                     # play() 呼び出し
-                    self.voice_client.play(self.current_song.source, after=lambda e: self.handle_after_play(e))
+                    self.voice_client.play(source, after=lambda e: self.handle_after_play(e))
+                    audio_cache.record_play(self.current_song.url) # よく再生される曲はローカルに保存
+                    update_idle_timer(self.guild_id) # 再生が始まったので待機中の切断を取り消す
 
                     # 再生開始通知
                     duration_str = self.format_duration(self.current_song.duration)
@@ -189,15 +1679,17 @@ class GuildMusicState:
                     display_duration = self.current_song.duration if self.current_song.duration and self.current_song.duration < 3600 else None
                     await self.notify_channel("", embed=embed, delete_after=display_duration)
 
-                    self._logger.debug(f"Guild {self.guild_id}: Waiting for play_next_song event...")
+                    self._logger.debug("Guild %s: Waiting for play_next_song event...", self.guild_id)
                     # wait() 呼び出し
                     await self.play_next_song.wait() # 再生終了 or スキップ待ち
-                    self._logger.debug(f"Guild {self.guild_id}: play_next_song event received. Successful flag: {self._playback_was_successful}")
+                    self._logger.debug("Guild %s: play_next_song event received. Successful flag: %s", self.guild_id, self._playback_was_successful)
 
                 else: # VC未接続
-                    self._logger.error(f"Guild {self.guild_id}: VC disconnected before playing. Cleaning up.")
+                    self._logger.error("Guild %s: VC disconnected before playing. Cleaning up.", self.guild_id)
                     self.queue.clear()
+                    self.clear_prefetch()
                     if self.voice_client: self.voice_client = None
+                    tracer.finish(trace, 'disconnected')
                     remove_guild_state(self.guild_id)
                     # タスク自体を終了
                     break # whileループを抜ける
@@ -208,16 +1700,16 @@ class GuildMusicState:
 
                 # ループ機能がないため、再生後の特別な処理は不要
                 if playback_successful:
-                     self._logger.debug(f"Guild {self.guild_id}: Playback successful.")
+                     self._logger.debug("Guild %s: Playback successful.", self.guild_id)
                 else:
-                     self._logger.debug(f"Guild {self.guild_id}: Playback not successful (skipped or error).")
+                     self._logger.debug("Guild %s: Playback not successful (skipped or error).", self.guild_id)
 
             except asyncio.CancelledError:
-                 self._logger.info(f"Guild {self.guild_id}: Audio player task cancelled.")
+                 self._logger.info("Guild %s: Audio player task cancelled.", self.guild_id)
                  # タスク自体を終了
                  break # whileループを抜ける
             except Exception as e:
-                self._logger.exception(f"Guild {self.guild_id}: Unexpected error in player loop cycle: {e}")
+                self._logger.exception("Guild %s: Unexpected error in player loop cycle: %s", self.guild_id, e)
                 await self.notify_channel(f"⚠️ プレーヤーエラー発生: `{e}`", delete_after=30)
                 # エラーが発生しても次の曲へ進むためにループは継続
                 await asyncio.sleep(1) # 少し待機
@@ -226,36 +1718,53 @@ class GuildMusicState:
 
             finally:
                  # 各サイクルの最後に必ず通る
-                 self._logger.debug(f"Guild {self.guild_id}: End of loop cycle. Cleaning up current song state.")
+                 self._logger.debug("Guild %s: End of loop cycle. Cleaning up current song state.", self.guild_id)
                  self.current_song = None
                  self.playback_start_time = None
                  # _playback_was_successful は次のサイクルの最初にリセットされる
 
             # 自然に次のループサイクルへ
-            self._logger.debug(f"Guild {self.guild_id}: --- Proceeding to the next player loop cycle ---")
+            self._logger.debug("Guild %s: --- Proceeding to the next player loop cycle ---", self.guild_id)
 
 
         # --- while ループが break で抜けられた場合 ---
-        self._logger.info(f"Guild {self.guild_id}: === Audio player task finished (exited while loop) ===")
+        self._logger.info("Guild %s: === Audio player task finished (exited while loop) ===", self.guild_id)
         # 終了時のクリーンアップ (念のため)
         self.queue.clear()
+        self.clear_prefetch()
         self.current_song = None
         self.playback_start_time = None
         # VC切断や状態削除は remove_guild_state に任せる
 
 
+    def _on_first_audio(self, at: float):
+        """曲の最初の音声が出た時の記録 (停止中からの /play なら応答時間とトレースの終了、続けて再生した曲なら曲間)"""
+        if self.first_audio_trace.active:
+            self.first_audio_trace.add_span('first_packet', self._play_called_at, at)
+            tracer.finish(self.first_audio_trace, 'playing')
+            self.first_audio_trace = NO_TRACE
+        if self._first_audio_requested_at is not None:
+            first_audio_seconds.observe(at - self._first_audio_requested_at)
+        elif self._track_ended_at is not None:
+            inter_track_gap_seconds.observe(at - self._track_ended_at)
+        self._first_audio_requested_at = None
+        self._track_ended_at = None
+
     def handle_after_play(self, error):
         """再生終了時のコールバック (再生成功フラグ設定追加)"""
         log_prefix = f"Guild {self.guild_id}: [AfterPlay]"
+        if metrics.enabled: self._track_ended_at = time.monotonic()
         # コールバック実行時点の曲名をログに残す
         current_title_for_log = self.current_song.title if self.current_song else 'N/A (state might be ahead)'
-        self._logger.debug(f"{log_prefix} Callback entered. Error: {error}. Current song for log: '{current_title_for_log}'")
+        self._logger.debug("%s Callback entered. Error: %s. Current song for log: '%s'", log_prefix, error, current_title_for_log)
 
+        if self.first_audio_trace.active: # 音声が出る前に終わった
+            self.loop.call_soon_threadsafe(tracer.finish, self.first_audio_trace, 'error' if error else 'no_audio')
         if error:
             self._playback_was_successful = False # エラー時は False
-            if isinstance(error, discord.errors.ConnectionClosed): self._logger.warning(f"{log_prefix} Player conn closed: {error}")
-            elif 'Not connected' in str(error): self._logger.warning(f"{log_prefix} Player not connected: {error}")
-            else: self._logger.error(f'{log_prefix} Player error: {error}')
+            if isinstance(error, discord.errors.ConnectionClosed): self._logger.warning("%s Player conn closed: %s", log_prefix, error)
+            elif 'Not connected' in str(error): self._logger.warning("%s Player not connected: %s", log_prefix, error)
+            else: self._logger.error('%s Player error: %s', log_prefix, error)
             # エラー通知 (非同期実行)
             asyncio.run_coroutine_threadsafe(
                 self.notify_channel(f"⚠️ 再生エラー発生: {current_title_for_log}\n`{error}`", delete_after=30),
@@ -263,16 +1772,20 @@ class GuildMusicState:
             )
         else:
             self._playback_was_successful = True # 正常終了時は True
-            self._logger.info(f"{log_prefix} Finished playing '{current_title_for_log}' successfully.")
+            self._logger.info("%s Finished playing '%s' successfully.", log_prefix, current_title_for_log)
 
         # 次の曲への進行をトリガー
-        self._logger.debug(f"{log_prefix} Setting play_next_song event.")
+        self._logger.debug("%s Setting play_next_song event.", log_prefix)
         self.loop.call_soon_threadsafe(self.play_next_song.set)
-        self._logger.debug(f"{log_prefix} Callback finished.")
+        self._logger.debug("%s Callback finished.", log_prefix)
 
 
-    async def create_song_object(self, url: str, requester: discord.Member | int | None) -> Song | None:
-        """URLから再生に必要なSongオブジェクトを作成する (Requester型対応)"""
+    async def create_song_object(self, url: str, requester: discord.Member | int | None, notify_errors: bool = True, stream_info: dict | None = None, priority: int = PRIORITY_PLAYER, start_at: float = 0, trace: Trace = NO_TRACE) -> Song | None:
+        """URLから再生に必要なSongオブジェクトを作成する (Requester型対応)
+        notify_errors=False (先読み時) の場合、失敗してもチャンネルには通知しない
+        stream_info (キュー追加時に取得済みのストリーム情報) が有効期限内ならそれを使い、再取得しない
+        start_at (秒) を指定すると曲の途中から再生する
+        trace には各処理の時間を記録する"""
         # RequesterがIDの場合、Memberオブジェクトを取得試行
         requester_member: discord.Member | None = None
         if isinstance(requester, discord.Member):
@@ -281,166 +1794,199 @@ class GuildMusicState:
              guild = bot.get_guild(self.guild_id)
              if guild:
                  try:
-                     requester_member = await guild.fetch_member(requester)
-                     self._logger.debug(f"Guild {self.guild_id}: Successfully fetched member for ID {requester}")
-                 except discord.errors.NotFound: self._logger.warning(f"Guild {self.guild_id}: Requester ID {requester} not found in guild.")
-                 except discord.errors.HTTPException: self._logger.warning(f"Guild {self.guild_id}: Failed to fetch requester ID {requester} due to HTTP error.")
-             else: self._logger.warning(f"Guild {self.guild_id}: Cannot fetch member, guild not found.")
+                     with trace.span('fetch_member'):
+                         requester_member = await guild.fetch_member(requester)
+                     self._logger.debug("Guild %s: Successfully fetched member for ID %s", self.guild_id, requester)
+                 except discord.errors.NotFound: self._logger.warning("Guild %s: Requester ID %s not found in guild.", self.guild_id, requester)
+                 except discord.errors.HTTPException: self._logger.warning("Guild %s: Failed to fetch requester ID %s due to HTTP error.", self.guild_id, requester)
+             else: self._logger.warning("Guild %s: Cannot fetch member, guild not found.", self.guild_id)
         # else requester is None or other type
 
-        self._logger.debug(f"Guild {self.guild_id}: Creating song object for URL: {url}. Requester obj: {requester_member}")
+        self._logger.debug("Guild %s: Creating song object for URL: %s. Requester obj: %s", self.guild_id, url, requester_member)
         try:
-            loop = asyncio.get_event_loop()
-            self._logger.debug(f"Guild {self.guild_id}: Running ytdl_stream.extract_info in executor for {url}...")
-            data = await loop.run_in_executor(None, lambda: ytdl_stream.extract_info(url, download=False))
-            self._logger.debug(f"Guild {self.guild_id}: ytdl_stream.extract_info finished.")
-
-            if not data:
-                 self._logger.warning(f"Guild {self.guild_id}: ytdl_stream returned no data for {url}.")
-                 return None
-
-            if 'entries' in data and data['entries']:
-                self._logger.debug(f"Guild {self.guild_id}: Playlist URL passed, using first entry.")
-                if not data['entries']: return None
-                data = data['entries'][0]
-                if not data: return None
-
-            stream_url = data.get('url')
-            if not stream_url:
-                 formats = data.get('formats', [])
-                 self._logger.debug(f"Guild {self.guild_id}: No direct stream URL. Checking {len(formats)} formats...")
-                 audio_formats = [f for f in formats if f.get('url') and f.get('acodec') != 'none' and f.get('vcodec') == 'none']
-                 if audio_formats:
-                      best_audio = max(audio_formats, key=lambda f: f.get('abr', 0) if f.get('acodec') == 'opus' else (f.get('abr', 0) - 1000) if f.get('acodec') == 'aac' else -2000)
-                      stream_url = best_audio.get('url')
-                      self._logger.debug(f"Guild {self.guild_id}: Found audio-only stream (acodec: {best_audio.get('acodec')}).")
-                 else:
-                      mixed_formats = [f for f in formats if f.get('url') and f.get('acodec') != 'none']
-                      if mixed_formats:
-                           best_mixed = max(mixed_formats, key=lambda f: f.get('abr', 0))
-                           stream_url = best_mixed.get('url')
-                           self._logger.debug(f"Guild {self.guild_id}: Found mixed stream (acodec: {best_mixed.get('acodec')}).")
-                 if not stream_url:
-                     self._logger.error(f"Guild {self.guild_id}: Could not extract stream URL for {data.get('webpage_url', url)}.")
+            if local_info := await audio_cache.lookup(url):
+                self._logger.debug("Guild %s: Playing %s from local audio cache.", self.guild_id, url)
+                stream_info = local_info
+                stream_source = 'local'
+            elif stream_info and stream_info['expires_at'] > time.time():
+                self._logger.debug("Guild %s: Reusing stream info fetched at enqueue for %s.", self.guild_id, url)
+                stream_source = 'enqueue'
+            elif stream_info := stream_cache.get(url):
+                self._logger.debug("Guild %s: Stream cache hit for %s.", self.guild_id, url)
+                stream_source = 'cache'
+            else:
+                self._logger.debug("Guild %s: Running extraction.extract_full in executor for %s...", self.guild_id, url)
+                stream_source = 'ytdl'
+                started = time.monotonic()
+                with trace.span('ytdl_stream', priority=priority):
+                    data = await run_extraction('full', url, guild_id=self.guild_id, priority=priority)
+                extraction_seconds.observe(time.monotonic() - started, 'stream')
+                self._logger.debug("Guild %s: extraction.extract_full finished.", self.guild_id)
+
+                if not data:
+                     self._logger.warning("Guild %s: extractor returned no data for %s.", self.guild_id, url)
                      return None
 
-            title = data.get('title', '不明なタイトル')
-            webpage_url = data.get('webpage_url', url)
-            duration = data.get('duration')
-
-            self._logger.debug(f"Guild {self.guild_id}: Creating FFmpegPCMAudio source for '{title}'. Duration: {duration}")
-            source = discord.FFmpegPCMAudio(stream_url, **ffmpeg_options)
-            self._logger.info(f"Guild {self.guild_id}: Successfully created song object: '{title}' from {webpage_url}")
+                stream_info = data['stream']
+                if not stream_info:
+                    self._logger.error("Guild %s: Could not extract stream URL for %s.", self.guild_id, data.get('webpage_url', url))
+                    return None
+                stream_cache.put(stream_info, url)
+
+            title = stream_info['title']
+            webpage_url = stream_info['webpage_url']
+            duration = stream_info['duration']
+
+            self._logger.debug("Guild %s: Creating audio source for '%s'. Duration: %s, acodec: %s", self.guild_id, title, duration, stream_info.get('acodec'))
+            with trace.span('ffmpeg_spawn') as attrs:
+                source, playback_path = create_audio_source(stream_info, start_at)
+                attrs.update(path=playback_path, stream=stream_source)
+            self._logger.info("Guild %s: Successfully created song object: '%s' from %s (path: %s, start: %.0fs)", self.guild_id, title, webpage_url, playback_path, start_at)
             # requester_member を渡す (Memberオブジェクト or None)
-            return Song(source, title, webpage_url, requester_member, duration)
+            return Song(source, title, webpage_url, requester_member, duration, playback_path, start_at)
 
-        except yt_dlp.utils.DownloadError as e:
-             self._logger.warning(f"Guild {self.guild_id}: yt-dlp error creating song object for {url}: {e}")
-             asyncio.run_coroutine_threadsafe(self.notify_channel(f"❌ 曲「{url}」読込失敗: `{e}`", delete_after=30), self.loop)
+        except ExtractionError as e:
+             self._logger.warning("Guild %s: yt-dlp error creating song object for %s: %s", self.guild_id, url, e)
+             if notify_errors:
+                 asyncio.run_coroutine_threadsafe(self.notify_channel(f"❌ 曲「{url}」読込失敗: `{e}`", delete_after=30), self.loop)
              return None
         except Exception as e:
-            self._logger.exception(f"Guild {self.guild_id}: Unexpected error creating song object for {url}: {e}")
-            asyncio.run_coroutine_threadsafe(self.notify_channel(f"❌ 曲「{url}」読込中エラー: `{e}`", delete_after=30), self.loop)
+            self._logger.exception("Guild %s: Unexpected error creating song object for %s: %s", self.guild_id, url, e)
+            if notify_errors:
+                asyncio.run_coroutine_threadsafe(self.notify_channel(f"❌ 曲「{url}」読込中エラー: `{e}`", delete_after=30), self.loop)
             return None
 
-    async def add_to_queue(self, url_or_search: str, requester: discord.Member, ctx: discord.ApplicationContext):
-        """キューに曲を追加する (UX向上版 - ブロッキング対策)"""
+    async def add_to_queue(self, url_or_search: str, requester: discord.Member, ctx: discord.ApplicationContext, trace: Trace = NO_TRACE):
+        """キューに曲を追加する (UX向上版 - ブロッキング対策)
+        停止中からの追加なら trace は最初の音声が出るまで続け、それ以外はキューに入った時点で終える"""
         self.update_last_channel(ctx.channel_id)
-        self._logger.info(f"Guild {self.guild_id}: Adding to queue requested by {requester.name} ({requester.id}): '{url_or_search}'") # IDもログに
+        self._logger.info("Guild %s: Adding to queue requested by %s (%s): '%s'", self.guild_id, requester.name, requester.id, url_or_search) # IDもログに
         loop = asyncio.get_event_loop()
         added_count = 0
         is_playlist = False
         playlist_title = None
         songs_to_add = []
+        stream_info: dict | None = None # 単一曲で詳細情報を取得した場合のストリーム情報 (再生時に再利用)
         initial_message: discord.WebhookMessage | None = None
+        playlist_stream: PlaylistStream | None = None
+        ingest_completed = True
+        player_kicked = False
+        idle = self.current_song is None and not (self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()))
+        if metrics.enabled and idle and self._first_audio_requested_at is None:
+            self._first_audio_requested_at = time.monotonic() # 停止中からの /play は最初の音声までの時間を計測
+        if idle and not self.first_audio_trace.active:
+            self.first_audio_trace = trace
 
         try:
             # 初期応答はdeferしているので、followupで応答する
-            initial_message = await ctx.followup.send(f"⏳ '{url_or_search}' 検索中...")
-
-            self._logger.debug(f"Guild {self.guild_id}: Running ytdl_meta.extract_info in executor...")
-            # extract_flat=Trueでメタデータを高速取得
-            data = await loop.run_in_executor(None, lambda: ytdl_meta.extract_info(url_or_search, download=False, process=False))
-            self._logger.debug(f"Guild {self.guild_id}: ytdl_meta finished. Type: {data.get('_type') if data else 'None'}")
+            with trace.span('followup'):
+                initial_message = await ctx.followup.send(f"⏳ '{url_or_search}' 検索中...")
+
+            # 永続キャッシュにあれば yt-dlp を呼ばない
+            cache_key = metadata_cache_key(url_or_search)
+            with trace.span('metadata_cache') as attrs:
+                data = await loop.run_in_executor(None, metadata_cache.get, cache_key)
+                attrs['hit'] = data is not None
+            from_cache = data is not None
+            started = time.monotonic()
+            if from_cache:
+                self._logger.info("Guild %s: Metadata cache hit for '%s'. Type: %s", self.guild_id, cache_key, data.get('_type'))
+            elif cache_key.startswith('pl:') and EXTRACT_BACKEND == 'thread':
+                # プレイリストはページを取得しながら少しずつキューに追加する (大量処理扱い)
+                self._logger.debug("Guild %s: Streaming playlist via extraction.stream_flat...", self.guild_id)
+                playlist_stream = PlaylistStream(url_or_search, guild_id=self.guild_id, priority=PRIORITY_BULK)
+                with trace.span('ytdl_meta', playlist=True):
+                    event, data = await playlist_stream.next_event()
+                if event == 'done': playlist_stream = None # プレイリストではなかった
+            else:
+                self._logger.debug("Guild %s: Running extraction.extract_flat in executor...", self.guild_id)
+                # extract_flat でメタデータを高速取得 (プレイリストはエントリ一覧の展開まで行うので大量処理扱い)
+                priority = PRIORITY_BULK if cache_key.startswith('pl:') else PRIORITY_INTERACTIVE
+                with trace.span('ytdl_meta'):
+                    data = await run_extraction('flat', url_or_search, guild_id=self.guild_id, priority=priority)
+                self._logger.debug("Guild %s: extraction.extract_flat finished. Type: %s", self.guild_id, data.get('_type') if data else 'None')
+            if not from_cache: extraction_seconds.observe(time.monotonic() - started, 'metadata')
 
             if not data:
-                 self._logger.warning(f"Guild {self.guild_id}: No data found for '{url_or_search}'.")
+                 self._logger.warning("Guild %s: No data found for '%s'.", self.guild_id, url_or_search)
                  await initial_message.edit(content=f"❌ '{url_or_search}' 情報が見つかりません。")
                  return 0
 
             if data.get('_type') == 'playlist':
                 is_playlist = True
                 playlist_title = data.get('title', 'プレイリスト')
-                self._logger.info(f"Guild {self.guild_id}: Playlist: '{playlist_title}'. Processing entries...")
+                self._logger.info("Guild %s: Playlist: '%s'. Processing entries...", self.guild_id, playlist_title)
                 await initial_message.edit(content=f"⏳ Playlist「{playlist_title}」処理中...")
 
-                entries = data.get('entries')
-                if not entries:
-                     self._logger.warning(f"Guild {self.guild_id}: Playlist entries missing.")
-                     await initial_message.edit(content=f"⚠️ Playlist「{playlist_title}」に曲なし。")
-                     return 0
-
-                self._logger.debug(f"Guild {self.guild_id}: Converting entries to list in executor...")
-                # entries はジェネレータの場合があるのでリスト化
-                entries_list = await loop.run_in_executor(None, list, entries)
-                original_entry_count = len(entries_list)
-                self._logger.info(f"Guild {self.guild_id}: Converted {original_entry_count} entries.")
-                await initial_message.edit(content=f"⏳ Playlist「{playlist_title}」({original_entry_count}曲) 処理中...")
-
-                for entry in entries_list:
-                    if not entry: continue
-                    entry_title = entry.get('title')
-                    webpage_url = None
-                    entry_id = entry.get('id')
-                    # yt-dlpのextract_flatではURLがないことがあるので、IDから復元を試みる
-                    if entry_id and entry.get('ie_key') == 'Youtube': webpage_url = f"https://www.youtube.com/watch?v={entry_id}"
-                    else: webpage_url = entry.get('url') # フォールバック
-
-                    if webpage_url and entry_title and entry_title != '[Unavailable Video]' and entry_title != '[Deleted video]':
-                        # キューには Member オブジェクトではなく ID を格納する (再接続時の fetch 用)
-                        songs_to_add.append({'webpage_url': webpage_url,'title': entry_title,'requester': requester.id,'duration': entry.get('duration')})
-                        added_count += 1
-                    else:
-                        self._logger.warning(f"Guild {self.guild_id}: Skipping invalid playlist entry (ID:'{entry_id}', Title:'{entry_title}', URL: {webpage_url})")
+                if playlist_stream is not None:
+                    batches = playlist_stream.batches()
+                else:
+                    # キャッシュ/プロセスのバックエンドでは取得済みの一覧を少しずつ流す
+                    entries_list = data.get('entries')
+                    if not entries_list:
+                         self._logger.warning("Guild %s: Playlist entries missing.", self.guild_id)
+                         await initial_message.edit(content=f"⚠️ Playlist「{playlist_title}」に曲なし。")
+                         return 0
+                    self._logger.info("Guild %s: Got %s entries.", self.guild_id, len(entries_list))
+                    batches = iter_batches(entries_list)
+
+                # キャッシュに保存するエントリは取り込みながら作る (追加した曲の一覧は持たない)
+                cache_entries = [] if not from_cache and metadata_cache.max_rows > 0 else None
+                with trace.span('playlist_ingest') as attrs:
+                    added_count, ingest_completed = await self._ingest_playlist(batches, playlist_title, requester.id, initial_message, cache_entries)
+                    attrs['songs'] = added_count
+                player_kicked = added_count > 0
+                if cache_entries and ingest_completed:
+                    cache_keys = [cache_key]
+                    if data.get('id') and (data.get('extractor_key') or '').startswith('Youtube'): cache_keys.append('pl:' + data['id'])
+                    header = {k: data.get(k) for k in ('_type', 'id', 'title', 'extractor_key')}
+                    loop.run_in_executor(None, metadata_cache.put, cache_keys, dict(header, entries=cache_entries))
 
             else: # 単一 or 検索
                  # extract_flat=True の場合、単一動画でも title などが不足することがある
                  # process=False で取得した場合、再取得が必要
                  if data.get('_type') == 'url' or not data.get('title') or not data.get('duration'):
-                      self._logger.info(f"Guild {self.guild_id}: Re-fetching full info in executor for single entry...")
+                      self._logger.info("Guild %s: Re-fetching full info in executor for single entry...", self.guild_id)
                       await initial_message.edit(content=f"⏳ '{url_or_search}' 情報取得中...")
                       try:
-                          # extract_flat=False で詳細情報を取得
-                          fetched_data = await loop.run_in_executor(None, lambda: ytdl_stream.extract_info(url_or_search, download=False))
-                          if not fetched_data: raise yt_dlp.utils.DownloadError("Failed to fetch full info.")
-                          # 検索結果の場合、最初のものを採用
-                          if fetched_data.get('entries'):
-                              if not fetched_data['entries']: raise yt_dlp.utils.DownloadError("Search result empty.")
-                              data = fetched_data['entries'][0]
-                          else: data = fetched_data # 単一動画の詳細情報
-                      except yt_dlp.utils.DownloadError as dl_error:
-                           self._logger.warning(f"Guild {self.guild_id}: Failed re-fetch: {dl_error}")
+                          # extract_flat=False で詳細情報を取得 (検索結果の場合は最初のもの)
+                          started = time.monotonic()
+                          with trace.span('ytdl_stream', refetch=True):
+                              fetched_data = await run_extraction('full', url_or_search, guild_id=self.guild_id, priority=PRIORITY_INTERACTIVE)
+                          extraction_seconds.observe(time.monotonic() - started, 'metadata')
+                          if not fetched_data: raise ExtractionError("Failed to fetch full info.")
+                          data = fetched_data
+                          # 再生時に同じ抽出をやり直さないよう、ストリーム情報を曲情報に持たせる
+                          stream_info = data['stream']
+                          if stream_info: stream_cache.put(stream_info, url_or_search)
+                      except ExtractionError as dl_error:
+                           self._logger.warning("Guild %s: Failed re-fetch: %s", self.guild_id, dl_error)
                            await initial_message.edit(content=f"❌ 情報取得失敗: `{dl_error}`")
                            return 0
                       except Exception as e:
-                           self._logger.exception(f"Guild {self.guild_id}: Error during re-fetch: {e}")
+                           self._logger.exception("Guild %s: Error during re-fetch: %s", self.guild_id, e)
                            await initial_message.edit(content=f"❌ 情報取得中エラー: `{e}`")
                            return 0
 
-                 self._logger.info(f"Guild {self.guild_id}: Processing as single entry.")
+                 self._logger.info("Guild %s: Processing as single entry.", self.guild_id)
                  entry_title = data.get('title')
                  webpage_url = data.get('webpage_url') or data.get('original_url') or data.get('url')
                  duration = data.get('duration')
 
                  if webpage_url and entry_title and entry_title != '[Unavailable Video]' and entry_title != '[Deleted video]':
                      # キューには Member オブジェクトではなく ID を格納
-                     songs_to_add.append({'webpage_url': webpage_url,'title': entry_title,'requester': requester.id,'duration': duration})
+                     songs_to_add.append(QueueEntry(webpage_url, entry_title, requester.id, duration, stream_info))
                      added_count = 1
-                     self._logger.info(f"Guild {self.guild_id}: Identified single song: '{entry_title}'.")
+                     self._logger.info("Guild %s: Identified single song: '%s'.", self.guild_id, entry_title)
+                     if not from_cache:
+                         cache_keys = [cache_key]
+                         video_info = trim_video_info(data)
+                         if video_info['id'] and (video_info['extractor_key'] or '').startswith('Youtube'): cache_keys.append('v:' + video_info['id'])
+                         loop.run_in_executor(None, metadata_cache.put, cache_keys, video_info)
                      # 単一曲の場合は initial_message を削除しても良いかもしれないが、編集で完了を示す
                      # await initial_message.delete() # 削除する場合
                  else:
-                     self._logger.warning(f"Guild {self.guild_id}: Failed to get valid video data. Title: {entry_title}, URL: {webpage_url}")
+                     self._logger.warning("Guild %s: Failed to get valid video data. Title: %s, URL: %s", self.guild_id, entry_title, webpage_url)
                      errmsg = f"❌ 曲情報取得失敗。"
                      if not webpage_url: errmsg += " (URL不明)"
                      if not entry_title or entry_title == '[Unavailable Video]' or entry_title == '[Deleted video]': errmsg += " (タイトル/動画無効)"
@@ -448,58 +1994,125 @@ class GuildMusicState:
                      return 0
 
             # --- キューへの追加と通知 ---
-            if songs_to_add:
+            if songs_to_add: # 単一曲 (プレイリストは取り込みながら追加済み)
                 self.queue.extend(songs_to_add)
-                self._logger.info(f"Guild {self.guild_id}: Added {added_count} song(s) to queue. Queue size: {len(self.queue)}")
+                self.schedule_prefetch()
+            if added_count > 0:
+                self._logger.info("Guild %s: Added %s song(s) to queue. Queue size: %s", self.guild_id, added_count, len(self.queue))
                 final_message_content = ""
-                if is_playlist: final_message_content = f"✅ Playlist「{playlist_title}」から {added_count} 曲をキューに追加。"
-                else: final_message_content = f"✅ キュー追加: **{songs_to_add[0]['title']}** ({self.format_duration(songs_to_add[0]['duration'])})"
+                if is_playlist and not ingest_completed: final_message_content = f"⚠️ Playlist「{playlist_title}」の取り込みを中断しました ({added_count} 曲追加済み)。"
+                elif is_playlist: final_message_content = f"✅ Playlist「{playlist_title}」から {added_count} 曲をキューに追加。"
+                else: final_message_content = f"✅ キュー追加: **{songs_to_add[0].title}** ({self.format_duration(songs_to_add[0].duration)})"
                 try:
                      await initial_message.edit(content=final_message_content)
-                except discord.errors.NotFound: logger.warning(f"Guild {self.guild_id}: Failed to edit final confirmation (message deleted?).")
-                except Exception as e: logger.exception(f"Guild {self.guild_id}: Error editing final confirmation: {e}")
+                except discord.errors.NotFound: logger.warning("Guild %s: Failed to edit final confirmation (message deleted?).", self.guild_id)
+                except Exception as e: logger.exception("Guild %s: Error editing final confirmation: %s", self.guild_id, e)
             elif is_playlist: # プレイリストだが追加されなかった場合
-                 self._logger.warning(f"Guild {self.guild_id}: No valid songs added from playlist '{playlist_title}'.")
+                 self._logger.warning("Guild %s: No valid songs added from playlist '%s'.", self.guild_id, playlist_title)
                  final_message_content = f"⚠️ Playlist「{playlist_title}」から有効な曲を追加できませんでした。"
                  try:
                      await initial_message.edit(content=final_message_content)
                  except discord.errors.NotFound: pass
-                 except Exception as e: logger.exception(f"Guild {self.guild_id}: Error editing playlist empty confirmation: {e}")
+                 except Exception as e: logger.exception("Guild %s: Error editing playlist empty confirmation: %s", self.guild_id, e)
             else: # 単一曲でも追加されなかった場合 (上のエラー処理でメッセージは編集済のはず)
-                self._logger.warning(f"Guild {self.guild_id}: No songs were added for '{url_or_search}'.")
+                self._logger.warning("Guild %s: No songs were added for '%s'.", self.guild_id, url_or_search)
 
 
-        except yt_dlp.utils.DownloadError as e:
-             self._logger.warning(f"Guild {self.guild_id}: yt-dlp error adding to queue: {e}")
+        except ExtractionError as e:
+             self._logger.warning("Guild %s: yt-dlp error adding to queue: %s", self.guild_id, e)
              try:
                  if "Unsupported URL" in str(e): errmsg = f"❌ サポート外URL。"
                  elif "Unable to download webpage" in str(e): errmsg = f"❌ URLアクセス失敗。"
                  elif "Video unavailable" in str(e): errmsg = f"❌ 動画利用不可。"
                  else: errmsg = f"❌ 情報取得失敗: `{e}`"
                  await initial_message.edit(content=errmsg)
-             except Exception as e_inner: logger.exception(f"Guild {self.guild_id}: Error handling DownloadError: {e_inner}")
+             except Exception as e_inner: logger.exception("Guild %s: Error handling DownloadError: %s", self.guild_id, e_inner)
              return 0
         except Exception as e:
-             self._logger.exception(f"Guild {self.guild_id}: Unexpected error adding to queue: {e}")
+             self._logger.exception("Guild %s: Unexpected error adding to queue: %s", self.guild_id, e)
              try:
                  await initial_message.edit(content=f"予期せぬエラー発生: `{type(e).__name__}`。")
-             except Exception as e_inner: logger.exception(f"Guild {self.guild_id}: Error handling unexpected error: {e_inner}")
+             except Exception as e_inner: logger.exception("Guild %s: Error handling unexpected error: %s", self.guild_id, e_inner)
              return 0
+        finally:
+            if playlist_stream is not None: playlist_stream.close()
+            if added_count == 0 and not player_kicked:
+                self._first_audio_requested_at = None # 何も再生されないので計測しない
+                tracer.finish(trace, 'failed')
+            elif self.first_audio_trace is not trace:
+                tracer.finish(trace, 'queued') # 再生中の曲の後ろに入った
+
+        # --- 再生開始トリガー --- (プレイリストは最初の曲の追加時に済んでいる)
+        if added_count > 0 and not player_kicked:
+            self.start_playback_if_idle()
 
-        # --- 再生開始トリガー ---
-        if added_count > 0 and self.voice_client and self.voice_client.is_connected():
+        return added_count
+
+    async def _ingest_playlist(self, batches, playlist_title: str, requester_id: int, message: discord.WebhookMessage, cache_entries: list | None = None) -> tuple[int, bool]:
+        """プレイリストのエントリを届いた分から順にキューへ追加する
+        最初の曲が入った時点で再生を始め、進捗メッセージは PLAYLIST_PROGRESS_INTERVAL 秒ごとに更新する
+        cache_entries を渡すと、追加した曲をメタデータキャッシュ用の形にして追記する
+        (META_CACHE_PLAYLIST_MAX 曲を超えたら空にして追記をやめる = キャッシュしない)
+        途中でキューがクリアされたら打ち切る。(追加した曲数, 最後まで取り込んだか) を返す"""
+        added = 0
+        generation = self.queue.generation
+        last_edit = time.monotonic()
+        async for batch in batches:
+            if self.queue.generation != generation or guild_states.get(self.guild_id) is not self:
+                self._logger.info("Guild %s: Queue cleared during playlist ingestion. Stopping after %s songs.", self.guild_id, added)
+                return added, False
+            songs = [song for entry in batch if (song := self._playlist_entry_to_song(entry, requester_id)) is not None]
+            if not songs: continue
+            self.queue.extend(songs)
+            if cache_entries is not None:
+                if added + len(songs) > META_CACHE_PLAYLIST_MAX:
+                    cache_entries.clear()
+                    cache_entries = None
+                else:
+                    cache_entries.extend(song.to_flat_entry() for song in songs)
+            added += len(songs)
+            self.schedule_prefetch()
+            if added == len(songs): # 最初の曲が入ったらすぐ再生を始める
+                self._logger.info("Guild %s: First playlist entry queued, starting playback while ingesting.", self.guild_id)
+                self.start_playback_if_idle()
+            now = time.monotonic()
+            if now - last_edit >= PLAYLIST_PROGRESS_INTERVAL:
+                last_edit = now
+                try:
+                    await message.edit(content=f"⏳ Playlist「{playlist_title}」取り込み中... ({added}曲追加済み)")
+                except discord.errors.HTTPException as e:
+                    self._logger.debug("Guild %s: Failed to edit ingestion progress: %s", self.guild_id, e)
+        return added, True
+
+    def _playlist_entry_to_song(self, entry: dict, requester_id: int) -> QueueEntry | None:
+        """フラット取得したプレイリストのエントリをキューの曲にする (再生できないものは None)"""
+        if not entry: return None
+        entry_title = entry.get('title')
+        webpage_url = None
+        entry_id = entry.get('id')
+        # yt-dlpのextract_flatではURLがないことがあるので、IDから復元を試みる
+        if entry_id and entry.get('ie_key') == 'Youtube': webpage_url = f"https://www.youtube.com/watch?v={entry_id}"
+        else: webpage_url = entry.get('url') # フォールバック
+
+        if webpage_url and entry_title and entry_title != '[Unavailable Video]' and entry_title != '[Deleted video]':
+            # キューには Member オブジェクトではなく ID を格納する (再接続時の fetch 用)
+            return QueueEntry(webpage_url, entry_title, requester_id, entry.get('duration'))
+        self._logger.warning("Guild %s: Skipping invalid playlist entry (ID:'%s', Title:'%s', URL: %s)", self.guild_id, entry_id, entry_title, webpage_url)
+        return None
+
+    def start_playback_if_idle(self):
+        """プレーヤーがアイドル状態なら再生を開始/再開する (キューに曲を追加した後に呼ぶ)"""
+        if self.voice_client and self.voice_client.is_connected():
              # プレーヤーがアイドル状態の場合のみ再生を開始/再開
              if not self.voice_client.is_playing() and not self.voice_client.is_paused():
-                 self._logger.info(f"Guild {self.guild_id}: Player idle, triggering next song.")
+                 self._logger.info("Guild %s: Player idle, triggering next song.", self.guild_id)
                  # プレーヤータスクがなければ開始、あればイベントをセット
                  if self.audio_player_task is None or self.audio_player_task.done():
                      self.start_player_task()
                  else:
                      self.play_next_song.set() # audio_playerループを起こす
              else:
-                 self._logger.debug(f"Guild {self.guild_id}: Player is active, new song added to queue.")
-
-        return added_count
+                 self._logger.debug("Guild %s: Player is active, new song added to queue.", self.guild_id)
 
     @staticmethod
     def format_duration(seconds: float | int | None) -> str:
@@ -512,53 +2125,182 @@ class GuildMusicState:
         except (ValueError, TypeError): return "不明"
 
 
+# --- キューの保存と復元 ---
+QUEUE_SAVE_INTERVAL = float(os.getenv("QUEUE_SAVE_INTERVAL", "5")) # キューを保存する間隔 (秒, 0 で保存・復元しない)
+QUEUE_STORE_PATH = os.getenv("QUEUE_STORE_PATH", os.path.join(CACHE_DIR, 'queues.sqlite3'))
+RESUME_REWIND_SECONDS = 2.0 # 再開時に少し巻き戻す秒数 (保存間隔ぶんのずれを吸収)
+
+
+class QueueStore:
+    """サーバーごとのキュー・再生中の曲・再生位置を SQLite (WAL) に保存し、再起動後に復元する
+    書き込みは専用の1スレッドでまとめて行う。イベントループ側は変更のあったサーバーの曲リストの参照をコピーするだけ"""
+    _logger = logging.getLogger(__qualname__)
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='queue-store')
+        self._saved: dict[int, tuple | None] = {} # guild_id -> 最後に保存した (queue.version, 再生中の曲のURL)
+        self.flushes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path) # 書き込みスレッド専用
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL') # WAL では NORMAL でもクラッシュで壊れない
+            conn.execute('CREATE TABLE IF NOT EXISTS guild_queues (guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER, text_channel_id INTEGER, '
+                         'current TEXT, position REAL NOT NULL, entries TEXT NOT NULL, updated_at REAL NOT NULL)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _write(self, upserts: list, positions: list, deletes: list):
+        """書き込みスレッドで実行。1回の flush の変更を1トランザクションで書く"""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            for guild_id, voice_channel_id, text_channel_id, current, position, entries in upserts:
+                conn.execute('INSERT OR REPLACE INTO guild_queues VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (guild_id, voice_channel_id, text_channel_id, json.dumps(current, ensure_ascii=False) if current else None,
+                              position, json.dumps([entry.to_row() for entry in entries], ensure_ascii=False), now))
+            conn.executemany('UPDATE guild_queues SET voice_channel_id = ?, text_channel_id = ?, position = ?, updated_at = ? WHERE guild_id = ?',
+                             [(voice_channel_id, text_channel_id, position, now, guild_id) for guild_id, voice_channel_id, text_channel_id, position in positions])
+            conn.executemany('DELETE FROM guild_queues WHERE guild_id = ?', [(guild_id,) for guild_id in deletes])
+
+    def _load(self) -> dict[int, dict]:
+        conn = self._connect()
+        rows = conn.execute('SELECT guild_id, voice_channel_id, text_channel_id, current, position, entries FROM guild_queues').fetchall()
+        return {row[0]: {'voice_channel_id': row[1], 'text_channel_id': row[2], 'current': row[3], 'position': row[4], 'entries': row[5]} for row in rows}
+
+    async def load(self, include=None) -> dict[int, dict]:
+        """保存されているキューを読む (曲リストは JSON 文字列のまま。復元時に GuildMusicState.restore_snapshot で展開する)
+        include (guild_id -> bool) を渡すと、対象のサーバーだけを返す"""
+        try:
+            saved = await asyncio.get_running_loop().run_in_executor(self._writer, self._load)
+        except sqlite3.Error as e:
+            self._logger.error("Failed to load saved queues: %s", e)
+            return {}
+        if include is not None:
+            saved = {guild_id: row for guild_id, row in saved.items() if include(guild_id)}
+        for guild_id in saved:
+            self._saved.setdefault(guild_id, None) # 保存済み (内容は次の flush で書き直すか削除する)
+        return saved
+
+    async def flush(self, states: dict[int, 'GuildMusicState'], keep: set[int] = frozenset()):
+        """前回から変わったサーバーだけ保存する。キューが空になった/状態が消えたサーバーは削除 (keep に含まれるものは残す)"""
+        upserts, positions, deletes = [], [], []
+        for guild_id, state in list(states.items()):
+            if not state.queue and state.current_song is None:
+                if guild_id in self._saved:
+                    del self._saved[guild_id]
+                    deletes.append(guild_id)
+                continue
+            signature = (state.queue.version, state.current_song.url if state.current_song else None)
+            if self._saved.get(guild_id) != signature:
+                upserts.append((guild_id, *state.snapshot()))
+                self._saved[guild_id] = signature
+            elif state.current_song is not None: # 曲もキューも同じなら再生位置だけ更新
+                positions.append((guild_id, *state.playback_position()))
+        for guild_id in list(self._saved):
+            if guild_id not in states and guild_id not in keep:
+                del self._saved[guild_id]
+                deletes.append(guild_id)
+        if not (upserts or positions or deletes): return
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._writer, self._write, upserts, positions, deletes)
+            self.flushes += 1
+        except sqlite3.Error as e:
+            self._logger.error("Failed to save queues: %s", e)
+            for guild_id, *_ in upserts: self._saved.pop(guild_id, None) # 次回もう一度書く
+
+
+queue_store = QueueStore(QUEUE_STORE_PATH)
+pending_restores: dict[int, dict] = {} # 保存から読んだが、まだ GuildMusicState に戻していないキュー (guild_id -> 保存内容)
+
+
 # --- BOT本体 ---
 intents = discord.Intents.default()
 intents.voice_states = True
 intents.guilds = True
 intents.members = True # fetch_member を使うために追加推奨 (Privileged Gateway Intent)
 
-bot = discord.Bot(intents=intents)
+if SHARD_COUNT:
+    # シャードごとに Gateway 接続を分ける (このプロセスの担当分だけ接続する)
+    shard_ids = parse_shard_ids(SHARD_IDS)
+    if SHARD_COUNT == 'auto' and shard_ids:
+        logger.critical("エラー: SHARD_IDS を指定する場合は SHARD_COUNT に数値を設定してください。")
+        exit()
+    bot = discord.AutoShardedBot(intents=intents, shard_count=None if SHARD_COUNT == 'auto' else int(SHARD_COUNT), shard_ids=shard_ids)
+    logger.info("Sharding enabled. Shard count: %s, shard ids: %s", SHARD_COUNT, shard_ids if shard_ids else 'all')
+else:
+    bot = discord.Bot(intents=intents)
 
 guild_states: dict[int, GuildMusicState] = {}
 
 def get_guild_state(guild_id: int) -> GuildMusicState:
     if guild_id not in guild_states:
-        logger.info(f"Creating new GuildMusicState for Guild {guild_id}")
+        logger.info("Creating new GuildMusicState for Guild %s", guild_id)
         guild_states[guild_id] = GuildMusicState(asyncio.get_event_loop(), guild_id)
+        # 再起動前のキューが保存されていれば、最初に使われた時点で復元する
+        saved = pending_restores.pop(guild_id, None)
+        if saved: guild_states[guild_id].restore_snapshot(saved)
     return guild_states[guild_id]
 
 def remove_guild_state(guild_id: int):
     if guild_id in guild_states:
-        logger.info(f"Removing GuildMusicState for Guild {guild_id}")
+        logger.info("Removing GuildMusicState for Guild %s", guild_id)
         state = guild_states.pop(guild_id, None)
         if state:
+            # 先読み済みの曲と自動切断タイマーを破棄
+            state.clear_prefetch()
+            idle_scheduler.cancel(guild_id)
+            tracer.finish(state.first_audio_trace, 'stopped')
             # タスクのキャンセルを試みる
             if state.audio_player_task and not state.audio_player_task.done():
-                logger.info(f"Guild {guild_id}: Cancelling audio player task during state removal.")
+                logger.info("Guild %s: Cancelling audio player task during state removal.", guild_id)
                 state.audio_player_task.cancel()
             # VC切断は非同期で行う
             if state.voice_client and state.voice_client.is_connected():
-                 logger.info(f"Guild {guild_id}: Disconnecting VC during state removal.")
+                 logger.info("Guild %s: Disconnecting VC during state removal.", guild_id)
                  bot.loop.create_task(state.voice_client.disconnect(force=True)) # loop.create_taskで非同期実行
                  state.voice_client = None # 参照を切る
-        logger.info(f"Guild {guild_id}: GuildMusicState removed.")
+        logger.info("Guild %s: GuildMusicState removed.", guild_id)
 
 
 @bot.event
 async def on_ready():
-    logger.info(f'Logged in as {bot.user.name} ({bot.user.id})')
-    logger.info(f'Py-cord version: {discord.__version__}')
+    logger.info('Logged in as %s (%s)', bot.user.name, bot.user.id)
+    logger.info('Py-cord version: %s', discord.__version__)
+    if isinstance(bot, discord.AutoShardedBot):
+        logger.info('Shards: %s of %s, guilds: %s', sorted(bot.shards), bot.shard_count, len(bot.guilds))
     logger.info('Bot is ready and online.')
     logger.info('------')
-    # 起動時に古い状態が残らないようにクリア
+    # yt-dlp の下準備 (再接続で on_ready が再度呼ばれても一度だけ)
+    global extraction_warm_up_task
+    if EXTRACT_WARMUP == 'background' and extraction_warm_up_task is None:
+        extraction_warm_up_task = bot.loop.create_task(warm_up_extraction())
+    # ローカル音声キャッシュの読み込み (再接続で on_ready が再度呼ばれても一度だけ)
+    if not audio_cache.loaded:
+        audio_cache.loaded = True
+        await audio_cache.load()
+    if QUEUE_SAVE_INTERVAL > 0:
+        # 再接続の場合は、状態を捨てる前に最新のキューを保存しておく
+        if guild_states: await queue_store.flush(guild_states, set(pending_restores))
+        # 他のシャード (別プロセス) が担当するサーバーのキューは復元しない
+        pending_restores.update(await queue_store.load(lambda guild_id: bot.get_guild(guild_id) is not None))
+    # 起動時に古い状態が残らないようにクリア (キューは保存から復元する)
     guild_states.clear()
     logger.info("Cleared existing guild states on ready.")
+    if pending_restores:
+        logger.info("Found %s saved queues. Restoring guilds with listeners.", len(pending_restores))
+        bot.loop.create_task(restore_guilds())
 
 # --- スラッシュコマンド定義 ---
 @bot.slash_command(name="play", description="YouTubeの動画やプレイリストを再生します (URL or 検索ワード)")
 async def play(ctx: discord.ApplicationContext, query: str):
-    logger.info(f"Guild {ctx.guild_id}: /play invoked by {ctx.author} with query: '{query}'")
+    trace = tracer.start(ctx.guild_id, query)
+    logger.info("Guild %s: /play invoked by %s with query: '%s' (trace %s)", ctx.guild_id, ctx.author, query, trace.trace_id)
     if not ctx.author.voice:
         await ctx.respond("VCに参加してください。", ephemeral=True)
         return
@@ -570,76 +2312,85 @@ async def play(ctx: discord.ApplicationContext, query: str):
     guild_state.update_last_channel(ctx.channel_id)
     voice_channel = ctx.author.voice.channel
 
-    await ctx.defer() # 長時間かかる可能性があるのでまずdefer
+    with trace.span('defer'):
+        await ctx.defer() # 長時間かかる可能性があるのでまずdefer
 
     try:
         if guild_state.voice_client is None or not guild_state.voice_client.is_connected():
-            logger.info(f"Guild {ctx.guild_id}: Connecting to VC: {voice_channel.name}")
-            guild_state.voice_client = await voice_channel.connect(timeout=15.0)
-            logger.info(f"Guild {ctx.guild_id}: Connected.")
+            logger.info("Guild %s: Connecting to VC: %s", ctx.guild_id, voice_channel.name)
+            with trace.span('voice_connect'):
+                guild_state.voice_client = await voice_channel.connect(timeout=15.0)
+            logger.info("Guild %s: Connected.", ctx.guild_id)
         elif guild_state.voice_client.channel != voice_channel:
-             logger.info(f"Guild {ctx.guild_id}: Moving to VC: {voice_channel.name}")
+             logger.info("Guild %s: Moving to VC: %s", ctx.guild_id, voice_channel.name)
              # 移動前に再生を停止する必要がある場合がある
              if guild_state.voice_client.is_playing() or guild_state.voice_client.is_paused():
                  guild_state.voice_client.stop()
-             await guild_state.voice_client.move_to(voice_channel)
-             logger.info(f"Guild {ctx.guild_id}: Moved.")
+             with trace.span('voice_move'):
+                 await guild_state.voice_client.move_to(voice_channel)
+             logger.info("Guild %s: Moved.", ctx.guild_id)
              # followupで応答 (defer済のため)
              await ctx.followup.send(f"{voice_channel.name} に移動。", ephemeral=True, delete_after=10)
     except asyncio.TimeoutError:
-         logger.error(f"Guild {ctx.guild_id}: Timeout connecting/moving.")
+         logger.error("Guild %s: Timeout connecting/moving.", ctx.guild_id)
+         tracer.finish(trace, 'connect_timeout')
          await ctx.followup.send(f"接続/移動タイムアウト。", ephemeral=True)
          # 接続失敗時は状態を削除
          if not guild_state.voice_client or not guild_state.voice_client.is_connected():
              remove_guild_state(ctx.guild_id)
          return
     except discord.errors.ClientException as e:
-         logger.error(f"Guild {ctx.guild_id}: ClientException during connect/move: {e}")
+         logger.error("Guild %s: ClientException during connect/move: %s", ctx.guild_id, e)
          # すでに接続済みだがチャンネルが違う場合など
          if "Already connected" in str(e) and guild_state.voice_client and guild_state.voice_client.channel != voice_channel:
-              logger.warning(f"Guild {ctx.guild_id}: Already connected mismatch? Force disconnect and retry.")
+              logger.warning("Guild %s: Already connected mismatch? Force disconnect and retry.", ctx.guild_id)
               await guild_state.voice_client.disconnect(force=True)
               guild_state.voice_client = None # voice_clientをリセット
               try: # 再接続を試みる
                  guild_state.voice_client = await voice_channel.connect(timeout=15.0)
-                 logger.info(f"Guild {ctx.guild_id}: Reconnected after mismatch.")
+                 logger.info("Guild %s: Reconnected after mismatch.", ctx.guild_id)
               except Exception as recon_e:
-                 logger.error(f"Guild {ctx.guild_id}: Failed to reconnect after mismatch: {recon_e}")
+                 logger.error("Guild %s: Failed to reconnect after mismatch: %s", ctx.guild_id, recon_e)
+                 tracer.finish(trace, 'connect_failed')
                  await ctx.followup.send("接続状態リセット失敗。再試行してください。", ephemeral=True)
                  remove_guild_state(ctx.guild_id)
                  return
          elif "Already connecting" in str(e):
+             tracer.finish(trace, 'connect_failed')
              await ctx.followup.send("接続処理中です。少し待ってから再試行してください。", ephemeral=True)
              return
          else:
+             tracer.finish(trace, 'connect_failed')
              await ctx.followup.send(f"接続エラー: {e}", ephemeral=True)
              # 不明な ClientException の場合も状態をクリーンアップ
              remove_guild_state(ctx.guild_id)
              return
     except Exception as e:
-        logger.exception(f"Guild {ctx.guild_id}: Failed connect/move: {e}")
+        logger.exception("Guild %s: Failed connect/move: %s", ctx.guild_id, e)
+        tracer.finish(trace, 'connect_failed')
         await ctx.followup.send(f"接続/移動失敗: {e}", ephemeral=True)
         remove_guild_state(ctx.guild_id) # 失敗したら状態削除
         return
 
     # キュー追加処理 (defer済なので ctx.followup を内部で使用)
-    await guild_state.add_to_queue(query, ctx.author, ctx)
+    await guild_state.add_to_queue(query, ctx.author, ctx, trace=trace)
 
 @bot.slash_command(name="stop", description="再生を停止し、BOTがVCから切断します")
 async def stop(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /stop invoked by {ctx.author}")
+    logger.info("Guild %s: /stop invoked by %s", ctx.guild_id, ctx.author)
     guild_state = guild_states.get(ctx.guild_id)
     if guild_state and guild_state.voice_client and guild_state.voice_client.is_connected():
         guild_state.update_last_channel(ctx.channel_id)
-        logger.info(f"Guild {ctx.guild_id}: Stopping playback and disconnecting.")
+        logger.info("Guild %s: Stopping playback and disconnecting.", ctx.guild_id)
         # キューと現在の曲情報をクリア
         guild_state.queue.clear()
+        guild_state.clear_prefetch()
         guild_state.current_song = None
         guild_state.playback_start_time = None
         # オーディオプレーヤータスクをキャンセル
         if guild_state.audio_player_task and not guild_state.audio_player_task.done():
             guild_state.audio_player_task.cancel()
-            logger.debug(f"Guild {ctx.guild_id}: Cancelled audio player task.")
+            logger.debug("Guild %s: Cancelled audio player task.", ctx.guild_id)
         # VCの再生を停止し、切断
         guild_state.voice_client.stop()
         await guild_state.voice_client.disconnect(force=True)
@@ -654,18 +2405,18 @@ async def stop(ctx: discord.ApplicationContext):
 
 @bot.slash_command(name="skip", description="現在の曲をスキップします")
 async def skip(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /skip invoked by {ctx.author}")
+    logger.info("Guild %s: /skip invoked by %s", ctx.guild_id, ctx.author)
     if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です。", ephemeral=True); return
     guild_state = get_guild_state(ctx.guild_id) # state がなければ作成
     guild_state.update_last_channel(ctx.channel_id)
 
     if guild_state.voice_client and guild_state.voice_client.is_connected():
         if guild_state.voice_client.is_playing() or guild_state.current_song: # 再生中か、再生準備完了状態
-            logger.info(f"Guild {ctx.guild_id}: Skipping current song.")
+            logger.info("Guild %s: Skipping current song.", ctx.guild_id)
             guild_state.voice_client.stop() # after コールバックが呼ばれ、play_next_songがセットされる
             await ctx.respond("⏭️ スキップ。")
         elif guild_state.queue: # プレーヤーはアイドルだがキューに曲がある場合
-             logger.info(f"Guild {ctx.guild_id}: Player idle, but queue has songs. Forcing next.")
+             logger.info("Guild %s: Player idle, but queue has songs. Forcing next.", ctx.guild_id)
              # audio_player が wait 状態の場合、イベントをセットして起こす
              guild_state.play_next_song.set()
              # audio_playerタスクが存在しないか終了している場合は開始する
@@ -678,7 +2429,7 @@ async def skip(ctx: discord.ApplicationContext):
 
 @bot.slash_command(name="pause", description="再生を一時停止します")
 async def pause(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /pause invoked by {ctx.author}")
+    logger.info("Guild %s: /pause invoked by %s", ctx.guild_id, ctx.author)
     if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です。", ephemeral=True); return
     guild_state = get_guild_state(ctx.guild_id)
     guild_state.update_last_channel(ctx.channel_id)
@@ -693,7 +2444,7 @@ async def pause(ctx: discord.ApplicationContext):
 
 @bot.slash_command(name="resume", description="再生を再開します")
 async def resume(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /resume invoked by {ctx.author}")
+    logger.info("Guild %s: /resume invoked by %s", ctx.guild_id, ctx.author)
     if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です.", ephemeral=True); return
     guild_state = get_guild_state(ctx.guild_id)
     guild_state.update_last_channel(ctx.channel_id)
@@ -706,23 +2457,13 @@ async def resume(ctx: discord.ApplicationContext):
     else:
         await ctx.respond("一時停止していません。", ephemeral=True)
 
-@bot.slash_command(name="queue", description="現在の再生キューを表示します")
-async def queue_cmd(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /queue invoked by {ctx.author}")
-    if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です.", ephemeral=True); return
-    guild_state = get_guild_state(ctx.guild_id)
-    guild_state.update_last_channel(ctx.channel_id)
-
-    queue_list = list(guild_state.queue) # dequeをリストに変換
-
-    if not guild_state.current_song and not queue_list:
-        await ctx.respond("キューは空です。", ephemeral=True)
-        return
-
+def build_queue_embed(guild_state: GuildMusicState, page: int, viewer: discord.abc.User) -> discord.Embed:
+    """/queue の page ページ目 (0始まり) の Embed を作る。曲一覧はキャッシュ済みのテキストを使う"""
     embed = discord.Embed(title="再生キュー", color=discord.Color.blue())
-    footer_text = f"Req by {ctx.author.display_name}"
-    if ctx.author.display_avatar:
-        embed.set_footer(text=footer_text, icon_url=ctx.author.display_avatar.url)
+    page_count = guild_state.queue_page_count()
+    footer_text = f"ページ {page + 1}/{page_count} | Req by {viewer.display_name}"
+    if viewer.display_avatar:
+        embed.set_footer(text=footer_text, icon_url=viewer.display_avatar.url)
     else:
         embed.set_footer(text=footer_text)
 
@@ -742,42 +2483,87 @@ async def queue_cmd(ctx: discord.ApplicationContext):
          if len(value) > 1024: value = value[:1021] + "..." # Embed Field Value Limit
          embed.add_field(name="🎵 現在再生中", value=value, inline=False)
 
-    # キューの内容を表示
-    if queue_list:
-        queue_text = ""
-        max_queue_display = 10
-        total_songs = len(queue_list)
-        # キュー内の曲の合計時間を計算
-        total_duration_seconds = sum(s.get('duration', 0) for s in queue_list if s.get('duration') is not None and isinstance(s['duration'], (int, float)))
-
-        # キューの先頭から表示
-        for i, song_info in enumerate(queue_list[:max_queue_display]):
-            duration_str = guild_state.format_duration(song_info.get('duration'))
-            # キュー内のリクエスタIDからメンションを作成 (fetchはしない)
-            req_mention = f"<@{song_info['requester']}>" if song_info.get('requester') else '不明'
-
-            entry_text = f"{i+1}. [{song_info['title']}]({song_info['webpage_url']}) ({duration_str}) Req: {req_mention}\n"
-            # Embed Field Value Limit (1024) を超えないようにチェック
-            if len(queue_text) + len(entry_text) > 1024:
-                remaining_count = total_songs - i
-                queue_text += f"\n...他{remaining_count}曲"
-                break
-            queue_text += entry_text
-        else: # ループが break せずに終わった場合 (表示上限以下)
-             if total_songs > max_queue_display:
-                 queue_text += f"\n...他{total_songs - max_queue_display}曲"
-
+    # キューの内容を表示 (曲一覧は Embed の description に入れる。上限 4096 文字)
+    if guild_state.queue:
+        total_songs = len(guild_state.queue)
+        # キュー内の曲の合計時間 (キュー側で集計済み)
+        total_duration_seconds = guild_state.queue.total_duration
         total_duration_str = guild_state.format_duration(total_duration_seconds) if total_duration_seconds > 0 else "不明"
-        embed.add_field(name=f"🗒️ 次の曲 ({total_songs} 曲, 合計: {total_duration_str})", value=queue_text if queue_text else "キューは空です。", inline=False)
-
-    elif guild_state.current_song: # 再生中だがキューは空の場合
+        unknown_count = guild_state.queue.unknown_duration_count
+        if unknown_count and total_duration_seconds > 0: total_duration_str += f" + 不明{unknown_count}曲"
+        queue_text = guild_state.queue_page_text(page)
+        if len(queue_text) > 4000: queue_text = queue_text[:3997] + "..."
+        embed.description = f"**🗒️ 次の曲 ({total_songs} 曲, 合計: {total_duration_str})**\n{queue_text}"
+        # リクエストした人ごとの曲数 (上位3人)
+        top_requesters = guild_state.queue.requester_counts.most_common(3)
+        if len(guild_state.queue.requester_counts) > 1:
+            embed.add_field(name="👥 リクエスト", value=" / ".join(f"<@{user_id}>: {count}曲" for user_id, count in top_requesters), inline=False)
+    else:
         embed.add_field(name="🗒️ 次の曲", value="キューは空です。", inline=False)
+    return embed
 
-    await ctx.respond(embed=embed)
+
+class QueueView(discord.ui.View):
+    """/queue のページ送りボタン。押されるたびに同じメッセージを編集してページを切り替える"""
+
+    def __init__(self, guild_id: int, viewer: discord.abc.User, page: int = 0):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT, disable_on_timeout=True)
+        self.guild_id = guild_id
+        self.viewer = viewer
+        self.page = page
+        self._update_buttons(get_guild_state(guild_id))
+
+    def _update_buttons(self, guild_state: GuildMusicState):
+        last_page = guild_state.queue_page_count() - 1
+        self.page = max(0, min(self.page, last_page)) # 曲が減ってページが無くなった場合
+        self.first_button.disabled = self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.last_button.disabled = self.page == last_page
+
+    async def _show(self, interaction: discord.Interaction, page: int | None):
+        """page のページを表示する (None なら最後のページ)"""
+        guild_state = guild_states.get(self.guild_id) # ボタンを押しただけで状態を作り直さない
+        if guild_state is None: # /stop や切断で状態ごと消えた
+            self.disable_all_items()
+            self.stop()
+            await interaction.response.edit_message(content="キューはもうありません。", embed=None, view=self)
+            return
+        self.page = guild_state.queue_page_count() - 1 if page is None else page
+        self._update_buttons(guild_state)
+        await interaction.response.edit_message(embed=build_queue_embed(guild_state, self.page, self.viewer), view=self)
+
+    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.secondary)
+    async def first_button(self, button: discord.ui.Button, interaction: discord.Interaction):
+        await self._show(interaction, 0)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.primary)
+    async def prev_button(self, button: discord.ui.Button, interaction: discord.Interaction):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.primary)
+    async def next_button(self, button: discord.ui.Button, interaction: discord.Interaction):
+        await self._show(interaction, self.page + 1)
+
+    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary)
+    async def last_button(self, button: discord.ui.Button, interaction: discord.Interaction):
+        await self._show(interaction, None)
+
+@bot.slash_command(name="queue", description="現在の再生キューを表示します")
+async def queue_cmd(ctx: discord.ApplicationContext):
+    logger.info("Guild %s: /queue invoked by %s", ctx.guild_id, ctx.author)
+    if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です.", ephemeral=True); return
+    guild_state = get_guild_state(ctx.guild_id)
+    guild_state.update_last_channel(ctx.channel_id)
+
+    if not guild_state.current_song and not guild_state.queue:
+        await ctx.respond("キューは空です。", ephemeral=True)
+        return
+
+    view = QueueView(ctx.guild_id, ctx.author)
+    await ctx.respond(embed=build_queue_embed(guild_state, 0, ctx.author), view=view)
 
 @bot.slash_command(name="leave", description="BOTがボイスチャンネルから切断します (キューは保持)")
 async def leave(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /leave invoked by {ctx.author}")
+    logger.info("Guild %s: /leave invoked by %s", ctx.guild_id, ctx.author)
     if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です.", ephemeral=True); return
     guild_state = guild_states.get(ctx.guild_id)
 
@@ -787,37 +2573,37 @@ async def leave(ctx: discord.ApplicationContext):
 
     guild_state.update_last_channel(ctx.channel_id)
     if guild_state.voice_client and guild_state.voice_client.is_connected():
-        logger.info(f"Guild {ctx.guild_id}: Disconnecting VC (leave command).")
+        logger.info("Guild %s: Disconnecting VC (leave command).", ctx.guild_id)
         # 再生中の場合は停止
         if guild_state.voice_client.is_playing() or guild_state.voice_client.is_paused():
              guild_state.voice_client.stop()
              # プレーヤータスクもキャンセルする
              if guild_state.audio_player_task and not guild_state.audio_player_task.done():
                  guild_state.audio_player_task.cancel()
-                 logger.debug(f"Guild {ctx.guild_id}: Cancelled audio player task on leave.")
+                 logger.debug("Guild %s: Cancelled audio player task on leave.", ctx.guild_id)
         # 現在再生中の情報をクリア (キューは保持)
         guild_state.current_song = None
         guild_state.playback_start_time = None
         # VCから切断
         await guild_state.voice_client.disconnect(force=True)
         guild_state.voice_client = None # voice_clientオブジェクトへの参照をクリア
-        logger.info(f"Guild {ctx.guild_id}: Disconnected from VC. Guild state (queue) kept.")
+        logger.info("Guild %s: Disconnected from VC. Guild state (queue) kept.", ctx.guild_id)
         await ctx.respond("👋 ボイスチャンネルから切断しました (キューは保持されています)。")
     else: # stateはあるがVCに接続していない場合
         await ctx.respond("BOTはどのボイスチャンネルにも接続していません。", ephemeral=True)
         # voice_client が None になっているか確認し、なっていなければ None にする
         if guild_state.voice_client is not None:
             guild_state.voice_client = None
-            logger.warning(f"Guild {ctx.guild_id}: Found non-None voice_client despite not being connected. Resetting.")
+            logger.warning("Guild %s: Found non-None voice_client despite not being connected. Resetting.", ctx.guild_id)
 
 @bot.slash_command(name="nowplaying", description="現在再生中の曲情報を表示します")
 async def nowplaying(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /nowplaying invoked by {ctx.author}")
+    logger.info("Guild %s: /nowplaying invoked by %s", ctx.guild_id, ctx.author)
     await now_playing_impl(ctx)
 
 @bot.slash_command(name="np", description="現在再生中の曲情報を表示します (nowplayingのエイリアス)")
 async def np(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /np invoked by {ctx.author}")
+    logger.info("Guild %s: /np invoked by %s", ctx.guild_id, ctx.author)
     await now_playing_impl(ctx)
 
 # /np と /nowplaying の共通処理
@@ -865,7 +2651,7 @@ async def now_playing_impl(ctx: discord.ApplicationContext):
 
 @bot.slash_command(name="remove", description="キューから指定した番号の曲を削除します")
 async def remove(ctx: discord.ApplicationContext, number: discord.Option(int, "削除するキューの番号", min_value=1)):
-    logger.info(f"Guild {ctx.guild_id}: /remove {number} invoked by {ctx.author}")
+    logger.info("Guild %s: /remove %s invoked by %s", ctx.guild_id, number, ctx.author)
     if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です.", ephemeral=True); return
     guild_state = get_guild_state(ctx.guild_id)
     guild_state.update_last_channel(ctx.channel_id)
@@ -881,24 +2667,93 @@ async def remove(ctx: discord.ApplicationContext, number: discord.Option(int, "
         return
 
     try:
-        # deque は直接インデックスで pop できないのでリストに変換して操作
-        queue_list = list(guild_state.queue)
-        removed_song = queue_list.pop(index_to_remove) # 指定インデックスの要素を削除＆取得
-        guild_state.queue = deque(queue_list) # dequeに戻す
+        removed_song = guild_state.queue.pop(index_to_remove) # 指定インデックスの要素を削除＆取得
+        guild_state.schedule_prefetch() # 先頭が変わった場合は先読みし直す
 
-        logger.info(f"Guild {ctx.guild_id}: Removed '{removed_song['title']}' from queue at position {number}.")
-        await ctx.respond(f"✅ キューの{number}番目の曲「{removed_song['title']}」を削除しました。")
+        logger.info("Guild %s: Removed '%s' from queue at position %s.", ctx.guild_id, removed_song.title, number)
+        await ctx.respond(f"✅ キューの{number}番目の曲「{removed_song.title}」を削除しました。")
     except IndexError:
         # これは上記の範囲チェックで防げるはずだが念のため
-        logger.error(f"Guild {ctx.guild_id}: IndexError during remove despite check. Index: {index_to_remove}, QueueLen: {queue_len}")
+        logger.error("Guild %s: IndexError during remove despite check. Index: %s, QueueLen: %s", ctx.guild_id, index_to_remove, queue_len)
         await ctx.respond(f"番号{number}の曲が見つかりませんでした（内部エラー）。", ephemeral=True)
     except Exception as e:
-        logger.exception(f"Guild {ctx.guild_id}: Error removing song from queue: {e}")
+        logger.exception("Guild %s: Error removing song from queue: %s", ctx.guild_id, e)
         await ctx.respond(f"キューからの削除中にエラーが発生しました: {e}", ephemeral=True)
 
+@bot.slash_command(name="move", description="キュー内の曲の順番を移動します")
+async def move(ctx: discord.ApplicationContext,
+               source: discord.Option(int, "移動する曲の番号", min_value=1),
+               target: discord.Option(int, "移動先の番号", min_value=1)):
+    logger.info("Guild %s: /move %s %s invoked by %s", ctx.guild_id, source, target, ctx.author)
+    if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です.", ephemeral=True); return
+    guild_state = get_guild_state(ctx.guild_id)
+    guild_state.update_last_channel(ctx.channel_id)
+
+    queue_len = len(guild_state.queue)
+    if queue_len == 0:
+        await ctx.respond("キューは空です。", ephemeral=True)
+        return
+    if not (source <= queue_len and target <= queue_len):
+        await ctx.respond(f"無効な番号です。1から{queue_len}の間で指定してください。", ephemeral=True)
+        return
+
+    moved_song = guild_state.queue.move(source - 1, target - 1)
+    guild_state.schedule_prefetch() # 先頭が変わった場合は先読みし直す
+    logger.info("Guild %s: Moved '%s' from %s to %s.", ctx.guild_id, moved_song.title, source, target)
+    await ctx.respond(f"↕️ 「{moved_song.title}」を{source}番目から{target}番目に移動しました。")
+
+@bot.slash_command(name="removerange", description="キューから指定した範囲の曲をまとめて削除します")
+async def removerange(ctx: discord.ApplicationContext,
+                      start: discord.Option(int, "削除する最初の番号", min_value=1),
+                      end: discord.Option(int, "削除する最後の番号", min_value=1)):
+    logger.info("Guild %s: /removerange %s %s invoked by %s", ctx.guild_id, start, end, ctx.author)
+    if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です.", ephemeral=True); return
+    guild_state = get_guild_state(ctx.guild_id)
+    guild_state.update_last_channel(ctx.channel_id)
+
+    queue_len = len(guild_state.queue)
+    if queue_len == 0:
+        await ctx.respond("キューは空です。", ephemeral=True)
+        return
+    if not (start <= end <= queue_len):
+        await ctx.respond(f"無効な範囲です。1 ≦ 開始 ≦ 終了 ≦ {queue_len} で指定してください。", ephemeral=True)
+        return
+
+    removed = guild_state.queue.remove_range(start - 1, end)
+    guild_state.schedule_prefetch()
+    logger.info("Guild %s: Removed %s songs from queue (positions %s-%s).", ctx.guild_id, len(removed), start, end)
+    await ctx.respond(f"✅ キューの{start}〜{end}番目 ({len(removed)} 曲) を削除しました。")
+
+@bot.slash_command(name="skipto", description="キューの指定した番号の曲までスキップします")
+async def skipto(ctx: discord.ApplicationContext, number: discord.Option(int, "次に再生する曲の番号", min_value=1)):
+    logger.info("Guild %s: /skipto %s invoked by %s", ctx.guild_id, number, ctx.author)
+    if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です。", ephemeral=True); return
+    guild_state = get_guild_state(ctx.guild_id)
+    guild_state.update_last_channel(ctx.channel_id)
+
+    if not (guild_state.voice_client and guild_state.voice_client.is_connected()):
+        await ctx.respond("BOTがボイスチャンネルに接続していません。", ephemeral=True)
+        return
+    queue_len = len(guild_state.queue)
+    if not (number <= queue_len):
+        await ctx.respond(f"無効な番号です。1から{queue_len}の間で指定してください。" if queue_len else "キューは空です。", ephemeral=True)
+        return
+
+    # 指定した曲の手前までをまとめて削除してから、現在の曲をスキップする
+    skipped = guild_state.queue.remove_range(0, number - 1)
+    guild_state.schedule_prefetch()
+    next_title = guild_state.queue[0].title
+    logger.info("Guild %s: Skipping to '%s' (%s queued songs dropped).", ctx.guild_id, next_title, len(skipped))
+    if guild_state.voice_client.is_playing() or guild_state.voice_client.is_paused():
+        guild_state.voice_client.stop() # after コールバックで次の曲へ
+    else:
+        guild_state.play_next_song.set()
+        guild_state.start_player_task()
+    await ctx.respond(f"⏭️ 「{next_title}」までスキップします ({len(skipped)} 曲を飛ばしました)。")
+
 @bot.slash_command(name="clearqueue", description="再生中の曲を除き、キューを空にします")
 async def clearqueue(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /clearqueue invoked by {ctx.author}")
+    logger.info("Guild %s: /clearqueue invoked by %s", ctx.guild_id, ctx.author)
     if not ctx.guild: await ctx.respond("サーバー内でのみ使用可能です.", ephemeral=True); return
     guild_state = get_guild_state(ctx.guild_id)
     guild_state.update_last_channel(ctx.channel_id)
@@ -909,12 +2764,13 @@ async def clearqueue(ctx: discord.ApplicationContext):
         return
 
     guild_state.queue.clear()
-    logger.info(f"Guild {ctx.guild_id}: Queue cleared ({queue_len} songs removed).")
+    guild_state.clear_prefetch()
+    logger.info("Guild %s: Queue cleared (%s songs removed).", ctx.guild_id, queue_len)
     await ctx.respond(f"🧹 キューを空にしました ({queue_len} 曲削除)。")
 
 @bot.slash_command(name="help", description="利用可能なコマンドの一覧を表示します")
 async def help_command(ctx: discord.ApplicationContext):
-    logger.info(f"Guild {ctx.guild_id}: /help invoked by {ctx.author}")
+    logger.info("Guild %s: /help invoked by %s", ctx.guild_id, ctx.author)
     embed = discord.Embed(title="🎶 再生BOT ヘルプ", description="スラッシュコマンド一覧:", color=discord.Color.purple())
     if bot.user and bot.user.avatar:
         embed.set_thumbnail(url=bot.user.avatar.url)
@@ -927,15 +2783,61 @@ async def help_command(ctx: discord.ApplicationContext):
     embed.add_field(name="`/skip`", value="現在再生中の曲をスキップします。", inline=False)
     embed.add_field(name="`/pause`", value="再生を一時停止します。", inline=False)
     embed.add_field(name="`/resume`", value="一時停止中の再生を再開します。", inline=False)
-    embed.add_field(name="`/queue`", value="現在の再生キューを表示します。", inline=False)
+    embed.add_field(name="`/queue`", value="現在の再生キューを表示します (ボタンでページ切り替え)。", inline=False)
     embed.add_field(name="`/nowplaying` (または `/np`)", value="現在再生中の曲の詳細情報を表示します。", inline=False)
     embed.add_field(name="`/remove <番号>`", value="キューから指定された番号の曲を削除します。", inline=False)
+    embed.add_field(name="`/move <番号> <移動先>`", value="キュー内の曲の順番を入れ替えます。", inline=False)
+    embed.add_field(name="`/removerange <開始> <終了>`", value="キューから指定した範囲の曲をまとめて削除します。", inline=False)
+    embed.add_field(name="`/skipto <番号>`", value="キューの指定した番号の曲まで飛ばして再生します。", inline=False)
     embed.add_field(name="`/clearqueue`", value="再生中の曲を除き、キューをすべて削除します。", inline=False)
     embed.add_field(name="`/leave`", value="VCから切断します（キューは保持されます）。", inline=False)
     embed.add_field(name="`/help`", value="このヘルプメッセージを表示します。", inline=False)
+    embed.add_field(name="`/traces [件数]`", value="(管理者向け) 最近の `/play` で音が出るまでにかかった時間の内訳を表示します。", inline=False)
 
     await ctx.respond(embed=embed, ephemeral=False) # ヘルプは通常表示
 
+TRACE_STATUS_ICONS = {'playing': '✅', 'queued': '📥', 'failed': '❌', 'error': '⚠️', 'no_audio': '⚠️', 'stopped': '⏹️', 'disconnected': '🔌'}
+
+
+def format_trace_summary(traces: list[Trace]) -> str:
+    """/traces の表示用テキスト (1トレース2行 + 区間ごとの中央値)"""
+    lines = []
+    for trace in traces:
+        icon = TRACE_STATUS_ICONS.get(trace.status, '❔')
+        query = trace.query if len(trace.query) <= 40 else trace.query[:39] + "…"
+        age = GuildMusicState.format_duration(time.time() - trace.started_at)
+        lines.append(f"{icon} `{trace.trace_id}` **{trace.duration:.2f}s** {trace.status} ({age}前) {query}")
+        spans = " · ".join(f"{name} {seconds:.2f}" for name, seconds in trace.span_totals().items())
+        lines.append(f"　└ {spans or '(区間なし)'}")
+    # 音が出るまで進んだトレースだけで、区間ごとの中央値を出す
+    played = [trace for trace in traces if trace.status == 'playing']
+    if played:
+        medians = []
+        for name in dict.fromkeys(name for trace in played for name in trace.span_totals()):
+            values = sorted(trace.span_totals().get(name, 0.0) for trace in played)
+            medians.append(f"{name} {values[len(values) // 2]:.2f}")
+        totals = sorted(trace.duration for trace in played)
+        lines.append(f"\n**中央値 ({len(played)}件)**: 合計 {totals[len(totals) // 2]:.2f}s\n{' · '.join(medians)}")
+    return "\n".join(lines)
+
+
+@bot.slash_command(name="traces", description="(管理者向け) 最近の /play の処理時間の内訳を表示します",
+                   default_member_permissions=discord.Permissions(administrator=True))
+async def traces_cmd(ctx: discord.ApplicationContext,
+                     count: discord.Option(int, "表示する件数", min_value=1, max_value=20, default=10)):
+    logger.info("Guild %s: /traces invoked by %s", ctx.guild_id, ctx.author)
+    if not tracer.enabled:
+        await ctx.respond("トレースは無効です (TRACE_HISTORY=0)。", ephemeral=True)
+        return
+    traces = tracer.recent(ctx.guild_id, count)
+    if not traces:
+        await ctx.respond("まだトレースがありません。", ephemeral=True)
+        return
+    text = format_trace_summary(traces)
+    if len(text) > 4000: text = text[:3999] + "…"
+    embed = discord.Embed(title=f"⏱️ 最近の /play ({len(traces)} 件, 秒)", description=text, color=discord.Color.dark_grey())
+    await ctx.respond(embed=embed, ephemeral=True)
+
 # --- エラーハンドリング ---
 @bot.event
 async def on_application_command_error(ctx: discord.ApplicationContext, error: discord.DiscordException):
@@ -945,11 +2847,11 @@ async def on_application_command_error(ctx: discord.ApplicationContext, error: d
 
     # エラーの種類によってログレベルやメッセージを調整
     if isinstance(error, discord.errors.CheckFailure):
-        logger.warning(f"Cmd CheckFail '{ctx.command.name}' by {ctx.author} G:{ctx.guild_id}: {error}")
+        logger.warning("Cmd CheckFail '%s' by %s G:%s: %s", ctx.command.name, ctx.author, ctx.guild_id, error)
         await responder("コマンド実行に必要な権限がありません。", ephemeral=ephemeral)
     elif isinstance(error, discord.errors.NotFound) and "Interaction" in str(error):
          # インタラクションがタイムアウトしたか、見つからない場合
-         logger.warning(f"Guild {ctx.guild_id}: Interaction timed out or not found for command '{ctx.command.name}'.")
+         logger.warning("Guild %s: Interaction timed out or not found for command '%s'.", ctx.guild_id, ctx.command.name)
          # response.is_done() が False の場合でも NotFound が発生しうる (e.g., defer 前にタイムアウト)
          # 応答しようとするとさらにエラーになる可能性があるので、ここでは応答しない方が安全かもしれない
          # try: await responder("インタラクションの応答に失敗しました。", ephemeral=ephemeral)
@@ -957,10 +2859,10 @@ async def on_application_command_error(ctx: discord.ApplicationContext, error: d
     elif isinstance(error, discord.ApplicationCommandInvokeError):
          # コマンド実行中のエラー
          original = error.original
-         logger.error(f"Error invoking command '{ctx.command.name}' G:{ctx.guild_id}: {type(original).__name__}: {original}", exc_info=original)
+         logger.error("Error invoking command '%s' G:%s: %s: %s", ctx.command.name, ctx.guild_id, type(original).__name__, original, exc_info=original)
          errmsg = f"コマンド実行中にエラーが発生しました: `{type(original).__name__}`"
          # 特定のエラーに対するユーザーフレンドリーなメッセージ
-         if isinstance(original, yt_dlp.utils.DownloadError): errmsg = "動画/プレイリスト情報の取得またはダウンロードに失敗しました。"
+         if isinstance(original, ExtractionError): errmsg = "動画/プレイリスト情報の取得またはダウンロードに失敗しました。"
          elif isinstance(original, asyncio.TimeoutError): errmsg = "処理がタイムアウトしました。時間をおいて再試行してください。"
          elif isinstance(original, discord.errors.ClientException) and "Not connected" in str(original): errmsg = "ボイスチャンネルに接続していません。"
          elif isinstance(original, discord.errors.ClientException) and "Already connected" in str(original): errmsg = "既に他のボイスチャンネルに接続中です。"
@@ -969,77 +2871,241 @@ async def on_application_command_error(ctx: discord.ApplicationContext, error: d
          await responder(errmsg, ephemeral=ephemeral)
     elif isinstance(error, discord.errors.ApplicationCommandError):
         # ApplicationCommand の引数エラーなど
-        logger.warning(f"AppCmd Error '{ctx.command.name}' G:{ctx.guild_id}: {error}")
+        logger.warning("AppCmd Error '%s' G:%s: %s", ctx.command.name, ctx.guild_id, error)
         if isinstance(error.original, ValueError): await responder(f"不正な引数: {error.original}", ephemeral=ephemeral)
         else: await responder(f"コマンドエラー: {error}", ephemeral=ephemeral)
     else:
         # その他の予期しない Discord API エラーなど
-        logger.error(f"Unhandled Error in command '{ctx.command.name}' G:{ctx.guild_id}", exc_info=error)
+        logger.error("Unhandled Error in command '%s' G:%s", ctx.command.name, ctx.guild_id, exc_info=error)
         await responder(f"予期せぬ Discord API エラーが発生しました: `{error}`", ephemeral=ephemeral)
 
 # --- 自動切断機能 ---
-async def check_activity():
+ALONE_TIMEOUT = float(os.getenv("ALONE_TIMEOUT", "60")) # VCにBOTだけになってから切断するまでの秒数 (0 で切断しない)
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "300")) # キューが空で何も再生していない状態が続いたら切断するまでの秒数 (0 で切断しない)
+
+
+class IdleScheduler:
+    """サーバーごとの自動切断タイマー
+    タイマーは期限順のヒープに入れ、一番近い期限まで眠る1つのタスクで処理する (定期的な全サーバーの走査はしない)
+    取り消し/上書きされたタイマーはヒープに残るが、期限が来た時 (または先頭に来た時) に捨てる"""
+    _logger = logging.getLogger(__qualname__)
+
+    def __init__(self, on_expire):
+        self._on_expire = on_expire # async def (guild_id, reason)
+        self._heap: list[tuple[float, int, int, str]] = [] # (期限, 連番, guild_id, 理由)
+        self._timers: dict[int, tuple[float, int, str]] = {} # guild_id -> 有効なタイマー (期限, 連番, 理由)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def schedule(self, guild_id: int, reason: str, delay: float):
+        """delay 秒後に on_expire(guild_id, reason) を呼ぶ。同じ理由のタイマーが動いていれば期限は延ばさない"""
+        current = self._timers.get(guild_id)
+        if current is not None and current[2] == reason:
+            return
+        deadline = time.monotonic() + delay
+        seq = next(self._seq)
+        self._timers[guild_id] = (deadline, seq, reason)
+        heapq.heappush(self._heap, (deadline, seq, guild_id, reason))
+        self._logger.debug("Guild %s: Idle timer '%s' set (%.0fs).", guild_id, reason, delay)
+        if self._heap[0][1] == seq: # 一番近い期限が変わったので起こす
+            self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def cancel(self, guild_id: int):
+        if self._timers.pop(guild_id, None) is not None:
+            self._logger.debug("Guild %s: Idle timer cancelled.", guild_id)
+            if len(self._heap) > 2 * len(self._timers) + 64: # 無効なタイマーが溜まったら作り直す
+                self._heap = [(d, q, g, r) for g, (d, q, r) in self._timers.items()]
+                heapq.heapify(self._heap)
+
+    def pending(self, guild_id: int) -> str | None:
+        timer = self._timers.get(guild_id)
+        return timer[2] if timer else None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._heap:
+                deadline, seq, guild_id, reason = self._heap[0]
+                timer = self._timers.get(guild_id)
+                valid = timer is not None and timer[1] == seq
+                if valid and deadline > now:
+                    break
+                heapq.heappop(self._heap)
+                if valid:
+                    del self._timers[guild_id]
+                    asyncio.get_running_loop().create_task(self._on_expire(guild_id, reason))
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {'timers': len(self._timers), 'heap': len(self._heap)}
+
+
+def idle_reason(state: GuildMusicState) -> str | None:
+    """切断の対象なら理由 ('alone' = VCに人がいない / 'idle' = 再生するものがない) を返す"""
+    vc = state.voice_client
+    if not vc or not vc.is_connected() or not vc.channel:
+        return None
+    if not any(not m.bot for m in vc.channel.members):
+        return 'alone'
+    if not vc.is_playing() and not vc.is_paused() and not state.queue and state.current_song is None:
+        return 'idle'
+    return None
+
+
+def update_idle_timer(guild_id: int):
+    """サーバーの状態に合わせて自動切断タイマーを設定/取り消す (VCの出入り・再生の開始/終了時に呼ぶ)"""
+    state = guild_states.get(guild_id)
+    reason = idle_reason(state) if state else None
+    if reason == 'alone' and ALONE_TIMEOUT > 0:
+        idle_scheduler.schedule(guild_id, reason, ALONE_TIMEOUT)
+    elif reason == 'idle' and IDLE_TIMEOUT > 0:
+        idle_scheduler.schedule(guild_id, reason, IDLE_TIMEOUT)
+    else:
+        idle_scheduler.cancel(guild_id)
+
+
+async def disconnect_idle_guild(guild_id: int, reason: str):
+    """自動切断タイマーの期限が来たときの処理 (状態が変わっていれば切断せずタイマーを設定し直す)"""
+    state_to_remove = guild_states.get(guild_id)
+    if state_to_remove is None:
+        return
+    if idle_reason(state_to_remove) != reason:
+        update_idle_timer(guild_id)
+        return
+    try:
+        logger.info("Guild %s: Disconnecting due to inactivity (%s).", guild_id, reason)
+        # 通知チャンネルがあれば通知
+        message = "誰もいなくなったためVCから切断しました。" if reason == 'alone' else "しばらく再生がなかったためVCから切断しました。"
+        await state_to_remove.notify_channel(message, delete_after=30)
+        # VCから切断し、状態を削除
+        if state_to_remove.voice_client and state_to_remove.voice_client.is_connected():
+             # stop コマンドと同様のクリーンアップを実行
+             state_to_remove.queue.clear()
+             state_to_remove.clear_prefetch()
+             state_to_remove.current_song = None
+             state_to_remove.playback_start_time = None
+             if state_to_remove.audio_player_task and not state_to_remove.audio_player_task.done():
+                 state_to_remove.audio_player_task.cancel()
+             state_to_remove.voice_client.stop()
+             await state_to_remove.voice_client.disconnect(force=True)
+        remove_guild_state(guild_id) # 状態を削除
+    except Exception as e:
+        logger.exception("Guild %s: Error during inactivity disconnect: %s", guild_id, e)
+
+
+idle_scheduler = IdleScheduler(disconnect_idle_guild)
+
+
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    """VCの出入りがあったら、そのサーバーの自動切断タイマーだけを更新する"""
+    state = guild_states.get(member.guild.id)
+    if state is None or before.channel == after.channel:
+        return
+    bot_channel = state.voice_client.channel if state.voice_client else None
+    if member.id == bot.user.id or bot_channel in (before.channel, after.channel):
+        update_idle_timer(member.guild.id)
+
+# --- キューの保存と復元 (バックグラウンド) ---
+async def queue_persistence_loop():
+    """QUEUE_SAVE_INTERVAL 秒ごとに、変更のあったキューをまとめて保存する"""
     await bot.wait_until_ready()
-    logger.info("Starting activity check loop...")
+    logger.info("Starting queue persistence loop...")
     while not bot.is_closed():
-        await asyncio.sleep(60) # 60秒ごとにチェック
+        await asyncio.sleep(QUEUE_SAVE_INTERVAL)
         try:
-            inactive_guilds = []
-            # guild_states のコピーに対してループ (ループ中に削除される可能性があるため)
-            current_guild_states = list(guild_states.items())
-
-            for guild_id, state in current_guild_states:
-                 # stateやvoice_clientが存在し、VCに接続しているか確認
-                 if not state or not state.voice_client or not state.voice_client.is_connected():
-                     continue
-
-                 vc = state.voice_client.channel
-                 # VCにBot以外のメンバーがいるか確認
-                 human_members = [m for m in vc.members if not m.bot]
-
-                 if not human_members:
-                     # 人間が誰もいなければ非アクティブとみなす
-                     logger.info(f"Guild {guild_id}: No human members found in VC '{vc.name}'. Marking for inactivity disconnect.")
-                     inactive_guilds.append(guild_id)
-
-            # 非アクティブなギルドの処理
-            for guild_id in inactive_guilds:
-                 if guild_id in guild_states: # 再度存在確認
-                      state_to_remove = guild_states[guild_id]
-                      logger.info(f"Guild {guild_id}: Disconnecting due to inactivity.")
-                      # 通知チャンネルがあれば通知
-                      await state_to_remove.notify_channel("誰もいなくなったためVCから切断しました。", delete_after=30)
-                      # VCから切断し、状態を削除
-                      if state_to_remove.voice_client and state_to_remove.voice_client.is_connected():
-                           # disconnect は create_task 不要 (stop 内で await しているため)
-                           # await state_to_remove.voice_client.disconnect(force=True)
-                           # stop コマンドと同様のクリーンアップを実行
-                           state_to_remove.queue.clear()
-                           state_to_remove.current_song = None
-                           state_to_remove.playback_start_time = None
-                           if state_to_remove.audio_player_task and not state_to_remove.audio_player_task.done():
-                               state_to_remove.audio_player_task.cancel()
-                           state_to_remove.voice_client.stop()
-                           await state_to_remove.voice_client.disconnect(force=True)
-                      remove_guild_state(guild_id) # 状態を削除
-                 else:
-                     logger.warning(f"Guild {guild_id}: State already removed before inactivity disconnect.")
-
+            await queue_store.flush(guild_states, set(pending_restores))
         except Exception as e:
-            # ループ自体が止まらないように例外をキャッチ
-            logger.exception(f"Error during activity check loop: {e}")
-            await asyncio.sleep(60) # エラー発生時も少し待つ
+            logger.exception("Error during queue persistence: %s", e)
+
+async def restore_guilds():
+    """保存されていたキューのうち、VCに人がいるサーバーだけ再接続して続きから再生する
+    それ以外のサーバーは、次にコマンドが使われた時に get_guild_state で復元する"""
+    for guild_id, saved in list(pending_restores.items()):
+        guild = bot.get_guild(guild_id)
+        channel = guild.get_channel(saved['voice_channel_id']) if guild and saved['voice_channel_id'] else None
+        if not isinstance(channel, discord.VoiceChannel) or not any(not m.bot for m in channel.members):
+            continue
+        try:
+            guild_state = get_guild_state(guild_id) # ここでキューが復元される
+            if guild.voice_client and guild.voice_client.is_connected():
+                guild_state.voice_client = guild.voice_client
+            else:
+                logger.info("Guild %s: Reconnecting to VC '%s' to resume saved queue.", guild_id, channel.name)
+                guild_state.voice_client = await channel.connect(timeout=15.0)
+            guild_state.start_player_task()
+            await guild_state.notify_channel(f"🔄 再起動前のキュー ({len(guild_state.queue)} 曲) を復元し、続きから再生します。", delete_after=30)
+        except Exception as e:
+            logger.exception("Guild %s: Failed to resume saved queue: %s", guild_id, e)
+        await asyncio.sleep(1) # 再接続が一度に集中しないように
+
+# --- メトリクスの公開 ---
+def count_ffmpeg_processes() -> int:
+    count = 0
+    for source in list(_ffmpeg_sources):
+        process = getattr(source, '_process', None)
+        if hasattr(process, 'poll') and process.poll() is None:
+            count += 1
+    return count
+
+metrics.gauge('musicbot_guild_states', 'Guilds with an active music state', lambda: len(guild_states))
+metrics.gauge('musicbot_queue_tracks', 'Queued tracks summed over all guilds', lambda: sum(len(state.queue) for state in guild_states.values()))
+metrics.gauge('musicbot_queue_length_max', 'Longest guild queue', lambda: max((len(state.queue) for state in guild_states.values()), default=0))
+metrics.gauge('musicbot_voice_clients', 'Connected voice clients by state', lambda: {
+    ('playing',): sum(1 for vc in bot.voice_clients if vc.is_playing()),
+    ('paused',): sum(1 for vc in bot.voice_clients if vc.is_paused()),
+    ('idle',): sum(1 for vc in bot.voice_clients if not vc.is_playing() and not vc.is_paused()),
+}, ('state',))
+metrics.gauge('musicbot_ffmpeg_processes', 'Running ffmpeg processes (playing and prefetched)', count_ffmpeg_processes)
+metrics.gauge('musicbot_extraction_queue_depth', 'Extraction jobs waiting for a worker', lambda: extraction_scheduler.stats()['pending'])
+metrics.gauge('musicbot_extraction_running', 'Extraction jobs running on workers', lambda: extraction_scheduler.stats()['running'])
+metrics.gauge('musicbot_extraction_workers', 'Extraction worker count', lambda: extraction_scheduler.workers)
+metrics.gauge('musicbot_log_records_dropped', 'Log records dropped because the log queue was full', lambda: log_handler.dropped)
+metrics.gauge('musicbot_log_records_suppressed', 'Repetitive per-guild log records suppressed by LOG_RATE_LIMIT', lambda: log_rate_limit.suppressed if log_rate_limit else 0)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+async def start_metrics_server():
+    """METRICS_HOST:METRICS_PORT の /metrics で Prometheus 形式のメトリクスを公開する"""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logger.error("Failed to start metrics server on %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+        await runner.cleanup()
+        return
+    logger.info("Metrics server listening on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
 
 # --- Bot起動 ---
 if __name__ == "__main__":
+    # spawn で起動する抽出ワーカーに bot.py を実行し直させない (ワーカーが使うのは extraction の関数だけ)。
+    # multiprocessing は __main__ のモジュール名が '__main__' の時は、子プロセスで __main__ を読み込み直さない
+    __spec__ = importlib.machinery.ModuleSpec('__main__', None)
     if not DISCORD_BOT_TOKEN:
         print("エラー: 環境変数 'DISCORD_BOT_TOKEN' が設定されていません。")
         logger.critical("エラー: 環境変数 'DISCORD_BOT_TOKEN' が設定されていません。")
     else:
         try:
+            if EXTRACT_WARMUP == 'eager':
+                started = time.monotonic()
+                log_warm_up_result(extraction.warm_up(), time.monotonic() - started)
             logger.info("Starting bot...")
-            # バックグラウンドタスクとしてアクティビティチェックを開始
-            bot.loop.create_task(check_activity())
+            # キューを定期的に保存 (再起動後に続きから再生するため)
+            if QUEUE_SAVE_INTERVAL > 0: bot.loop.create_task(queue_persistence_loop())
+            # メトリクスの公開 (METRICS_PORT を設定した場合のみ)
+            if metrics.enabled: bot.loop.create_task(start_metrics_server())
             # Botを実行
             bot.run(DISCORD_BOT_TOKEN)
         except discord.errors.LoginFailure:
@@ -1047,6 +3113,6 @@ if __name__ == "__main__":
         except discord.errors.PrivilegedIntentsRequired:
             logger.critical("!!! MISSING INTENTS: Enable 'Server Members Intent' in the Discord Developer Portal for your bot. !!!")
         except Exception as e:
-            logger.critical(f"!!! Bot runtime error: {e}", exc_info=True)
+            logger.critical("!!! Bot runtime error: %s", e, exc_info=True)
 
 # --- END OF FILE bot.py (Loop機能削除版, np重複修正版) ---
\ No newline at end of file
@@ -2,8 +2,17 @@
 import os
 import sys
 import subprocess
-import discord
-import yt_dlp
+# バージョンはインストール情報から読む (discord や yt_dlp を import すると、それだけで数百ミリ秒かかる)
+from importlib import metadata
+
+def package_version(*names):
+    """最初に見つかったパッケージのバージョン (見つからなければ None)"""
+    for name in names:
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            continue
+    return None
 
 def check_env_vars():
     token = os.getenv("DISCORD_BOT_TOKEN")
@@ -16,20 +25,32 @@ def check_python_version():
     print("Python バージョン:", sys.version)
 
 def check_discord_version():
-    try:
-        version = discord.__version__
+    version = package_version("py-cord", "discord.py")
+    if version:
         print("discord.py バージョン:", version)
-    except AttributeError:
+    else:
         print("❌ discord.py のバージョンが取得できませんでした。")
 
 def check_yt_dlp_version():
-    try:
-        # yt_dlp のバージョンは __version__ で取得できる場合があります
-        version = yt_dlp.__version__
+    version = package_version("yt-dlp")
+    if version:
         print("yt_dlp バージョン:", version)
-    except AttributeError:
+    else:
         print("❌ yt_dlp のバージョン情報が取得できませんでした。")
 
+def check_yt_dlp_lazy_extractors():
+    # lazy extractors がないと (ソースから入れた場合など)、YoutubeDL の作成に1秒近く余計にかかる
+    try:
+        files = metadata.files("yt-dlp") or []
+    except metadata.PackageNotFoundError:
+        return
+    if os.getenv("YTDLP_NO_LAZY_EXTRACTORS"):
+        print("⚠️ YTDLP_NO_LAZY_EXTRACTORS が設定されているため、yt_dlp の起動が遅くなります。")
+    elif any(file.name == "lazy_extractors.py" for file in files):
+        print("✅ yt_dlp の lazy extractors が有効です。")
+    else:
+        print("⚠️ yt_dlp の lazy extractors が見つかりません (pip でインストールし直すと起動が速くなります)。")
+
 def check_ffmpeg():
     try:
         # ffmpeg -version を実行して確認
@@ -47,6 +68,7 @@ def main():
     check_python_version()
     check_discord_version()
     check_yt_dlp_version()
+    check_yt_dlp_lazy_extractors()
     check_ffmpeg()
 
 if __name__ == "__main__":
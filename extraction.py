@@ -0,0 +1,624 @@
+# extraction.py - yt-dlp による曲情報の取得
+# bot.py のスレッドプール、またはワーカープロセス (EXTRACT_BACKEND=process) の中で実行される。
+# ワーカープロセスでも import されるので、discord には依存しないこと。
+# 戻り値は bot.py が使う項目だけに絞った (プロセス間で受け渡せる) 辞書にする。
+# 取得方法は Resolver で差し替えられる (yt-dlp / 結果をファイルに記録 / 記録した結果を再生)。
+# yt_dlp の import は重い (数百ミリ秒) ので、起動時ではなく最初に使う時 (または warm_up) に行う。
+
+import os
+import re
+import abc
+import json
+import time
+import random
+import hashlib
+import queue
+import logging
+import threading
+import contextlib
+import multiprocessing
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+yt_dlp = None # load_yt_dlp() で import するまでは None
+
+
+def load_yt_dlp():
+    """yt_dlp を import して返す (2回目以降はすぐ返る)
+    import はモジュールごとのロックで守られるので、複数のスレッドから同時に呼んでも実行されるのは1回だけ"""
+    global yt_dlp
+    if yt_dlp is None:
+        import yt_dlp as module
+        yt_dlp = module
+    return yt_dlp
+
+
+def lazy_extractors_enabled() -> bool | None:
+    """yt-dlp が lazy extractors (使う時に初めて各サイトの抽出処理を import する仕組み) を使っているか
+    使っていないと YoutubeDL の作成時に全サイト分を import するので、1秒近く余計にかかる。判別できなければ None"""
+    yt_dlp = load_yt_dlp()
+    try:
+        from yt_dlp.globals import LAZY_EXTRACTORS # 2025年以降の yt-dlp
+        return LAZY_EXTRACTORS.value
+    except ImportError:
+        return getattr(yt_dlp.extractor.extractors, '_LAZY_LOADER', None)
+
+# yt-dlp の設定 (メタデータ取得用)
+ydl_opts_meta = {
+    'format': 'bestaudio/best',
+    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+    'restrictfilenames': True,
+    'noplaylist': False,
+    'nocheckcertificate': True,
+    'ignoreerrors': True, # プレイリスト内のエラーエントリをスキップ
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',
+    'extract_flat': 'in_playlist', # プレイリスト取得を高速化
+}
+
+# yt-dlp の設定 (個別のストリームURL取得用)
+ydl_opts_stream = ydl_opts_meta.copy()
+ydl_opts_stream['ignoreerrors'] = False # 個別の曲のエラーは検知する
+ydl_opts_stream['extract_flat'] = False # 個別取得時はFalseに
+# ydl_opts_stream['format'] = 'bestaudio[abr<=128]/bestaudio/best' # 必要なら調整
+
+# ストリームURLの有効期限の見積もり
+STREAM_CACHE_MARGIN = int(os.getenv("STREAM_CACHE_MARGIN", "600")) # URLの有効期限の何秒前に失効扱いにするか
+STREAM_CACHE_DEFAULT_TTL = int(os.getenv("STREAM_CACHE_DEFAULT_TTL", "1800")) # expire パラメータがないURLの保持秒数
+
+_EXPIRE_PARAM_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+PLAYLIST_BATCH_SIZE = 100 # stream_flat で一度に渡すエントリ数
+
+# 記録した結果を再生する場合の待ち時間 (EXTRACT_RESOLVER=replay:<フォルダ>)
+REPLAY_LATENCY = os.getenv("REPLAY_LATENCY", "") # 固定の秒数 (空なら記録時にかかった時間)
+REPLAY_LATENCY_SCALE = float(os.getenv("REPLAY_LATENCY_SCALE", "1.0")) # 待ち時間の倍率
+REPLAY_JITTER = float(os.getenv("REPLAY_JITTER", "0")) # 待ち時間のばらつき (0.2 なら ±20%)
+# warm_up で先に読み込んでおく抽出処理 (lazy extractors の場合、各サイトの処理は初めて使う時に import される)
+WARM_UP_EXTRACTORS = ('Youtube', 'YoutubeTab', 'YoutubeSearch')
+# フラット取得 (extract_flat) のエントリから残す項目
+FLAT_ENTRY_KEYS = ('id', 'title', 'duration', 'ie_key', 'url')
+
+
+class YoutubeDLPool:
+    """YoutubeDL インスタンスのプール (貸し出し/返却式)
+    YoutubeDL はスレッドセーフではないので、1つのインスタンスを同時に使うのは1スレッドだけにする。
+    インスタンスは使い回すので、HTTP接続やCookieもインスタンスごとに再利用される。
+    インスタンスは必要になった時点で size 個まで作る"""
+
+    def __init__(self, opts: dict, size: int):
+        self._opts = opts
+        self.size = size
+        self._idle: queue.LifoQueue = queue.LifoQueue() # 直近に返却された (接続が温まっている) ものから使う
+        self._created = 0
+        self._lock = threading.Lock()
+        self.waits = 0 # 空きがなく返却を待った回数
+
+    def resize(self, size: int):
+        """最大数を変更する (既に作ったインスタンスは減らさない)"""
+        with self._lock:
+            self.size = max(1, size)
+
+    @contextlib.contextmanager
+    def checkout(self):
+        ydl = self._acquire()
+        try:
+            yield ydl
+        finally:
+            self._idle.put(ydl)
+
+    def _acquire(self) -> 'yt_dlp.YoutubeDL':
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create: self._created += 1
+            else: self.waits += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return load_yt_dlp().YoutubeDL(self._opts)
+        except BaseException:
+            with self._lock: self._created -= 1
+            raise
+
+    def stats(self) -> dict:
+        idle = self._idle.qsize()
+        return {'size': self.size, 'created': self._created, 'idle': idle, 'in_use': self._created - idle, 'waits': self.waits}
+
+
+# yt-dlp インスタンスのプール (最大数は configure_pools で抽出の並列数に合わせる)
+meta_pool = YoutubeDLPool(ydl_opts_meta, 1)
+stream_pool = YoutubeDLPool(ydl_opts_stream, 1)
+
+
+def configure_pools(size: int):
+    """プールの最大数を設定する (このプロセスで同時に抽出を行うスレッド数と同じにする)"""
+    meta_pool.resize(size)
+    stream_pool.resize(size)
+
+
+class ExtractionError(Exception):
+    """曲情報の取得失敗 (yt-dlp の DownloadError などの代わり。メッセージだけを持つのでプロセス間で受け渡せる)"""
+
+
+def create_process_pool(workers: int, resolver_spec: str = 'ytdlp') -> concurrent.futures.ProcessPoolExecutor:
+    """ワーカープロセスのプールを作る (EXTRACT_BACKEND=process)
+    fork だとイベントループやスレッドの状態まで複製されるので spawn を使う。
+    ワーカーで実行するのは init_worker とこのモジュールのモジュールレベルの関数だけ (bot.py は必要ない)"""
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=init_worker, initargs=(resolver_spec,))
+
+
+def init_worker(resolver_spec: str = 'ytdlp'):
+    """ワーカープロセスの初期化処理 (ワーカープロセスは1度に1件ずつ処理するので、インスタンスは1組で足りる)"""
+    logging.getLogger('yt_dlp').setLevel(logging.WARNING)
+    configure_pools(1)
+    configure_resolver(resolver_spec)
+
+
+def _playlist_header(data: dict) -> dict:
+    return {'_type': 'playlist', 'id': data.get('id'), 'title': data.get('title'), 'extractor_key': data.get('extractor_key')}
+
+
+def _trim_flat_entry(entry: dict) -> dict:
+    return {k: entry.get(k) for k in FLAT_ENTRY_KEYS}
+
+
+def _single_entry(data: dict) -> dict:
+    return {
+        '_type': data.get('_type'),
+        'id': data.get('id'),
+        'title': data.get('title'),
+        'duration': data.get('duration'),
+        'extractor_key': data.get('extractor_key') or data.get('ie_key'),
+        'webpage_url': data.get('webpage_url'),
+        'original_url': data.get('original_url'),
+        'url': data.get('url'),
+    }
+
+
+def _ytdlp_extract_flat(url_or_search: str) -> dict | None:
+    """/play の入力からメタデータを取得する (プレイリストはエントリ一覧まで展開する)
+    プレイリストなら {'_type': 'playlist', 'id', 'title', 'extractor_key', 'entries': [...]}、
+    それ以外は単一エントリの辞書を返す。見つからなければ None"""
+    load_yt_dlp()
+    try:
+        with meta_pool.checkout() as ytdl:
+            data = ytdl.extract_info(url_or_search, download=False, process=False)
+            if not data:
+                return None
+            if data.get('_type') == 'playlist':
+                # entries はジェネレータの場合があるので、ここでページングしきってリスト化
+                # (ページングにもインスタンスを使うので、返却はその後)
+                playlist = _playlist_header(data)
+                playlist['entries'] = [_trim_flat_entry(entry) for entry in data.get('entries') or [] if entry]
+                return playlist
+        return _single_entry(data)
+    except yt_dlp.utils.YoutubeDLError as e: # DownloadError とネットワーク系のエラー
+        raise ExtractionError(str(e)) from None
+
+
+def _ytdlp_stream_flat(url_or_search: str, emit) -> dict | None:
+    """extract_flat のストリーミング版 (emit を渡すのでスレッドのワーカー専用)
+    プレイリストなら emit('playlist', ヘッダー) の後、ページングしながら emit('entries', [...]) で PLAYLIST_BATCH_SIZE 件ずつ渡す
+    (最初の1件だけはすぐに渡す)。emit が False を返したら打ち切る
+    戻り値は extract_flat と同じ (ただしプレイリストの entries は空)"""
+    load_yt_dlp()
+    try:
+        with meta_pool.checkout() as ytdl:
+            data = ytdl.extract_info(url_or_search, download=False, process=False)
+            if not data:
+                return None
+            if data.get('_type') != 'playlist':
+                return _single_entry(data)
+            playlist = _playlist_header(data)
+            if not emit('playlist', dict(playlist)):
+                return dict(playlist, entries=[])
+            batch = []
+            sent_first = False
+            for entry in data.get('entries') or []:
+                if not entry: continue
+                batch.append(_trim_flat_entry(entry))
+                if len(batch) >= PLAYLIST_BATCH_SIZE or not sent_first:
+                    sent_first = True
+                    if not emit('entries', batch):
+                        batch = []
+                        break
+                    batch = []
+            if batch:
+                emit('entries', batch)
+            return dict(playlist, entries=[])
+    except yt_dlp.utils.YoutubeDLError as e: # DownloadError とネットワーク系のエラー
+        raise ExtractionError(str(e)) from None
+
+
+def _ytdlp_extract_full(url: str) -> dict | None:
+    """1曲分の詳細情報を取得する (検索ワードやプレイリストURLの場合は最初の1曲)
+    {'_type': 'video', 'id', 'title', 'duration', 'extractor_key', 'webpage_url', 'stream'} を返す。
+    'stream' は select_stream_info の結果 (ストリームURLが見つからなければ None)"""
+    load_yt_dlp()
+    try:
+        with stream_pool.checkout() as ytdl:
+            data = ytdl.extract_info(url, download=False)
+    except yt_dlp.utils.YoutubeDLError as e: # DownloadError とネットワーク系のエラー
+        raise ExtractionError(str(e)) from None
+    if not data:
+        return None
+    if 'entries' in data:
+        entries = data['entries']
+        if not entries:
+            return None
+        data = entries[0]
+        if not data:
+            return None
+    return {
+        '_type': 'video',
+        'id': data.get('id'),
+        'title': data.get('title'),
+        'duration': data.get('duration'),
+        'extractor_key': data.get('extractor_key'),
+        'webpage_url': data.get('webpage_url', url),
+        'stream': select_stream_info(data, url),
+    }
+
+
+def _ytdlp_download_audio(url: str, dest_dir: str, key: str) -> dict | None:
+    """音声を dest_dir/<key>.<拡張子> にダウンロードする (ローカル音声キャッシュ用)
+    曲の情報は dest_dir/<key>.json にも保存し、{'file', 'size', 'title', 'duration', 'acodec', 'webpage_url'} を返す"""
+    load_yt_dlp()
+    opts = ydl_opts_stream.copy()
+    opts.update({'outtmpl': os.path.join(dest_dir, f'{key}.%(ext)s'), 'overwrites': True, 'noprogress': True})
+    try:
+        # 出力先が曲ごとに違うので、プールは使わずに都度作る (バックグラウンド処理なので作成コストは問題にならない)
+        with yt_dlp.YoutubeDL(opts) as ytdl:
+            data = ytdl.extract_info(url, download=True)
+    except yt_dlp.utils.YoutubeDLError as e: # DownloadError とネットワーク系のエラー
+        raise ExtractionError(str(e)) from None
+    if not data:
+        return None
+    if data.get('entries'):
+        data = data['entries'][0]
+    downloads = data.get('requested_downloads') or []
+    path = downloads[0].get('filepath') if downloads else None
+    if not path or not os.path.exists(path):
+        return None
+    info = {
+        'file': os.path.basename(path),
+        'size': os.path.getsize(path),
+        'title': data.get('title', '不明なタイトル'),
+        'duration': data.get('duration'),
+        'acodec': data.get('acodec'),
+        'webpage_url': data.get('webpage_url', url),
+    }
+    with open(os.path.join(dest_dir, f'{key}.json'), 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False)
+    return info
+
+
+def select_stream_info(data: dict, fallback_url: str) -> dict | None:
+    """yt-dlp の詳細情報から再生に必要な項目だけを取り出す (ストリームURLが見つからなければ None)"""
+    stream_url = data.get('url')
+    acodec = data.get('acodec')
+    if not stream_url:
+         formats = data.get('formats', [])
+         logger.debug("No direct stream URL. Checking %s formats...", len(formats))
+         audio_formats = [f for f in formats if f.get('url') and f.get('acodec') != 'none' and f.get('vcodec') == 'none']
+         if audio_formats:
+              best_audio = max(audio_formats, key=lambda f: f.get('abr', 0) if f.get('acodec') == 'opus' else (f.get('abr', 0) - 1000) if f.get('acodec') == 'aac' else -2000)
+              stream_url = best_audio.get('url')
+              acodec = best_audio.get('acodec')
+              logger.debug("Found audio-only stream (acodec: %s).", acodec)
+         else:
+              mixed_formats = [f for f in formats if f.get('url') and f.get('acodec') != 'none']
+              if mixed_formats:
+                   best_mixed = max(mixed_formats, key=lambda f: f.get('abr', 0))
+                   stream_url = best_mixed.get('url')
+                   acodec = best_mixed.get('acodec')
+                   logger.debug("Found mixed stream (acodec: %s).", acodec)
+         if not stream_url:
+             logger.error("Could not extract stream URL for %s.", data.get('webpage_url', fallback_url))
+             return None
+
+    return {
+        'stream_url': stream_url,
+        'title': data.get('title', '不明なタイトル'),
+        'webpage_url': data.get('webpage_url', fallback_url),
+        'duration': data.get('duration'),
+        'acodec': acodec,
+        'expires_at': stream_url_expiry(stream_url),
+    }
+
+
+def stream_url_expiry(stream_url: str) -> float:
+    """ストリームURLの失効時刻 (time.time() 基準) を返す。安全マージン分だけ早めに見積もる"""
+    match = _EXPIRE_PARAM_RE.search(stream_url)
+    if match:
+        return int(match.group(1)) - STREAM_CACHE_MARGIN
+    return time.time() + STREAM_CACHE_DEFAULT_TTL
+
+
+# --- 取得方法の切り替え (Resolver) ---
+class Resolver(abc.ABC):
+    """曲情報の取得方法の共通インターフェース (extract_flat と extract_full は必ず実装する)
+    extract_flat: /play の入力 (URL / 検索ワード) のメタデータ。プレイリストはエントリ一覧まで
+    stream_flat: extract_flat のストリーミング版 (emit で少しずつ渡す)
+    extract_full: 1曲分の詳細情報とストリーム情報
+    download_audio: 音声ファイルのダウンロード (ローカル音声キャッシュ用)。downloads_audio が False なら使えない
+    warm_up: 最初の取得を速くするための下準備 (起動後にバックグラウンドで呼ばれる)。かかった時間などを返す
+    戻り値の形はモジュールレベルの同名の関数と同じ。複数のスレッドから同時に呼ばれる"""
+    name = 'base'
+    downloads_audio = False
+
+    def warm_up(self) -> dict:
+        return {}
+
+    @abc.abstractmethod
+    def extract_flat(self, url_or_search: str) -> dict | None:
+        ...
+
+    def stream_flat(self, url_or_search: str, emit) -> dict | None:
+        """既定では extract_flat の結果を PLAYLIST_BATCH_SIZE 件ずつ渡す"""
+        data = self.extract_flat(url_or_search)
+        if not data or data.get('_type') != 'playlist':
+            return data
+        header = _playlist_header(data)
+        if emit('playlist', dict(header)):
+            _emit_entries(data.get('entries') or [], emit)
+        return dict(header, entries=[])
+
+    @abc.abstractmethod
+    def extract_full(self, url: str) -> dict | None:
+        ...
+
+    def download_audio(self, url: str, dest_dir: str, key: str) -> dict | None:
+        raise ExtractionError(f"The {self.name} extraction resolver does not download audio.")
+
+
+def _emit_entries(entries: list, emit, delay: float = 0.0) -> bool:
+    """entries を stream_flat と同じ区切り (最初の1件、以降 PLAYLIST_BATCH_SIZE 件ずつ) で emit する
+    delay 秒は区切りごとに均等に分けて待つ (ページ取得の模擬)。打ち切られたら False"""
+    batches = [entries[:1]] + [entries[i:i + PLAYLIST_BATCH_SIZE] for i in range(1, len(entries), PLAYLIST_BATCH_SIZE)] if entries else []
+    for batch in batches:
+        if delay: time.sleep(delay / len(batches))
+        if not emit('entries', batch):
+            return False
+    return True
+
+
+class YtDlpResolver(Resolver):
+    """yt-dlp で取得する (通常の動作)"""
+    name = 'ytdlp'
+    downloads_audio = True
+
+    def extract_flat(self, url_or_search: str) -> dict | None:
+        return _ytdlp_extract_flat(url_or_search)
+
+    def stream_flat(self, url_or_search: str, emit) -> dict | None:
+        return _ytdlp_stream_flat(url_or_search, emit)
+
+    def extract_full(self, url: str) -> dict | None:
+        return _ytdlp_extract_full(url)
+
+    def download_audio(self, url: str, dest_dir: str, key: str) -> dict | None:
+        return _ytdlp_download_audio(url, dest_dir, key)
+
+    def warm_up(self) -> dict:
+        """yt_dlp の import、プールのインスタンス1つずつの作成、YouTube の抽出処理の読み込みを済ませておく"""
+        started = time.monotonic()
+        load_yt_dlp()
+        imported = time.monotonic()
+        with meta_pool.checkout() as ytdl:
+            for ie_key in WARM_UP_EXTRACTORS: ytdl.get_info_extractor(ie_key)
+        with stream_pool.checkout() as ytdl:
+            for ie_key in WARM_UP_EXTRACTORS: ytdl.get_info_extractor(ie_key)
+        return {'import': imported - started, 'instances': time.monotonic() - imported, 'lazy_extractors': lazy_extractors_enabled()}
+
+
+def fixture_path(directory: str, mode: str, url_or_search: str) -> str:
+    """記録ファイルのパス (<フォルダ>/<flat|full>-<入力のハッシュ>.json)"""
+    digest = hashlib.sha1(url_or_search.encode('utf-8')).hexdigest()[:20]
+    return os.path.join(directory, f"{mode}-{digest}.json")
+
+
+class RecordingResolver(Resolver):
+    """inner で取得した結果 (bot.py が使う項目だけに絞った辞書) と、かかった時間をファイルに記録する
+    ReplayResolver で読み込んで、ネットワークなしで同じ取得結果を再現するためのもの"""
+    name = 'record'
+
+    def __init__(self, inner: Resolver, directory: str):
+        self.inner = inner
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def extract_flat(self, url_or_search: str) -> dict | None:
+        return self._record('flat', url_or_search, self.inner.extract_flat)
+
+    def extract_full(self, url: str) -> dict | None:
+        return self._record('full', url, self.inner.extract_full)
+
+    @property
+    def downloads_audio(self) -> bool:
+        return self.inner.downloads_audio
+
+    def download_audio(self, url: str, dest_dir: str, key: str) -> dict | None:
+        # ダウンロードは記録しない (再生時はネットワークを使わないので、音声キャッシュも使わない)
+        return self.inner.download_audio(url, dest_dir, key)
+
+    def warm_up(self) -> dict:
+        return self.inner.warm_up()
+
+    def stream_flat(self, url_or_search: str, emit) -> dict | None:
+        # 渡したエントリを集めておき、extract_flat と同じ形 (entries 付き) で記録する
+        entries = []
+        first_at: list[float] = []
+        stopped = False # 受け取る側が途中で打ち切った (一覧が揃っていない)
+        started = time.monotonic()
+        def recording_emit(event: str, payload):
+            nonlocal stopped
+            if not first_at: first_at.append(time.monotonic() - started)
+            if event == 'entries': entries.extend(payload)
+            if not emit(event, payload):
+                stopped = True
+                return False
+            return True
+        try:
+            data = self.inner.stream_flat(url_or_search, recording_emit)
+        except ExtractionError as e:
+            self._write('flat', url_or_search, {'error': str(e), 'elapsed': time.monotonic() - started})
+            raise
+        if stopped: # 途中までの一覧を記録すると、再生した時に曲が足りないプレイリストになる
+            logger.debug("Not recording '%s': the playlist listing was stopped early.", url_or_search)
+            return data
+        result = dict(data, entries=entries) if data and data.get('_type') == 'playlist' else data
+        self._write('flat', url_or_search, {'result': result, 'elapsed': time.monotonic() - started,
+                                            'first_elapsed': first_at[0] if first_at else None})
+        return data
+
+    def _record(self, mode: str, url_or_search: str, func) -> dict | None:
+        started = time.monotonic()
+        try:
+            result = func(url_or_search)
+        except ExtractionError as e:
+            self._write(mode, url_or_search, {'error': str(e), 'elapsed': time.monotonic() - started})
+            raise
+        self._write(mode, url_or_search, {'result': result, 'elapsed': time.monotonic() - started})
+        return result
+
+    def _write(self, mode: str, url_or_search: str, record: dict):
+        record = dict(record, mode=mode, input=url_or_search, recorded_at=time.time())
+        path = fixture_path(self.directory, mode, url_or_search)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(tmp_path, path) # 同じ入力を同時に記録しても壊れたファイルを残さない
+        except OSError as e:
+            logger.warning("Failed to record extraction fixture %s: %s", path, e)
+
+
+class ReplayResolver(Resolver):
+    """RecordingResolver が記録した結果を返す (ネットワークには一切アクセスしない)
+    待ち時間は latency 秒 (None なら記録時にかかった時間) × scale で、jitter の割合だけランダムにばらつかせる
+    記録がない入力は ExtractionError にする。ストリームURLは記録時のままなので、有効期限だけ今から数え直す"""
+    name = 'replay'
+
+    def __init__(self, directory: str, latency: float | None = None, scale: float = 1.0, jitter: float = 0.0):
+        if not os.path.isdir(directory):
+            raise ValueError(f"Replay fixture directory not found: {directory}")
+        self.directory = directory
+        self.latency = latency
+        self.scale = scale
+        self.jitter = jitter
+        self.misses = 0
+
+    def extract_flat(self, url_or_search: str) -> dict | None:
+        record = self._load('flat', url_or_search)
+        self._sleep(record.get('elapsed'))
+        return self._result(record)
+
+    def stream_flat(self, url_or_search: str, emit) -> dict | None:
+        record = self._load('flat', url_or_search)
+        total = self._delay(record.get('elapsed'))
+        # 最初のページが届くまでの時間の後、残りの時間をかけて少しずつ渡す
+        first = min(total, self._delay(record['first_elapsed'])) if record.get('first_elapsed') is not None else total
+        if first: time.sleep(first)
+        data = self._result(record)
+        if not data or data.get('_type') != 'playlist':
+            return data
+        header = _playlist_header(data)
+        if emit('playlist', dict(header)):
+            _emit_entries(data.get('entries') or [], emit, delay=total - first)
+        return dict(header, entries=[])
+
+    def extract_full(self, url: str) -> dict | None:
+        record = self._load('full', url)
+        self._sleep(record.get('elapsed'))
+        result = self._result(record)
+        if result and result.get('stream'): # 記録時の有効期限は過ぎているので、再取得されないよう延ばす
+            result['stream'] = dict(result['stream'], expires_at=time.time() + STREAM_CACHE_DEFAULT_TTL)
+        return result
+
+    def _load(self, mode: str, url_or_search: str) -> dict:
+        path = fixture_path(self.directory, mode, url_or_search)
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            raise ExtractionError(f"No recorded {mode} result for '{url_or_search}'.") from None
+
+    def _delay(self, recorded: float | None) -> float:
+        base = self.latency if self.latency is not None else (recorded or 0.0)
+        delay = base * self.scale
+        if self.jitter: delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0.0, delay)
+
+    def _sleep(self, recorded: float | None):
+        delay = self._delay(recorded)
+        if delay: time.sleep(delay)
+
+    @staticmethod
+    def _result(record: dict) -> dict | None:
+        if record.get('error') is not None:
+            raise ExtractionError(record['error'])
+        return record.get('result')
+
+
+def create_resolver(spec: str) -> Resolver:
+    """EXTRACT_RESOLVER の値から Resolver を作る
+    'ytdlp' (既定) / 'record:<フォルダ>' (yt-dlp で取得して記録) / 'replay:<フォルダ>' (記録を再生)"""
+    kind, _, directory = spec.partition(':')
+    kind = kind.strip().lower()
+    if kind in ('', 'ytdlp', 'yt-dlp'):
+        return YtDlpResolver()
+    if not directory:
+        raise ValueError(f"EXTRACT_RESOLVER '{spec}' needs a directory (e.g. '{kind}:fixtures').")
+    if kind == 'record':
+        return RecordingResolver(YtDlpResolver(), directory)
+    if kind == 'replay':
+        return ReplayResolver(directory, float(REPLAY_LATENCY) if REPLAY_LATENCY else None, REPLAY_LATENCY_SCALE, REPLAY_JITTER)
+    raise ValueError(f"Unknown EXTRACT_RESOLVER '{spec}'. Use 'ytdlp', 'record:<dir>' or 'replay:<dir>'.")
+
+
+resolver: Resolver = YtDlpResolver()
+
+
+def configure_resolver(spec: str):
+    """このプロセスで使う Resolver を設定する (ワーカープロセスでは init_worker から呼ばれる)"""
+    global resolver
+    resolver = create_resolver(spec)
+    if resolver.name != 'ytdlp':
+        logger.info("Using %s extraction resolver (%s).", resolver.name, spec)
+
+
+# bot.py から (プロセスのワーカーでは pickle して) 呼ぶ入口。実際の取得は設定された resolver が行う
+def extract_flat(url_or_search: str) -> dict | None:
+    """/play の入力からメタデータを取得する (_ytdlp_extract_flat を参照)"""
+    return resolver.extract_flat(url_or_search)
+
+
+def stream_flat(url_or_search: str, emit) -> dict | None:
+    """extract_flat のストリーミング版 (_ytdlp_stream_flat を参照。スレッドのワーカー専用)"""
+    return resolver.stream_flat(url_or_search, emit)
+
+
+def extract_full(url: str) -> dict | None:
+    """1曲分の詳細情報を取得する (_ytdlp_extract_full を参照)"""
+    return resolver.extract_full(url)
+
+
+def download_audio(url: str, dest_dir: str, key: str) -> dict | None:
+    """音声をダウンロードする (_ytdlp_download_audio を参照)"""
+    return resolver.download_audio(url, dest_dir, key)
+
+
+def warm_up() -> dict:
+    """最初の取得を速くするための下準備 (YtDlpResolver.warm_up を参照)"""
+    return resolver.warm_up()
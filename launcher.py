@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# launcher.py - シャードを複数のプロセスに分けて bot.py を起動・監視する
+#
+# 使い方: python launcher.py
+#   SHARD_COUNT      全体のシャード数 (既定: "auto" = Discord の推奨値)
+#   SHARD_PROCESSES  起動するプロセス数 (既定: CPU コア数。シャード数より多くはならない)
+# 各プロセスには SHARD_COUNT と担当分の SHARD_IDS を渡して bot.py を起動する。
+# 落ちたプロセスは間隔を空けて再起動し、Ctrl+C / SIGTERM で全プロセスを終了する。
+
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from dotenv import load_dotenv
+
+# --- ロギング設定 ---
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+logger = logging.getLogger("launcher")
+
+load_dotenv()
+
+DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+IDENTIFY_INTERVAL = 5.0 # Discord の IDENTIFY の制限 (max_concurrency 回 / 5秒)
+RESTART_BACKOFF_MAX = 60.0 # 再起動の待ち時間の上限 (秒)
+STABLE_UPTIME = 60.0 # これより長く動いていたら、落ちても待ち時間をリセットする
+SHUTDOWN_TIMEOUT = 15.0 # 終了時に子プロセスを待つ秒数 (超えたら kill)
+
+
+def fetch_gateway_info(token: str) -> dict:
+    """GET /gateway/bot で推奨シャード数と同時 IDENTIFY 数を取得する"""
+    request = urllib.request.Request("https://discord.com/api/v10/gateway/bot", headers={
+        "Authorization": f"Bot {token}",
+        "User-Agent": "DiscordBot (launcher.py, 1.0)",
+    })
+    with urllib.request.urlopen(request, timeout=15) as response:
+        return json.load(response)
+
+
+def split_shards(shard_count: int, processes: int) -> list[list[int]]:
+    """シャードID 0..shard_count-1 を processes 個の連続した範囲に分ける"""
+    base, extra = divmod(shard_count, processes)
+    groups, start = [], 0
+    for i in range(processes):
+        size = base + (1 if i < extra else 0)
+        groups.append(list(range(start, start + size)))
+        start += size
+    return groups
+
+
+class ShardWorker:
+    """1つの bot.py プロセス (担当シャードのグループ) の起動と再起動を管理する"""
+
+    def __init__(self, index: int, shard_ids: list[int], shard_count: int):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process: subprocess.Popen | None = None
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at: float | None = None
+
+    @property
+    def label(self) -> str:
+        return f"worker {self.index} (shards {self.shard_ids[0]}-{self.shard_ids[-1]})"
+
+    def start(self):
+        env = dict(os.environ)
+        env["SHARD_COUNT"] = str(self.shard_count)
+        env["SHARD_IDS"] = f"{self.shard_ids[0]}-{self.shard_ids[-1]}"
+        # 音声キャッシュは容量管理をプロセスごとに行うので、フォルダを分ける
+        env.setdefault("AUDIO_CACHE_DIR", os.path.join(os.getenv("CACHE_DIR", "cache"), f"audio-{self.index}"))
+        # メトリクスを公開する場合は、ポートが重ならないようワーカーの番号だけずらす
+        metrics_port = int(os.getenv("METRICS_PORT", "0"))
+        if metrics_port > 0: env["METRICS_PORT"] = str(metrics_port + self.index)
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, cwd=os.path.dirname(BOT_SCRIPT))
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        logger.info("Started %s, pid %s.", self.label, self.process.pid)
+
+    def check(self):
+        """終了していたら再起動を予約し、予約時刻になったら再起動する"""
+        now = time.monotonic()
+        if self.restart_at is not None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll() if self.process else None
+        if code is None:
+            return
+        if now - self.started_at >= STABLE_UPTIME:
+            self.failures = 0
+        self.failures += 1
+        delay = min(RESTART_BACKOFF_MAX, 2.0 ** self.failures)
+        logger.warning("%s exited with code %s. Restarting in %.0fs.", self.label, code, delay)
+        self.restart_at = now + delay
+
+    def terminate(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait_or_kill(self, deadline: float):
+        if not self.process: return
+        try:
+            self.process.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logger.warning("%s did not exit in time. Killing.", self.label)
+            self.process.kill()
+
+
+def main():
+    if not DISCORD_BOT_TOKEN:
+        logger.critical("エラー: 環境変数 'DISCORD_BOT_TOKEN' が設定されていません。")
+        sys.exit(1)
+
+    shard_count_spec = os.getenv("SHARD_COUNT", "auto").strip().lower()
+    max_concurrency = 1
+    try:
+        gateway = fetch_gateway_info(DISCORD_BOT_TOKEN)
+        max_concurrency = gateway.get("session_start_limit", {}).get("max_concurrency", 1)
+        recommended = gateway.get("shards", 1)
+        logger.info("Gateway: recommended shards %s, max_concurrency %s.", recommended, max_concurrency)
+    except Exception as e:
+        if shard_count_spec == "auto":
+            logger.critical("Failed to fetch recommended shard count: %s. Set SHARD_COUNT explicitly.", e)
+            sys.exit(1)
+        logger.warning("Failed to fetch gateway info (%s). Assuming max_concurrency 1.", e)
+        recommended = None
+    shard_count = recommended if shard_count_spec == "auto" else int(shard_count_spec)
+    processes = max(1, min(shard_count, int(os.getenv("SHARD_PROCESSES", str(os.cpu_count() or 1)))))
+
+    workers = [ShardWorker(i, ids, shard_count) for i, ids in enumerate(split_shards(shard_count, processes))]
+    logger.info("Launching %s shards in %s processes.", shard_count, processes)
+
+    stopping = False
+    def request_stop(signum, frame):
+        nonlocal stopping
+        logger.info("Received signal %s. Stopping workers...", signum)
+        stopping = True
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # 同時に IDENTIFY しすぎないよう、前のプロセスのシャード数に応じて間隔を空けて起動する
+    for worker in workers:
+        if stopping: break
+        worker.start()
+        wait_until = time.monotonic() + IDENTIFY_INTERVAL * -(-len(worker.shard_ids) // max_concurrency)
+        while not stopping and time.monotonic() < wait_until:
+            time.sleep(0.5)
+
+    while not stopping:
+        for worker in workers:
+            worker.check()
+        time.sleep(1.0)
+
+    for worker in workers:
+        worker.terminate()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for worker in workers:
+        worker.wait_or_kill(deadline)
+    logger.info("All workers stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+# tests/conftest.py - bot.py をネットワークにも Discord にも接続せずに import するための設定
+# bot は import 時に環境変数を読むので、テストより先に (ここで) 固定する。実行: python -m pytest -q
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("DISCORD_BOT_TOKEN", "test") # bot.py は起動時に値があるかを確認するだけ
+os.environ["CACHE_DIR"] = tempfile.mkdtemp(prefix="musicbot-test-")
+
+import bot
+
+
+class Clock:
+    """time.time の代わり (進めた分だけ時間が経つ)"""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, 'time', clock)
+    return clock
@@ -0,0 +1,77 @@
+# IdleScheduler: タイマーの期限、上書き、取り消し
+
+import asyncio
+
+import bot
+
+
+def run_with_scheduler(scenario):
+    """scenario(scheduler, expired) を実行する。expired には期限が来た (guild_id, reason) が入る"""
+    async def main():
+        expired = []
+        async def on_expire(guild_id: int, reason: str):
+            expired.append((guild_id, reason))
+        scheduler = bot.IdleScheduler(on_expire)
+        try:
+            await scenario(scheduler, expired)
+        finally:
+            if scheduler._task is not None: scheduler._task.cancel()
+    asyncio.run(main())
+
+
+def test_timers_expire_in_deadline_order():
+    async def scenario(scheduler, expired):
+        scheduler.schedule(1, 'idle', 0.10)
+        scheduler.schedule(2, 'alone', 0.02) # 後から入れた近い期限で起こし直す
+        await asyncio.sleep(0.06)
+        assert expired == [(2, 'alone')]
+        await asyncio.sleep(0.08)
+        assert expired == [(2, 'alone'), (1, 'idle')]
+        assert scheduler.pending(1) is None
+        assert scheduler.stats() == {'timers': 0, 'heap': 0}
+    run_with_scheduler(scenario)
+
+
+def test_same_reason_keeps_deadline():
+    async def scenario(scheduler, expired):
+        scheduler.schedule(1, 'idle', 0.03)
+        await asyncio.sleep(0.02)
+        scheduler.schedule(1, 'idle', 1.0) # 延ばさない
+        await asyncio.sleep(0.04)
+        assert expired == [(1, 'idle')]
+    run_with_scheduler(scenario)
+
+
+def test_different_reason_replaces_timer():
+    async def scenario(scheduler, expired):
+        scheduler.schedule(1, 'idle', 0.02)
+        scheduler.schedule(1, 'alone', 0.08)
+        assert scheduler.pending(1) == 'alone'
+        await asyncio.sleep(0.05)
+        assert expired == [] # 上書きされた 'idle' は捨てられる
+        await asyncio.sleep(0.06)
+        assert expired == [(1, 'alone')]
+    run_with_scheduler(scenario)
+
+
+def test_cancel():
+    async def scenario(scheduler, expired):
+        scheduler.schedule(1, 'idle', 0.02)
+        scheduler.schedule(2, 'idle', 0.02)
+        scheduler.cancel(1)
+        scheduler.cancel(3) # タイマーのないサーバーは何もしない
+        assert scheduler.pending(1) is None
+        await asyncio.sleep(0.05)
+        assert expired == [(2, 'idle')]
+    run_with_scheduler(scenario)
+
+
+def test_cancelled_timers_are_compacted():
+    async def scenario(scheduler, expired):
+        for guild_id in range(200):
+            scheduler.schedule(guild_id, 'idle', 60)
+        for guild_id in range(150):
+            scheduler.cancel(guild_id)
+        assert scheduler.stats()['timers'] == 50
+        assert scheduler.stats()['heap'] <= 2 * 50 + 64
+    run_with_scheduler(scenario)
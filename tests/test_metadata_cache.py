@@ -0,0 +1,50 @@
+# MetadataCache (SQLite): 種類ごとの有効期限と件数上限 (LRU)
+
+import os
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def metadata_cache(tmp_path):
+    cache = bot.MetadataCache(os.path.join(tmp_path, 'metadata.sqlite3'), 3)
+    yield cache
+    if cache._conn is not None: cache._conn.close()
+
+
+def test_metadata_cache_ttl_per_kind(clock, metadata_cache, monkeypatch):
+    monkeypatch.setattr(bot, 'META_CACHE_TTL_SEARCH', 10)
+    monkeypatch.setattr(bot, 'META_CACHE_TTL_VIDEO', 100)
+    monkeypatch.setattr(bot, 'META_CACHE_TTL_PLAYLIST', 50)
+    metadata_cache.put(['q:song', 'v:aaaaaaaaaaa'], {'_type': 'video', 'title': 'Song'})
+    metadata_cache.put(['pl:list'], {'_type': 'playlist', 'entries': []})
+    clock.now += 11
+    assert metadata_cache.get('q:song') is None # 検索ワードは短い
+    assert metadata_cache.get('v:aaaaaaaaaaa') == {'_type': 'video', 'title': 'Song'}
+    assert metadata_cache.get('pl:list') is not None
+    clock.now += 40
+    assert metadata_cache.get('pl:list') is None
+    assert metadata_cache.get('v:aaaaaaaaaaa') is not None
+    clock.now += 50
+    assert metadata_cache.get('v:aaaaaaaaaaa') is None
+    assert metadata_cache.stats()['hits'] == 3
+
+
+def test_metadata_cache_evicts_least_recently_used(clock, metadata_cache):
+    for name in ('a', 'b', 'c'):
+        metadata_cache.put([f'v:{name}'], {'_type': 'video', 'title': name})
+        clock.now += 1
+    assert metadata_cache.get('v:a') is not None # a を最近使ったことにする
+    clock.now += 1
+    metadata_cache.put(['v:d'], {'_type': 'video', 'title': 'd'})
+    assert metadata_cache.get('v:b') is None
+    assert [metadata_cache.get(f'v:{name}')['title'] for name in ('a', 'c', 'd')] == ['a', 'c', 'd']
+
+
+def test_metadata_cache_disabled(tmp_path):
+    cache = bot.MetadataCache(os.path.join(tmp_path, 'metadata.sqlite3'), 0)
+    cache.put(['q:song'], {'_type': 'video'})
+    assert cache.get('q:song') is None
+    assert not os.path.exists(cache.path)
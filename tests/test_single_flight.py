@@ -0,0 +1,74 @@
+# SingleFlight: 同じキーの呼び出しの合流と、待っている呼び出し元がいなくなった時のキャンセル
+
+import asyncio
+
+import bot
+
+
+def test_coalesces_concurrent_calls():
+    async def main():
+        flights = bot.SingleFlight()
+        calls = 0
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 'result'
+        results = await asyncio.gather(*(flights.run('key', work) for _ in range(5)))
+        assert results == ['result'] * 5
+        assert calls == 1
+        assert flights.stats() == {'inflight': 0, 'started': 1, 'coalesced': 4}
+    asyncio.run(main())
+
+
+def test_cancelling_one_waiter_keeps_the_shared_task():
+    async def main():
+        flights = bot.SingleFlight()
+        release = asyncio.Event()
+        async def work():
+            await release.wait()
+            return 'result'
+        first = asyncio.ensure_future(flights.run('key', work))
+        second = asyncio.ensure_future(flights.run('key', work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        assert flights.is_inflight('key')
+        release.set()
+        assert await second == 'result'
+        assert first.cancelled()
+    asyncio.run(main())
+
+
+def test_cancelling_last_waiter_cancels_the_shared_task():
+    async def main():
+        flights = bot.SingleFlight()
+        cancelled = asyncio.Event()
+        async def work():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        waiters = [asyncio.ensure_future(flights.run('key', work)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters: waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        assert not flights.is_inflight('key')
+        # キャンセルの後は新しく始める
+        assert await flights.run('key', lambda: asyncio.sleep(0, 'again')) == 'again'
+        assert flights.started == 2
+    asyncio.run(main())
+
+
+def test_failure_is_shared_and_forgotten():
+    async def main():
+        flights = bot.SingleFlight()
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise bot.ExtractionError('boom')
+        results = await asyncio.gather(*(flights.run('key', fail) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, bot.ExtractionError) for result in results)
+        assert not flights.is_inflight('key')
+    asyncio.run(main())
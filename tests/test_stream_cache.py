@@ -0,0 +1,45 @@
+# StreamCache: 有効期限と件数上限 (LRU)
+
+import bot
+
+
+def stream_info(url: str, expires_at: float) -> dict:
+    return {'stream_url': url + '#stream', 'webpage_url': url, 'expires_at': expires_at}
+
+
+def test_stream_cache_expiry(clock):
+    cache = bot.StreamCache(10)
+    cache.put(stream_info('https://example.com/a', clock.now + 60))
+    assert cache.get('https://example.com/a')['stream_url'] == 'https://example.com/a#stream'
+    clock.now += 61
+    assert cache.get('https://example.com/a') is None
+    assert cache.stats()['size'] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_stream_cache_ignores_expired_and_disabled(clock):
+    cache = bot.StreamCache(10)
+    cache.put(stream_info('https://example.com/a', clock.now))
+    assert cache.stats()['size'] == 0
+    disabled = bot.StreamCache(0)
+    disabled.put(stream_info('https://example.com/a', clock.now + 60))
+    assert disabled.get('https://example.com/a') is None
+
+
+def test_stream_cache_evicts_least_recently_used(clock):
+    cache = bot.StreamCache(2)
+    cache.put(stream_info('https://example.com/a', clock.now + 60))
+    cache.put(stream_info('https://example.com/b', clock.now + 60))
+    cache.get('https://example.com/a') # a を最近使ったことにする
+    cache.put(stream_info('https://example.com/c', clock.now + 60))
+    assert cache.get('https://example.com/b') is None
+    assert cache.get('https://example.com/a') is not None
+    assert cache.get('https://example.com/c') is not None
+
+
+def test_stream_cache_extra_keys_share_entry(clock):
+    cache = bot.StreamCache(10)
+    info = stream_info('https://www.youtube.com/watch?v=aaaaaaaaaaa', clock.now + 60)
+    cache.put(info, 'https://youtu.be/aaaaaaaaaaa')
+    assert cache.get('https://youtu.be/aaaaaaaaaaa') is info
+    assert cache.stats()['size'] == 2
@@ -0,0 +1,125 @@
+# TrackQueue (ブロック分割リスト + Fenwick 木 + 集計値) を普通のリストと同じ操作で比べる
+
+import random
+from collections import Counter
+
+import pytest
+
+import bot
+
+
+def make_entry(i: int, rng: random.Random) -> bot.QueueEntry:
+    url = f"https://www.youtube.com/watch?v={i:011d}" if i % 3 else f"https://example.com/{i}"
+    duration = None if i % 7 == 0 else rng.choice([30, 61.5, 200, 3600])
+    return bot.QueueEntry(url, f"Song {i}", rng.randrange(5), duration)
+
+
+def assert_same(queue: bot.TrackQueue, model: list):
+    assert len(queue) == len(model)
+    assert bool(queue) == bool(model)
+    assert list(queue) == model
+    assert queue.total_duration == pytest.approx(sum(e.duration for e in model if e.duration is not None))
+    assert queue.unknown_duration_count == sum(1 for e in model if e.duration is None)
+    assert queue.requester_counts == Counter(e.requester for e in model)
+
+
+def clamp(index: int, model: list) -> int:
+    # slice / remove_range は負の位置を末尾からの位置ではなく 0 として扱う
+    return min(max(index, 0), len(model))
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    # ブロックの分割/削除を少ない曲数で起こす
+    monkeypatch.setattr(bot.TrackQueue, 'BLOCK_SIZE', 4)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_operations_match_list(small_blocks, seed):
+    rng = random.Random(seed)
+    counter = iter(range(10**6))
+    queue, model = bot.TrackQueue(), []
+    for _ in range(600):
+        op = rng.choice(['append', 'extend', 'insert', 'pop', 'move', 'remove_range', 'getitem', 'slice'])
+        if op == 'append':
+            entry = make_entry(next(counter), rng)
+            queue.append(entry)
+            model.append(entry)
+        elif op == 'extend':
+            entries = [make_entry(next(counter), rng) for _ in range(rng.randrange(12))]
+            queue.extend(entries)
+            model.extend(entries)
+        elif op == 'insert':
+            index = rng.randint(-len(model) - 3, len(model) + 3)
+            entry = make_entry(next(counter), rng)
+            queue.insert(index, entry)
+            model.insert(index, entry)
+        elif not model:
+            continue
+        elif op == 'pop':
+            index = rng.randrange(-len(model), len(model))
+            assert queue.pop(index) is model.pop(index)
+        elif op == 'move':
+            src, dst = rng.randrange(len(model)), rng.randrange(len(model))
+            entry = model.pop(src)
+            model.insert(dst, entry)
+            assert queue.move(src, dst) is entry
+        elif op == 'remove_range':
+            start = rng.randint(-2, len(model))
+            stop = rng.randint(start, len(model) + 2)
+            expected = model[clamp(start, model):clamp(stop, model)]
+            del model[clamp(start, model):clamp(stop, model)]
+            assert queue.remove_range(start, stop) == expected
+        elif op == 'getitem':
+            index = rng.randrange(-len(model), len(model))
+            assert queue[index] is model[index]
+        else:
+            start = rng.randint(-2, len(model) + 2)
+            stop = rng.randint(-2, len(model) + 4)
+            assert queue.slice(start, stop) == model[clamp(start, model):clamp(stop, model)]
+        assert_same(queue, model)
+
+
+def test_index_out_of_range(small_blocks):
+    queue = bot.TrackQueue(make_entry(i, random.Random(i)) for i in range(5))
+    with pytest.raises(IndexError):
+        queue[5]
+    with pytest.raises(IndexError):
+        queue.pop(-6)
+    with pytest.raises(IndexError):
+        bot.TrackQueue().popleft()
+
+
+def test_version_and_generation():
+    rng = random.Random(0)
+    queue = bot.TrackQueue()
+    version = queue.version
+    queue.append(make_entry(1, rng))
+    assert queue.version > version
+    generation = queue.generation
+    queue.clear()
+    assert queue.generation == generation + 1
+    assert_same(queue, [])
+
+
+def test_aggregates_reset_when_emptied():
+    queue = bot.TrackQueue([bot.QueueEntry("https://example.com/a", "a", 1, 0.1), bot.QueueEntry("https://example.com/b", "b", 2, 0.2)])
+    queue.popleft()
+    queue.popleft()
+    assert queue.total_duration == 0
+    assert not queue.requester_counts
+
+
+def test_blocks_stay_compact(small_blocks):
+    # 削除で小さくなったブロックは結合され、ブロック数は 2*曲数/BLOCK_SIZE+1 を超えない
+    rng = random.Random(1)
+    queue = bot.TrackQueue()
+    for i in range(400):
+        queue.insert(rng.randrange(len(queue) + 1), make_entry(i, rng))
+    while len(queue) > 10:
+        if rng.random() < 0.5: queue.pop(rng.randrange(len(queue)))
+        else:
+            start = rng.randrange(len(queue))
+            queue.remove_range(start, start + rng.randrange(1, 8))
+        assert len(queue._blocks) <= 2 * len(queue) / bot.TrackQueue.BLOCK_SIZE + 1
+        assert all(queue._blocks)